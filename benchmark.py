@@ -0,0 +1,750 @@
+# This script measures the performance of gdrive_manage.py offline,
+# without a google account. It generates a synthetic local tree and
+# syncs it with a fake Google Drive, which lives in the same process
+# and talks Drive v3 REST through the real googleapiclient, so the
+# whole way of requests is the same except the network.
+# The fake drive knows files.list/get/create/update/delete, changes,
+# batch requests, multipart and resumable uploads and ranged downloads.
+# Every request can be delayed and randomly failed with 429, 503 or
+# 403 rate limit exceeded to see how the sync copes. A POST isn't
+# failed with 503: gdrive may make an object and still answer 503,
+# so the sync doesn't repeat it, see RequestGate.retryable.
+# Runs these scenarios one by one:
+# 1. initial upload - the whole tree to an empty gdrive folder
+# 2. unchanged resync - nothing changed, only listing and comparing
+# 3. local changes - some files changed, added and deleted locally
+# 4. partial update - the same kind of changes by sync_partial
+# 5. full download - the gdrive folder to a new empty local folder
+# and reports for every one wall time, requests by kinds, bytes sent
+# and received and retries. After every scenario both sides are
+# compared, a mismatch is reported as an error.
+# Optional arguments:
+# 1. --depth, --fanout, --files-per-dir the shape of the tree: how
+# deep, how many dirs in every dir and how many files in every dir
+# 2. --file-sizes the distribution of file sizes like 4K:80,256K:15,8M:5
+# which means 80% of files are 4 KB, 15% - 256 KB and 5% - 8 MB
+# 3. --changes a share of files changed by scenarios 3 and 4, 0.1 by default
+# 4. --latency seconds every request takes, --bandwidth bytes per second
+# of every request body, 0 means unlimited
+# 5. --error-rate a share of requests answered by an error
+# 6. --max-transfers, --delta, --hash-local, --local-walkers are passed
+# to GdriveSync, see gdrive_manage.py
+# 7. --seed makes the tree, the changes and the errors repeatable
+# 8. --json saves the report to a file, --keep keeps generated trees
+# in a given directory instead of a temporary one
+
+import logging
+import sys
+import json
+import re
+import hashlib
+from os import path, makedirs, remove, walk, utime
+from random import Random
+from email.parser import FeedParser
+from urllib.parse import urlsplit, parse_qs, unquote
+from datetime import datetime, UTC
+from threading import RLock
+from time import sleep, time, perf_counter
+from argparse import ArgumentParser, ArgumentTypeError
+from tempfile import mkdtemp
+from shutil import rmtree
+from httplib2 import Response
+from googleapiclient.discovery import build_from_document
+import gdrive_manage as gm
+
+FOLDER = 'application/vnd.google-apps.folder'
+# sizes in --file-sizes
+UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+class QueryParser:
+    """parses files.list queries, which gdrive_manage.py makes, into
+    a function telling if a file matches. Knows 'id' in parents,
+    name, mimeType and trashed comparisons, name contains, and, or,
+    not and parentheses
+    """
+    TOKENS = re.compile(r"\s*(\(|\)|'(?:[^'\\]|\\.)*'|!=|=|[A-Za-z]+)")
+
+    def __init__(self, query: str) -> None:
+        self.tokens = []
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            match = self.TOKENS.match(query, position)
+            if match is None:
+                raise ValueError(f'Invalid query: {query}')
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+    def parse(self):
+        """returns a function taking file metadata"""
+        matches = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f'Unexpected {self.tokens[self.position]}')
+        return matches
+
+    def _next(self) -> str|None:
+        token = self.tokens[self.position] if self.position < len(self.tokens) else None
+        self.position += 1
+        return token
+
+    def _peek(self) -> str|None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _or(self):
+        items = [self._and()]
+        while self._peek() == 'or':
+            self._next()
+            items.append(self._and())
+        return items[0] if len(items) == 1 else lambda file: any(item(file) for item in items)
+
+    def _and(self):
+        items = [self._atom()]
+        while self._peek() == 'and':
+            self._next()
+            items.append(self._atom())
+        return items[0] if len(items) == 1 else lambda file: all(item(file) for item in items)
+
+    def _atom(self):
+        token = self._next()
+        if token == '(':
+            inner = self._or()
+            if self._next() != ')':
+                raise ValueError('Unbalanced parentheses')
+            return inner
+        if token == 'not':
+            inner = self._atom()
+            return lambda file: not inner(file)
+        # 'value' in parents
+        if token.startswith("'"):
+            value = self._string(token)
+            if self._next() != 'in' or self._next() != 'parents':
+                raise ValueError('Only "in parents" is supported')
+            return lambda file: value in file['parents']
+        field, operator, value = token, self._next(), self._next()
+        if value is None:
+            raise ValueError('Unexpected end of the query')
+        value = self._string(value) if value.startswith("'") else value == 'true'
+        if operator == 'contains':
+            return lambda file: value in file.get(field, '')
+        if operator == '=':
+            return lambda file: file.get(field) == value
+        if operator == '!=':
+            return lambda file: file.get(field) != value
+        raise ValueError(f'Unknown operator {operator}')
+
+    @staticmethod
+    def _string(token: str) -> str:
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+
+class FakeDrive:
+    """in-process Drive v3 backend. Takes the place of the http object
+    of googleapiclient services: request() gets the same arguments
+    as httplib2.Http.request and returns a response and content.
+    Safe to use from several threads
+    """
+    BASE = 'https://www.googleapis.com'
+
+    def __init__(self, latency: float=0.0, bandwidth: int=0, error_rate: float=0.0, seed: int=0) -> None:
+        """
+        Args:
+            latency (float, optional): seconds every request takes
+            bandwidth (int, optional): bytes per second, 0 - unlimited
+            error_rate (float, optional): a share of requests answered
+                        by 429, 503 or 403 rate limit exceeded. A POST
+                        isn't answered by 503
+            seed (int, optional): for repeatable errors
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._random = Random(seed)
+        self._lock = RLock()
+        # metadata by ids, contents of files separately
+        self.files = {'root': self._meta('root', 'My Drive', FOLDER, [])}
+        self.contents = {}
+        # ids of changed files in order, a page token is a position here
+        self.changes = []
+        # resumable upload sessions by ids
+        self.sessions = {}
+        self._last_id = 0
+
+    # ------------------ http ------------------
+    def request(self, uri: str, method: str='GET', body=None, headers=None, *args, **kwargs) -> tuple[Response, bytes]:
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        # chunks of resumable uploads come as file-like slices
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        body = body or b''
+        if self._fail():
+            status, response_headers, content = self._error(method)
+        else:
+            parts = urlsplit(uri)
+            status, response_headers, content = self._dispatch(method, parts.path, parse_qs(parts.query), headers, body)
+        delay = self.latency
+        if self.bandwidth:
+            delay += (len(body) + len(content)) / self.bandwidth
+        if delay:
+            sleep(delay)
+        return Response({'status': status, **response_headers}), content
+
+    def _fail(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _error(self, method: str) -> tuple[int, dict, bytes]:
+        with self._lock:
+            status = self._random.choice([429, 503, 403] if method != 'POST' else [429, 403])
+        reason = {429: 'rateLimitExceeded', 503: 'backendError', 403: 'userRateLimitExceeded'}[status]
+        return self._json(status, {'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+
+    @staticmethod
+    def _json(status: int, data: dict, headers: dict|None=None) -> tuple[int, dict, bytes]:
+        return status, {'content-type': 'application/json; charset=UTF-8', **(headers or {})}, json.dumps(data).encode()
+
+    def _not_found(self, file_id: str) -> tuple[int, dict, bytes]:
+        return self._json(404, {'error': {'code': 404, 'message': f'File not found: {file_id}.',
+                                          'errors': [{'reason': 'notFound'}]}})
+
+    def _dispatch(self, method: str, url_path: str, query: dict, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        """routes a request by it's method and path"""
+        param = lambda name: query.get(name, [None])[0]
+        if url_path == '/batch/drive/v3':
+            return self._batch(headers, body)
+        if url_path == '/drive/v3/changes/startPageToken':
+            with self._lock:
+                return self._json(200, {'startPageToken': str(len(self.changes))})
+        if url_path == '/drive/v3/changes':
+            return self._list_changes(query)
+        upload = url_path.startswith('/upload')
+        match = re.fullmatch(r'(?:/upload)?/drive/v3/files(?:/([^/]+))?', url_path)
+        if match is None:
+            return self._json(404, {'error': {'code': 404, 'message': f'Unknown path {url_path}'}})
+        file_id = unquote(match.group(1)) if match.group(1) else None
+        if param('upload_id') is not None:
+            return self._upload_chunk(param('upload_id'), headers, body)
+        if method == 'GET' and file_id is None:
+            return self._list(query)
+        if method == 'GET' and param('alt') == 'media':
+            return self._download(file_id, headers)
+        if method == 'GET':
+            return self._get(file_id, param('fields'))
+        if method == 'DELETE':
+            return self._delete(file_id)
+        if method in ('POST', 'PATCH'):
+            if upload and param('uploadType') == 'resumable':
+                return self._start_session(file_id, query, headers, body)
+            metadata, content = self._split_upload(param('uploadType'), headers, body) if upload else \
+                (json.loads(body or b'{}'), None)
+            if method == 'POST':
+                return self._create(metadata, content, param('fields'))
+            return self._update(file_id, metadata, content, query)
+        return self._json(405, {'error': {'code': 405, 'message': f'{method} is not supported'}})
+
+    # ------------------ metadata ------------------
+    @staticmethod
+    def _now() -> str:
+        return FakeDrive._rfc3339(datetime.now(UTC))
+
+    @staticmethod
+    def _rfc3339(moment: datetime) -> str:
+        moment = moment.astimezone(UTC)
+        return f'{moment.strftime("%Y-%m-%dT%H:%M:%S")}.{moment.microsecond // 1000:03d}Z'
+
+    def _meta(self, file_id: str, name: str, mime_type: str, parents: list[str], modified: str|None=None) -> dict:
+        return {
+            'kind': 'drive#file', 'id': file_id, 'name': name, 'mimeType': mime_type,
+            'parents': parents, 'trashed': False, 'modifiedTime': modified or self._now()
+        }
+
+    def _new_id(self) -> str:
+        self._last_id += 1
+        return f'fake{self._last_id:08d}'
+
+    def _set_content(self, file: dict, content: bytes) -> None:
+        self.contents[file['id']] = content
+        file['size'] = str(len(content))
+        file['md5Checksum'] = hashlib.md5(content).hexdigest()
+
+    def _apply_metadata(self, file: dict, metadata: dict) -> None:
+        for key in ('name', 'mimeType', 'trashed'):
+            if key in metadata:
+                file[key] = metadata[key]
+        if 'modifiedTime' in metadata:
+            file['modifiedTime'] = self._rfc3339(datetime.fromisoformat(metadata['modifiedTime']))
+
+    def _changed(self, file_id: str) -> None:
+        self.changes.append(file_id)
+
+    @staticmethod
+    def _select(data, fields: str|None):
+        """Applies a partial response selector like
+        'nextPageToken, files(id, name)'
+
+        Args:
+            data: a response
+            fields (str | None): the selector, None returns everything
+        """
+        if not fields:
+            return data
+        selector = {}
+        stack = [selector]
+        for token in re.findall(r'[\w\*]+|[(),]', fields):
+            if token == '(':
+                stack.append(stack[-1][last])
+            elif token == ')':
+                stack.pop()
+            elif token != ',':
+                last = token
+                stack[-1][token] = {}
+        def apply(value, selector: dict):
+            if not selector or '*' in selector:
+                return value
+            if isinstance(value, list):
+                return [apply(item, selector) for item in value]
+            if isinstance(value, dict):
+                return {key: apply(value[key], inner) for key, inner in selector.items() if key in value}
+            return value
+        return apply(data, selector)
+
+    # ------------------ files ------------------
+    def _list(self, query: dict) -> tuple[int, dict, bytes]:
+        matches = QueryParser(query.get('q', ['trashed = false'])[0]).parse()
+        page_size = min(1000, int(query.get('pageSize', ['100'])[0]))
+        start = int(query.get('pageToken', ['0'])[0])
+        with self._lock:
+            found = [dict(file) for file in self.files.values() if file['id'] != 'root' and matches(file)]
+        result = {'kind': 'drive#fileList', 'files': found[start:start + page_size]}
+        if start + page_size < len(found):
+            result['nextPageToken'] = str(start + page_size)
+        return self._json(200, self._select(result, query.get('fields', [None])[0]))
+
+    def _get(self, file_id: str, fields: str|None) -> tuple[int, dict, bytes]:
+        with self._lock:
+            file = self.files.get(file_id)
+            if file is None:
+                return self._not_found(file_id)
+            return self._json(200, self._select(dict(file), fields))
+
+    def _create(self, metadata: dict, content: bytes|None, fields: str|None) -> tuple[int, dict, bytes]:
+        with self._lock:
+            parents = metadata.get('parents') or ['root']
+            for parent in parents:
+                if parent not in self.files:
+                    return self._not_found(parent)
+            file = self._meta(self._new_id(), metadata.get('name', 'Untitled'),
+                              metadata.get('mimeType', 'application/octet-stream'), list(parents))
+            self._apply_metadata(file, metadata)
+            if file['mimeType'] != FOLDER:
+                self._set_content(file, content or b'')
+            self.files[file['id']] = file
+            self._changed(file['id'])
+            return self._json(200, self._select(dict(file), fields))
+
+    def _update(self, file_id: str, metadata: dict, content: bytes|None, query: dict) -> tuple[int, dict, bytes]:
+        with self._lock:
+            file = self.files.get(file_id)
+            if file is None:
+                return self._not_found(file_id)
+            add_parents = [item for item in query.get('addParents', [''])[0].split(',') if item]
+            remove_parents = [item for item in query.get('removeParents', [''])[0].split(',') if item]
+            for parent in add_parents:
+                if parent not in self.files:
+                    return self._not_found(parent)
+            file['parents'] = [item for item in file['parents'] if item not in remove_parents] + add_parents
+            self._apply_metadata(file, metadata)
+            if content is not None:
+                self._set_content(file, content)
+                if 'modifiedTime' not in metadata:
+                    file['modifiedTime'] = self._now()
+            self._changed(file_id)
+            return self._json(200, self._select(dict(file), query.get('fields', [None])[0]))
+
+    def _delete(self, file_id: str) -> tuple[int, dict, bytes]:
+        with self._lock:
+            if file_id not in self.files:
+                return self._not_found(file_id)
+            # everything inside goes with the folder
+            to_delete = [file_id]
+            while to_delete:
+                current = to_delete.pop()
+                to_delete += [item['id'] for item in self.files.values() if current in item['parents']]
+                self.files.pop(current, None)
+                self.contents.pop(current, None)
+                self._changed(current)
+        return 204, {}, b''
+
+    def _download(self, file_id: str, headers: dict) -> tuple[int, dict, bytes]:
+        with self._lock:
+            if file_id not in self.files:
+                return self._not_found(file_id)
+            content = self.contents.get(file_id, b'')
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if match is None or not content:
+            return 200, {'content-length': str(len(content))}, content
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+        if start >= len(content):
+            return 416, {'content-range': f'bytes */{len(content)}'}, b''
+        return 206, {'content-range': f'bytes {start}-{end}/{len(content)}'}, content[start:end + 1]
+
+    # ------------------ uploads ------------------
+    @staticmethod
+    def _split_upload(upload_type: str|None, headers: dict, body: bytes) -> tuple[dict, bytes]:
+        """takes metadata and media from a multipart/related or a media upload"""
+        if upload_type == 'media':
+            return {}, body
+        boundary = re.search(r'boundary="?([^";]+)"?', headers.get('content-type', '')).group(1).encode()
+        parts = []
+        for part in body.split(b'--' + boundary)[1:-1]:
+            # a part starts with the line end after the boundary and ends
+            # with one before the next boundary, media may have any bytes
+            line_end = b'\r\n' if part.startswith(b'\r\n') else b'\n'
+            _, payload = part[len(line_end):-len(line_end)].split(line_end * 2, 1)
+            parts.append(payload)
+        return json.loads(parts[0] or b'{}'), parts[1]
+
+    def _start_session(self, file_id: str|None, query: dict, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        with self._lock:
+            if file_id is not None and file_id not in self.files:
+                return self._not_found(file_id)
+            session_id = self._new_id()
+            self.sessions[session_id] = {
+                'file_id': file_id, 'metadata': json.loads(body or b'{}'), 'query': query,
+                'size': int(headers.get('x-upload-content-length', -1)), 'data': bytearray()
+            }
+        location = f'{self.BASE}/upload/drive/v3/files?uploadType=resumable&upload_id={session_id}'
+        return 200, {'location': location}, b''
+
+    def _upload_chunk(self, session_id: str, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return self._not_found(session_id)
+            match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', headers.get('content-range', ''))
+            if match is not None:
+                if int(match.group(1)) == len(session['data']):
+                    session['data'] += body
+                if match.group(3) != '*':
+                    session['size'] = int(match.group(3))
+            else:
+                match = re.fullmatch(r'bytes \*/(\d+)', headers.get('content-range', ''))
+                if match is not None:
+                    session['size'] = int(match.group(1))
+            if len(session['data']) < session['size']:
+                progress = {'range': f'bytes=0-{len(session["data"]) - 1}'} if session['data'] else {}
+                return 308, progress, b''
+            del self.sessions[session_id]
+        content = bytes(session['data'])
+        if session['file_id'] is None:
+            return self._create(session['metadata'], content, session['query'].get('fields', [None])[0])
+        return self._update(session['file_id'], session['metadata'], content, session['query'])
+
+    # ------------------ changes ------------------
+    def _list_changes(self, query: dict) -> tuple[int, dict, bytes]:
+        start = int(query.get('pageToken', ['0'])[0])
+        page_size = min(1000, int(query.get('pageSize', ['100'])[0]))
+        with self._lock:
+            file_ids = self.changes[start:start + page_size]
+            changes = []
+            for file_id in file_ids:
+                file = self.files.get(file_id)
+                change = {'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id, 'removed': file is None}
+                if file is not None:
+                    change['file'] = dict(file)
+                changes.append(change)
+            result = {'kind': 'drive#changeList', 'changes': changes}
+            if start + page_size < len(self.changes):
+                result['nextPageToken'] = str(start + page_size)
+            else:
+                result['newStartPageToken'] = str(len(self.changes))
+        return self._json(200, self._select(result, query.get('fields', [None])[0]))
+
+    # ------------------ batch ------------------
+    def _batch(self, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        """executes every request of a multipart/mixed batch"""
+        parser = FeedParser()
+        parser.feed(f'content-type: {headers["content-type"]}\r\n\r\n' + body.decode('utf-8'))
+        with self._lock:
+            boundary = f'batch_{self._new_id()}'
+        answers = []
+        for part in parser.close().get_payload():
+            request_line, serialized = part.get_payload().split('\n', 1)
+            method, target, _ = request_line.split(' ', 2)
+            inner = FeedParser()
+            inner.feed(serialized)
+            message = inner.close()
+            inner_headers = {key.lower(): value for key, value in message.items()}
+            target = urlsplit(target)
+            if self._fail():
+                status, response_headers, content = self._error(method)
+            else:
+                status, response_headers, content = self._dispatch(
+                    method, target.path, parse_qs(target.query), inner_headers, message.get_payload().encode('utf-8')
+                )
+            content_id = part['Content-ID'].replace('<', '<response-', 1)
+            response_headers['content-length'] = str(len(content))
+            answer_headers = ''.join(f'{key}: {value}\r\n' for key, value in response_headers.items())
+            answers.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n'
+                f'HTTP/1.1 {status} X\r\n{answer_headers}\r\n{content.decode("utf-8")}\r\n'
+            )
+        content = (''.join(answers) + f'--{boundary}--').encode('utf-8')
+        return 200, {'content-type': f'multipart/mixed; boundary={boundary}'}, content
+
+    # ------------------ helpers ------------------
+    def tree(self, folder_id: str) -> dict[str, str|None]:
+        """Everything inside a folder
+
+        Args:
+            folder_id (str): the folder id
+
+        Returns:
+            dict[str, str|None]: md5 of files and None for folders
+                        by paths relative to the folder
+        """
+        with self._lock:
+            found = {}
+            to_visit = [(folder_id, '')]
+            while to_visit:
+                current, rel_dir = to_visit.pop()
+                for file in self.files.values():
+                    if current in file['parents'] and not file['trashed']:
+                        rel_path = path.join(rel_dir, file['name'])
+                        found[rel_path] = None if file['mimeType'] == FOLDER else file['md5Checksum']
+                        if file['mimeType'] == FOLDER:
+                            to_visit.append((file['id'], rel_path))
+            return found
+
+    def find_folder(self, name: str) -> str|None:
+        """id of a folder in the root"""
+        with self._lock:
+            for file in self.files.values():
+                if file['name'] == name and 'root' in file['parents'] and file['mimeType'] == FOLDER:
+                    return file['id']
+        return None
+
+class BenchSync(gm.GdriveSync):
+    """GdriveSync talking to a FakeDrive. Requests still go through
+    the gate and the metrics, only authorization is skipped
+    """
+    def __init__(self, drive: FakeDrive, **kwargs) -> None:
+        self.drive = drive
+        super().__init__(client_secrets_file='client_secret.json', token_file='token.json', scopes=[], **kwargs)
+
+    def make_creds(self) -> None:
+        if self.service is None:
+            self.service = build_from_document(gm.drive_discovery(), http=gm.GatedHttp(self.drive, self.gate, self.metrics))
+
+def parse_sizes(arg_string: str) -> list[tuple[int, float]]:
+    """Parses --file-sizes like 4K:80,256K:15,8M:5
+
+    Returns:
+        list[tuple[int, float]]: sizes in bytes and their weights
+    """
+    sizes = []
+    try:
+        for item in arg_string.split(','):
+            size, weight = item.split(':')
+            match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)', size.strip().upper())
+            sizes.append((int(float(match.group(1)) * UNITS[match.group(2)]), float(weight)))
+    except (ValueError, AttributeError):
+        raise ArgumentTypeError('Wrong usage, example: --file-sizes 4K:80,256K:15,8M:5')
+    return sizes
+
+def make_tree(root: str, depth: int, fanout: int, files_per_dir: int, sizes: list[tuple[int, float]], rng: Random) -> list[str]:
+    """Generates a synthetic local tree
+
+    Args:
+        root (str): where to make it
+        depth (int): levels of directories under the root
+        fanout (int): directories in every directory
+        files_per_dir (int): files in every directory
+        sizes (list[tuple[int, float]]): sizes of files and their weights
+        rng (Random): the source of sizes and contents
+
+    Returns:
+        list[str]: relative paths of made files
+    """
+    files = []
+    level = ['']
+    for current_depth in range(depth + 1):
+        next_level = []
+        for rel_dir in level:
+            makedirs(path.join(root, rel_dir), exist_ok=True)
+            for number in range(files_per_dir):
+                rel_path = path.join(rel_dir, f'file_{number}.bin')
+                write_file(root, rel_path, rng.choices([size for size, _ in sizes], [weight for _, weight in sizes])[0], rng)
+                files.append(rel_path)
+            if current_depth < depth:
+                next_level += [path.join(rel_dir, f'dir_{number}') for number in range(fanout)]
+        level = next_level
+    return files
+
+def write_file(root: str, rel_path: str, size: int, rng: Random) -> None:
+    """writes random content, mtime is a whole second like on gdrive"""
+    full_path = path.join(root, rel_path)
+    with open(full_path, 'wb') as file:
+        file.write(rng.randbytes(size))
+    mtime = int(time()) - rng.randint(60, 3600)
+    utime(full_path, (mtime, mtime))
+
+def local_tree(root: str) -> dict[str, str|None]:
+    """same as FakeDrive.tree for a local directory"""
+    found = {}
+    for dir_path, dirs, files in walk(root):
+        rel_dir = path.relpath(dir_path, root)
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        for name in dirs:
+            found[path.join(rel_dir, name)] = None
+        for name in files:
+            with open(path.join(dir_path, name), 'rb') as file:
+                found[path.join(rel_dir, name)] = hashlib.md5(file.read()).hexdigest()
+    return found
+
+def change_tree(root: str, files: list[str], share: float, sizes: list[tuple[int, float]], rng: Random) -> dict:
+    """Changes, adds and deletes a share of files, like a user would
+
+    Returns:
+        dict: the changes as actions for sync_partial
+    """
+    count = max(1, int(len(files) * share))
+    picked = rng.sample(files, min(len(files), count * 2))
+    to_update, to_delete = picked[:count], picked[count:]
+    actions = {'update_file': [], 'create_file': [], 'delete_file': []}
+    for rel_path in to_update:
+        write_file(root, rel_path, rng.choices([size for size, _ in sizes], [weight for _, weight in sizes])[0], rng)
+        # a fresh mtime, so the change is newer than gdrive
+        utime(path.join(root, rel_path))
+        actions['update_file'].append(rel_path)
+    for rel_path in to_delete:
+        remove(path.join(root, rel_path))
+        files.remove(rel_path)
+        actions['delete_file'].append(rel_path)
+    for number in range(count):
+        rel_path = path.join(path.dirname(rng.choice(files)), f'new_{number}_{rng.randint(0, 10 ** 6)}.bin')
+        write_file(root, rel_path, rng.choices([size for size, _ in sizes], [weight for _, weight in sizes])[0], rng)
+        utime(path.join(root, rel_path))
+        files.append(rel_path)
+        actions['create_file'].append(rel_path)
+    return actions
+
+def run_scenario(title: str, drive: FakeDrive, run, sync: BenchSync, local_root: str, gdrive_folder: str) -> dict:
+    """Runs one scenario and checks both sides are the same after it
+
+    Args:
+        title (str): the scenario name
+        drive (FakeDrive): the fake gdrive
+        run (callable): what to run, takes nothing
+        sync (BenchSync): the object, which runs, for it's metrics
+        local_root (str): the synced local folder
+        gdrive_folder (str): the synced gdrive folder name
+
+    Returns:
+        dict: wall time, requests by kinds, bytes and retries
+    """
+    started = perf_counter()
+    run()
+    seconds = perf_counter() - started
+    metrics = sync.metrics.to_dict(title)
+    requests = {kind: item['count'] for kind, item in metrics['requests'].items()}
+    result = {
+        'scenario': title,
+        'seconds': round(seconds, 3),
+        'requests': sum(requests.values()),
+        'by_kind': requests,
+        'retries': sum(item['retries'] for item in metrics['requests'].values()),
+        'sent': sum(item['sent'] for item in metrics['requests'].values()),
+        'received': sum(item['received'] for item in metrics['requests'].values()),
+        'phases': {phase: round(value, 3) for phase, value in metrics['phases'].items()}
+    }
+    remote = drive.tree(drive.find_folder(gdrive_folder))
+    local = local_tree(local_root)
+    if remote != local:
+        differences = sorted(set(remote.items()) ^ set(local.items()))
+        result['error'] = f'{len(differences)} difference(s), like {differences[:3]}'
+        logger.error(f'{title}: both sides differ, {result["error"]}')
+    return result
+
+def print_report(results: list[dict]) -> None:
+    print(f'{"scenario":<18} {"seconds":>8} {"requests":>8} {"retries":>7} {"MB sent":>8} {"MB recv":>8}  by kind')
+    for result in results:
+        by_kind = ', '.join(f'{kind} {count}' for kind, count in sorted(result['by_kind'].items()))
+        print(f'{result["scenario"]:<18} {result["seconds"]:>8.2f} {result["requests"]:>8} {result["retries"]:>7} '
+              f'{result["sent"] / 1024 / 1024:>8.1f} {result["received"] / 1024 / 1024:>8.1f}  {by_kind}'
+              + (f'  ERROR {result["error"]}' if 'error' in result else ''))
+
+if __name__ == '__main__':
+    logging.basicConfig(format='{asctime} [{levelname:8}] {message}', style='{', level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+    # gdrive_manage.py makes it's logger only when run as a script
+    gm.logger = logger
+
+    parser = ArgumentParser(description='Benchmark of gdrive_manage.py against a fake Google Drive')
+    parser.add_argument('--depth', type=int, default=2, help='levels of directories')
+    parser.add_argument('--fanout', type=int, default=4, help='directories in every directory')
+    parser.add_argument('--files-per-dir', type=int, default=20, help='files in every directory')
+    parser.add_argument('--file-sizes', type=parse_sizes, default=parse_sizes('4K:80,256K:15,8M:5'),
+                        help='sizes and their shares, like 4K:80,256K:15,8M:5')
+    parser.add_argument('--changes', type=float, default=0.1, help='a share of files changed by scenarios 3 and 4')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every request takes')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second, 0 - unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='a share of requests answered by errors')
+    parser.add_argument('--max-transfers', type=int, default=4)
+    parser.add_argument('--local-walkers', type=int, default=1)
+    parser.add_argument('--delta', action='store_true')
+    parser.add_argument('--hash-local', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', type=str, help='save the report to this file')
+    parser.add_argument('--keep', type=str, help='make trees in this directory and keep them')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the sync logs')
+    args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+
+    work_dir = args.keep or mkdtemp(prefix='gdrive_bench_')
+    makedirs(work_dir, exist_ok=True)
+    rng = Random(args.seed)
+    drive = FakeDrive(args.latency, args.bandwidth, args.error_rate, args.seed)
+    local_root = path.join(work_dir, 'local')
+    files = make_tree(local_root, args.depth, args.fanout, args.files_per_dir, args.file_sizes, rng)
+    total_size = sum(path.getsize(path.join(local_root, rel_path)) for rel_path in files)
+    print(f'{len(files)} files, {total_size / 1024 / 1024:.1f} MB in {work_dir}')
+    options = {
+        'gdrive_folder': 'Benchmark',
+        'state_file': path.join(work_dir, 'sync_state.db'),
+        'max_transfers': args.max_transfers,
+        'max_walkers': args.local_walkers,
+        'delta': args.delta,
+        'hash_local': args.hash_local
+    }
+    results = []
+    try:
+        sync = BenchSync(drive, local_folder=local_root, sync_direction='local_to_gdrive', **options)
+        results.append(run_scenario('initial upload', drive, sync.sync, sync, local_root, 'Benchmark'))
+        sync = BenchSync(drive, local_folder=local_root, sync_direction='local_to_gdrive', **options)
+        results.append(run_scenario('unchanged resync', drive, sync.sync, sync, local_root, 'Benchmark'))
+        change_tree(local_root, files, args.changes, args.file_sizes, rng)
+        sync = BenchSync(drive, local_folder=local_root, sync_direction='local_to_gdrive', **options)
+        results.append(run_scenario('local changes', drive, sync.sync, sync, local_root, 'Benchmark'))
+        actions = json.dumps(change_tree(local_root, files, args.changes, args.file_sizes, rng))
+        sync = BenchSync(drive, local_folder=local_root, **options)
+        results.append(run_scenario('partial update', drive, lambda: sync.sync_partial(actions), sync, local_root, 'Benchmark'))
+        download_root = path.join(work_dir, 'download')
+        makedirs(download_root, exist_ok=True)
+        sync = BenchSync(drive, local_folder=download_root, sync_direction='mirror', **options)
+        results.append(run_scenario('full download', drive, sync.sync, sync, download_root, 'Benchmark'))
+    finally:
+        if not args.keep:
+            rmtree(work_dir, ignore_errors=True)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'arguments': {key: value for key, value in vars(args).items() if key != 'file_sizes'} |
+                       {'file_sizes': args.file_sizes, 'files': len(files), 'bytes': total_size},
+                       'results': results}, file, indent=2)
+    sys.exit(1 if any('error' in result for result in results) else 0)
@@ -8,12 +8,53 @@
 # 1. A list of objects to not sync. --ignore path=<somepath>,type=<ignoretype>
 # where "somepath" is relative path inside the syncing directory and
 # ignoretype can be "single_file", "all_files", "folder" which covers
-# all cases
+# all cases. --ignore-pattern <pattern> ignores everything matching
+# a glob pattern like in .gitignore: "*.tmp", "**/.trash/", "build/*.log".
+# Ignored directories aren't walked locally and aren't listed on gdrive
 # 2. -n --new flag. A new gdrive directory will be created instead of
 # searching an existing one. If there is an existing one with such name,
 # the new one will be created with slightly different name
 # 3. --sync-direction handles file deletions. It has four
 # options: "gdrive_to_local", "local_to_gdrive", "mirror", "ask"
+# 4. --max-transfers how many files are uploaded or downloaded
+# simultaneously, 4 by default. 1 makes them go one by one
+# 5. --delta takes from gdrive only the changes made since the last
+# sync, instead of listing the whole gdrive directory every time
+# 6. --simple-upload-threshold files up to this size in MB are uploaded
+# by one request, bigger ones - by a resumable session. 5 by default
+# 7. --chunk-size a resumable session sends files by chunks of this
+# size in MB, 8 by default
+# 8. --download-chunk-size files are downloaded by chunks of this size
+# in MB, 100 by default
+# 9. --hash-local count md5 of all local files before comparing, so
+# files with different mtimes but the same content aren't transferred
+# without reading them one by one during the comparison
+# 10. --local-walkers how many local directories are read at once,
+# 1 by default. More helps for wide trees on network filesystems
+# 11. --watch keep running after the sync, watch the local folder by
+# inotify (or by polling, where there is no inotify) and upload it's
+# changes a couple of seconds after they calm down, with one warm
+# process instead of starting a sync every time. Repeats the full sync
+# every --full-sync-interval minutes, 60 by default, to bring changes
+# from gdrive and anything the watcher could miss
+# 12. --metrics-file every sync logs how long it's phases took and
+# gdrive requests by kinds: number, latency, bytes and retries. With
+# this option the same is appended to the file as a json line
+# 13. --record writes all gdrive requests and responses of the run to
+# a gzipped file. Ids and page tokens are replaced by made up ones,
+# the access token and contents of files aren't written. --replay runs
+# the sync from such a file instead of gdrive, offline and without
+# credentials, --replay-speed scales the recorded time of requests,
+# 0 doesn't wait at all. A replay follows the recording only if both
+# start from the same local folder and the same state of the last sync,
+# the easiest is to give both a new --state-file
+# 14. --state-file where the state of the last sync is kept,
+# sync_state.db next to the script by default
+# 15. --address where --mode serve listens and --client connects to:
+# a unix socket path or host:port. By default a socket named after the
+# local folder in a directory only the user can access, or a localhost
+# port where there are no unix sockets. A host:port server accepts only
+# clients, which know it's random token from a file next to the socket
 # --------
 # new mode - partial update. Instead of --sync-direction expects these
 # arguments '--mode' 'partial_update' '--actions_json' '{
@@ -26,7 +67,15 @@
 #    'move': {'local/path/old_name: local/path/new_name', ...}
 # }'
 # This mode doesn't respect --ignore and just fullfills the actions
-# listed in --actions_json
+# listed in --actions_json. With --client the actions are sent to
+# a running '--mode serve' process of the same local folder and applied
+# there, if there is no such process, they are applied as usual.
+# '--mode serve' keeps running with warm credentials, service and dir
+# ids, coalesces actions coming close to each other into one update and
+# answers every client when it's actions are applied.
+# Ids of gdrive directories are remembered in sync_state.db, so the next
+# partial update doesn't look for them again. A remembered directory is
+# checked before it's used, it could be deleted or moved on gdrive
 
 # The logic of syncing - go over either local or gdrive files.
 # If anything is newer on a local machine - upload it to gdrive,
@@ -60,30 +109,86 @@
 # "local_to_gdrive", the script will interactively ask user what
 # to do with differences in the catalog structure. Either "c" to
 # create an absent file or "r" to remove the difference.
+# Every synced file and directory is remembered in sync_state.db
+# next to token.json, with it's gdrive id and mtime. So "mirror" and
+# "ask" can tell a deletion from a new object: if something is absent
+# on one side, but exists unchanged on the other since the last sync,
+# it was deleted and the deletion is repeated on the other side without
+# asking. Anything new or modified is still copied over.
+# Big files are uploaded by resumable sessions and downloaded to
+# <name>.gdsync-part files, their progress is journaled in the same
+# database. If a transfer is interrupted, the next try continues from
+# the last transferred chunk instead of sending the whole file again.
+# A sync makes a plan of all the operations and performs it, journaling
+# every done one. Gdrive folders are compared as soon as they are
+# listed, so transfers start while deeper folders are still being
+# listed ("ask" lists everything first, and asks before any change).
+# If the sync is interrupted by the network after the plan is complete,
+# the retry performs only the rest of the plan without scanning anything,
+# otherwise it starts over, skipping what is synced already.
+# If a file has different mtimes on both sides, but the same size and
+# md5, only the mtime is fixed, the file isn't transferred. Md5 of local
+# files are remembered by their inode, size and mtime, so unchanged
+# files aren't read again.
+# Requests throttled by gdrive (429, 5xx, 403 rate limit exceeded) are
+# repeated after a growing random pause, and less of them are sent at
+# once until gdrive calms down. All requests together are kept within
+# the gdrive quota of queries per minute.
+# The script starts fast: heavy modules (the OAuth flow, notifications)
+# are imported only when needed, and the Drive discovery document is
+# never requested over the network. A pyinstaller binary should bundle
+# only drive.v3.json (see DISCOVERY_DOCUMENT) instead of documents of
+# all google apis. Every first run of a process logs how long the
+# process took to start.
 
+# the startup time is counted from here, see Metrics.startup
+from time import perf_counter
+STARTED = perf_counter()
 import logging
 import subprocess
 import sys
 import json
+import re
+import sqlite3
+import hashlib
+import mmap
+import gzip
+import socket
+import struct
+import errno
+import ctypes
+import ctypes.util
+from random import uniform
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qs, unquote, unquote_plus
 from io import TextIOWrapper
-from os import path, listdir, remove, mkdir, utime, walk, _exit
+from os import path, scandir, remove, mkdir, utime, walk, replace, stat, lstat, stat_result, umask, environ, _exit
 from os import name as os_name
 from os import sep as os_sep
-from google.auth.transport.requests import Request
+from os import read as os_read, close as os_close, open as os_open, fsencode, fsdecode
+from stat import S_ISDIR
+from secrets import token_hex, compare_digest
+from select import select
+from tempfile import gettempdir
 from google.oauth2.credentials import Credentials
 from google.auth.exceptions import TransportError, RefreshError
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaFileUpload, build_http
+from google_auth_httplib2 import AuthorizedHttp, Request
 from io import FileIO
-from httplib2 import ServerNotFoundError
-from datetime import datetime, UTC
-from concurrent.futures import TimeoutError
-from time import sleep, time
+from httplib2 import ServerNotFoundError, Response
+from datetime import datetime, UTC, timedelta
+from concurrent.futures import TimeoutError, ThreadPoolExecutor, as_completed
+from threading import local, RLock, Condition, Thread, Event
+from queue import Queue
+from time import sleep, time, monotonic
 from argparse import ArgumentParser, ArgumentTypeError
 from typing import Literal
 from shutil import rmtree
+from itertools import groupby
+from collections import deque
 from datetime import datetime
 
 # ================= globals ==================
@@ -97,6 +202,75 @@ GOOGLE_LOGIN = {
     # If modifying these scopes, delete the file token.json.
     'scopes': ['https://www.googleapis.com/auth/drive']
 }
+# errors which mean that the network is down or flaky, so the whole
+# sync is worth to retry a bit later
+NETWORK_ERRORS = (TimeoutError, TransportError, ServerNotFoundError, RefreshError)
+# credentials are refreshed this many seconds before they expire,
+# so a long request doesn't start with an almost dead token
+CREDS_REFRESH_MARGIN = 300
+# how many folders' contents are requested by one files().list call.
+# Every folder adds about 50 characters to the query in the url
+LIST_PARENTS_PER_REQUEST = 40
+# gdrive doesn't take more requests in one batch
+BATCH_LIMIT = 100
+# files up to this size are uploaded in one multipart request. Bigger
+# ones - by a resumable session, which costs an extra request to start
+SIMPLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+# resumable uploads go by chunks of this size, has to be a multiple
+# of 256 KB. Bigger chunks mean less requests, but more to resend
+# if a chunk fails
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# a file is downloaded under it's name with this suffix and renamed
+# when complete. Such files are never synced
+PART_SUFFIX = '.gdsync-part'
+# downloads go by chunks of this size. Every chunk is a request
+DOWNLOAD_CHUNK_SIZE = 100 * 1024 * 1024
+# a plan of an interrupted sync is continued by the next try only if
+# it's younger than this, in seconds. Otherwise both sides are scanned
+# again, they could have changed too much
+PLAN_MAX_AGE = 30 * 60
+# local files are read by blocks of this size to count md5
+HASH_BLOCK_SIZE = 1024 * 1024
+# bigger files are mapped to memory and hashed in one go
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# the watch mode applies local changes when there were no new ones
+# for this many seconds, so a burst of events becomes one update
+WATCH_DEBOUNCE = 2
+# but doesn't wait longer than this, if changes keep coming
+WATCH_MAX_DELAY = 30
+# the watch mode makes a full sync this often, in seconds. It brings
+# changes from gdrive and anything the watcher could miss
+WATCH_FULL_SYNC_INTERVAL = 60 * 60
+# how often the local folder is scanned, where inotify is unavailable
+WATCH_POLL_INTERVAL = 5
+# a pause after a failed update in the watch mode
+WATCH_RETRY_DELAY = 60
+# gdrive allows 12000 queries a minute per user, see RequestGate
+GDRIVE_QUERIES_PER_SECOND = 12000 / 60
+# a request, throttled by gdrive, is repeated this many times, waiting
+# up to RETRY_BASE_DELAY * 2 ** attempt seconds, but not more than
+# RETRY_MAX_DELAY
+RETRY_ATTEMPTS = 6
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 64
+# upper bounds of latency histogram buckets of requests in seconds,
+# see Metrics
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# a warm process (--watch, --mode serve) doesn't check remembered
+# gdrive dirs again for this many seconds, see _verify_dirs
+DIR_VERIFY_INTERVAL = 10 * 60
+# --mode serve applies actions when no new ones came for this many
+# seconds, so a burst of saves becomes one update
+SERVE_DEBOUNCE = 0.3
+# a --client waits for the server's answer this many seconds
+SERVE_CLIENT_TIMEOUT = 5 * 60
+# where there are no unix sockets, the server listens on localhost
+# on a port from this range, chosen by the local folder
+SERVE_PORTS = (47000, 48000)
+# the Drive v3 discovery document, looked for in the pyinstaller bundle
+# (pyinstaller --add-data <...>/drive.v3.json:.) and taken from
+# googleapiclient if it's not there
+DISCOVERY_DOCUMENT = 'drive.v3.json'
 # =============== end globals ================
 
 # ========= special for pyinstaller ==========
@@ -117,8 +291,44 @@ def resource_path(relative_path, outer_file: bool=False):
     except Exception:
         base_path = path.abspath(".")
     return path.join(base_path, relative_path)
+
+# the discovery document, read once per process
+_discovery = None
+
+def drive_discovery() -> str:
+    """The Drive v3 discovery document to build services from. It's
+    never requested over the network and is read only once. A pyinstaller
+    binary has it's own copy, so documents of all google apis, which come
+    with googleapiclient (100+ MB), needn't be bundled and unpacked on
+    every start"""
+    global _discovery
+    if _discovery is None:
+        bundled = resource_path(DISCOVERY_DOCUMENT)
+        if path.isfile(bundled):
+            with open(bundled, encoding='utf-8') as file:
+                _discovery = file.read()
+        else:
+            from googleapiclient.discovery_cache import get_static_doc
+            _discovery = get_static_doc('drive', 'v3')
+            # a pyinstaller binary has no documents of googleapiclient
+            if _discovery is None:
+                raise FileNotFoundError(f'{DISCOVERY_DOCUMENT} is not found next to the script or in the binary, '
+                                        'and googleapiclient has no Drive v3 discovery document')
+    return _discovery
 # ======== end special for pyinstaller========
 
+def file_md5(full_path: str) -> str:
+    """counts md5 of a file, the same as gdrive md5Checksum"""
+    md5 = hashlib.md5()
+    with open(full_path, 'rb') as file:
+        if path.getsize(full_path) >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                md5.update(mapped)
+        else:
+            while block := file.read(HASH_BLOCK_SIZE):
+                md5.update(block)
+    return md5.hexdigest()
+
 class IgnoreThose:
     """this class is for storing paths to files or folders to ignore.
     Type of ignored objects can be specified: 'single_file',
@@ -152,7 +362,96 @@ class IgnoreThose:
             self.parents = path.dirname(rel_path)
         # tier to ease the search
         self.tier = len(self.parents)
-        
+
+class IgnoreMatcher:
+    """all ignore rules compiled to two regular expressions - for files
+    and for directories, so checking a path costs one match regardless
+    the amount of rules. Rules are IgnoreThose objects and glob patterns,
+    like in .gitignore: * - anything but a separator, ** - anything,
+    **/ - any amount of directories. A pattern without a separator
+    matches a name at any depth, a pattern ending with / matches
+    directories only
+    """
+    def __init__(self, ignored_objects: list[IgnoreThose], patterns: list[str]) -> None:
+        """
+        Args:
+            ignored_objects (list[IgnoreThose]): objects to ignore
+            patterns (list[str]): glob patterns, like *.tmp or **/.trash/
+        """
+        file_rules = []
+        dir_rules = []
+        for item in ignored_objects:
+            rel_path = re.escape(item.rel_path.replace(os_sep, '/'))
+            match item.obj_type:
+                case 'single_file':
+                    file_rules.append(rel_path)
+                case 'all_files':
+                    # files right in the syncing folder
+                    file_rules.append('[^/]+' if item.rel_path == '.' else f'{rel_path}/[^/]+')
+                case 'folder':
+                    dir_rules.append(rel_path)
+        for pattern in patterns:
+            rule, dirs_only = self._glob_to_regex(pattern)
+            dir_rules.append(rule)
+            if not dirs_only:
+                file_rules.append(rule)
+        self._files = re.compile('|'.join(f'(?:{rule})' for rule in file_rules)) if file_rules else None
+        self._dirs = re.compile('|'.join(f'(?:{rule})' for rule in dir_rules)) if dir_rules else None
+
+    @staticmethod
+    def _glob_to_regex(pattern: str) -> tuple[str, bool]:
+        """translates a glob pattern to a regular expression
+
+        Args:
+            pattern (str): a glob pattern
+
+        Returns:
+            tuple[str, bool]: the regular expression and if
+                        the pattern is for directories only
+        """
+        pattern = pattern.replace(os_sep, '/')
+        dirs_only = pattern.endswith('/')
+        # a pattern with a separator is related to the syncing folder
+        anchored = '/' in pattern.rstrip('/')
+        pattern = pattern.strip('/')
+        regex = '' if anchored else '(?:.*/)?'
+        position = 0
+        while position < len(pattern):
+            if pattern.startswith('**/', position):
+                regex += '(?:.*/)?'
+                position += 3
+            elif pattern.startswith('**', position):
+                regex += '.*'
+                position += 2
+            elif pattern[position] == '*':
+                regex += '[^/]*'
+                position += 1
+            elif pattern[position] == '?':
+                regex += '[^/]'
+                position += 1
+            elif pattern[position] == '[' and ']' in pattern[position + 2:]:
+                # a set of characters, ! negates it like ^
+                end = pattern.index(']', position + 2)
+                chars = pattern[position + 1:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += f'[{chars}]'
+                position = end + 1
+            else:
+                regex += re.escape(pattern[position])
+                position += 1
+        return regex, dirs_only
+
+    def matches(self, rel_path: str, is_dir: bool) -> bool:
+        """checks if an object is ignored
+
+        Args:
+            rel_path (str): path relative to the syncing folder
+            is_dir (bool): if the object is a directory
+        """
+        regex = self._dirs if is_dir else self._files
+        return regex is not None and regex.fullmatch(rel_path.replace(os_sep, '/')) is not None
+
 class OneLocalTier:
     """this class is meant to store lists of filenames and
     directory names in some direcorty and parents as a relative path
@@ -161,7 +460,9 @@ class OneLocalTier:
     def __init__(self, parents: str='') -> None:
         """files and dirs are initialized as empty lists, so
         elements can be added there in a loop. tier is the amount
-        of parents, i.e. the amount of directories in relative path
+        of parents, i.e. the amount of directories in relative path.
+        Local files are tuples (name, mtime, md5), md5 is None
+        unless it's counted
 
         Args:
             parents (str, optional): relative path to a file or directory
@@ -187,7 +488,9 @@ class OneGDriveTier(OneLocalTier):
         Takes two more parameters:
 
         "gparent" for gdrive items only, because they have relative path which is
-        for a user and parent folder id, which is for API requests
+        for a user and parent folder id, which is for API requests.
+        Files are tuples (name, id, mtime, size, md5), size and md5
+        are None for google docs
 
         Args:
             gparent (str|None, optional): tier parent folder id
@@ -195,6 +498,1359 @@ class OneGDriveTier(OneLocalTier):
         super().__init__(parents)
         self.gparent = gparent
 
+class TransferErrors(Exception):
+    """raised when some transfers of a pool have failed. Keeps
+    all the failures, so none of them is lost behind the first one
+    """
+    def __init__(self, errors: list[tuple[str, Exception]]) -> None:
+        self.errors = errors
+        super().__init__(f'{len(errors)} transfer(s) failed, the first one - '
+                         f'{errors[0][0]}: {errors[0][1]}')
+
+class TransferPool:
+    """runs uploads, updates and downloads in a pool of worker threads,
+    so many small files don't wait for each other's round-trips. Errors
+    are collected and raised all together by wait(), after all the
+    submitted transfers are over. With max_workers=1 transfers are made
+    right away in the calling thread, just like before
+    """
+    def __init__(self, max_workers: int=1) -> None:
+        self.max_workers = max_workers
+        # created on the first submit, so an idle pool costs nothing
+        self._executor = None
+        self._futures = []
+
+    def submit(self, description: str, func, *args, **kwargs) -> None:
+        """schedules func(*args, **kwargs) for the execution
+
+        Args:
+            description (str): what the transfer does. For error reports
+            func (Callable): the transfer itself
+        """
+        if self.max_workers <= 1:
+            func(*args, **kwargs)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='transfer')
+        future = self._executor.submit(func, *args, **kwargs)
+        self._futures.append((description, future))
+
+    def map(self, func, items: list) -> list:
+        """runs func for every item using the pool threads and returns
+        results in the same order. Unlike submit, waits for the results
+        and raises the first error right away. Meant for requests which
+        are needed before going on, like listing folders
+
+        Args:
+            func (Callable): a function of one argument
+            items (list): arguments
+
+        Returns:
+            list: results of func for every item
+        """
+        if self.max_workers <= 1 or len(items) < 2:
+            return [func(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='transfer')
+        return list(self._executor.map(func, items))
+
+    def map_unordered(self, func, items: list):
+        """like map, but yields (number of the item, result) as soon
+        as any result is ready, so the caller can go on with it while
+        others are still running. Raises the first error it meets
+
+        Args:
+            func (Callable): a function of one argument
+            items (list): arguments
+        """
+        if self.max_workers <= 1 or len(items) < 2:
+            for number, item in enumerate(items):
+                yield number, func(item)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='transfer')
+        futures = {self._executor.submit(func, item): number for number, item in enumerate(items)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # the caller stopped or an error happened, don't start the rest
+            for future in futures:
+                future.cancel()
+
+    def wait(self, raise_errors: bool=True) -> None:
+        """blocks until all submitted transfers are over. Logs every
+        failed one, then raises a network error if there is any among
+        them, so the caller can retry the sync, or TransferErrors otherwise
+
+        Args:
+            raise_errors (bool, optional): if False errors are only
+                        logged. For the case when the caller already
+                        has an exception to raise
+        """
+        errors = []
+        for description, future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f'Transfer failed: {description} - {str(e)}')
+                errors.append((description, e))
+        self._futures.clear()
+        if not errors or not raise_errors:
+            return
+        for _, e in errors:
+            if isinstance(e, NETWORK_ERRORS):
+                raise e
+        raise TransferErrors(errors)
+
+    def close(self) -> None:
+        """stops worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+class RequestGate:
+    """shared by all threads, which talk to gdrive. Spreads requests
+    in time by a token bucket, so they don't exceed the gdrive quota,
+    and limits how many of them are in flight at once. The limit adapts
+    AIMD-style: it's halved when gdrive asks to slow down and grows back
+    by one for every 'limit' successful requests. Throttled requests
+    are repeated by GatedHttp after an exponential backoff with jitter
+    """
+    def __init__(self, max_concurrency: int=1, rate: float=GDRIVE_QUERIES_PER_SECOND) -> None:
+        """
+        Args:
+            max_concurrency (int, optional): requests in flight at most
+            rate (float, optional): queries per second on average
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.rate = rate
+        # the bucket holds a second of queries
+        self._tokens = rate
+        self._refilled = monotonic()
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = Condition()
+
+    def acquire(self, cost: int=1) -> None:
+        """Waits for a free slot and enough tokens
+
+        Args:
+            cost (int, optional): queries the request counts for,
+                        a batch counts for every request inside
+        """
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+            while True:
+                now = monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                # a batch bigger than the bucket goes with a full one and
+                # leaves a debt for the following requests
+                if self._tokens >= min(cost, self.rate):
+                    self._tokens -= cost
+                    return
+                self._cond.wait((min(cost, self.rate) - self._tokens) / self.rate)
+
+    def release(self, throttled: bool=False) -> None:
+        """frees the slot, taken by acquire, and adapts the limit"""
+        with self._cond:
+            self._in_flight -= 1
+            self.adapt(throttled)
+            self._cond.notify_all()
+
+    def adapt(self, throttled: bool) -> None:
+        """Halves the limit of requests in flight, if gdrive asked
+        to slow down, otherwise grows it a bit
+
+        Args:
+            throttled (bool): the last answer was 'too many requests'
+        """
+        with self._cond:
+            if not throttled:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                return
+            now = monotonic()
+            # requests, sent together, are throttled together. That's one signal
+            if now - self._last_decrease > 1:
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = now
+                logger.info(f'(gdrive) asked to slow down, {int(self.limit)} request(s) at once now')
+
+    @staticmethod
+    def retryable(status: int, content: bytes|str|None, idempotent: bool=True) -> bool:
+        """Tells if a request failed because of the load and is worth
+        repeating: 429, 5xx and 403 with the rate limit reasons. Gdrive
+        may make an object and still answer 5xx, so a request, which
+        makes objects, isn't repeated after 5xx, a duplicate would appear
+
+        Args:
+            status (int): http status
+            content (bytes | str | None): the response body
+            idempotent (bool, optional): the request may be sent twice,
+                        every one except POST
+
+        Returns:
+            bool: True to repeat
+        """
+        if status == 429 or (status >= 500 and idempotent):
+            return True
+        if status != 403 or not content:
+            return False
+        try:
+            error = json.loads(content).get('error', {})
+        except (ValueError, AttributeError):
+            return False
+        reasons = {item.get('reason') for item in error.get('errors', []) if isinstance(item, dict)}
+        return bool(reasons & {'rateLimitExceeded', 'userRateLimitExceeded'})
+
+    @staticmethod
+    def backoff(attempt: int, retry_after: str|None=None) -> float:
+        """Seconds to wait before the next attempt. Random, so
+        throttled threads don't come back all at once
+
+        Args:
+            attempt (int): attempts made, starting from 0
+            retry_after (str | None, optional): the Retry-After header
+
+        Returns:
+            float: delay in seconds
+        """
+        delay = uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+
+class GatedHttp:
+    """wraps the authorized http object of a service, so every request,
+    including batches and media chunks, goes through the RequestGate
+    and is repeated when gdrive asks to slow down. Every attempt is
+    counted by Metrics. Anything else is taken from the wrapped object
+    """
+    def __init__(self, http, gate: RequestGate, metrics: 'Metrics') -> None:
+        self._http = http
+        self._gate = gate
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        return getattr(self._http, name)
+
+    def request(self, uri: str, method: str='GET', body=None, headers=None, *args, **kwargs):
+        cost = 1
+        # gdrive counts every request of a batch
+        if '/batch/' in uri and body:
+            cost = max(1, body.count('Content-ID:' if isinstance(body, str) else b'Content-ID:'))
+        # chunks of resumable uploads come as stream slices, which can be
+        # read only once and have no length. A chunk is read here, so
+        # it's measured and can be sent again
+        if hasattr(body, 'read'):
+            body = body.read()
+        kind = Metrics.request_kind(uri, method)
+        # a POST makes an object, like a folder, a file or an upload
+        # session. A batch is such, if any request inside is a POST
+        if '/batch/' in uri and body:
+            idempotent = not re.search('^POST ' if isinstance(body, str) else b'^POST ', body, re.M)
+        else:
+            idempotent = method != 'POST'
+        attempt = 0
+        while True:
+            self._gate.acquire(cost)
+            throttled = False
+            try:
+                started = perf_counter()
+                response, content = self._http.request(uri, method, body, headers, *args, **kwargs)
+                self._metrics.record(kind, perf_counter() - started, len(body or ''), len(content or ''))
+                throttled = RequestGate.retryable(response.status, content)
+            finally:
+                self._gate.release(throttled)
+            if not RequestGate.retryable(response.status, content, idempotent) or attempt >= RETRY_ATTEMPTS:
+                return response, content
+            delay = RequestGate.backoff(attempt, response.get('retry-after'))
+            logger.info(f'(gdrive) {response.status} on {method} request, repeating in {delay:.1f} s')
+            self._metrics.retried(kind)
+            attempt += 1
+            sleep(delay)
+
+class Metrics:
+    """counts gdrive requests by their kinds: how many, how long they
+    took (a histogram of latencies), bytes sent and received and how
+    many were repeated. Also times phases of a sync. Safe to use from
+    several threads
+    """
+    def __init__(self) -> None:
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        """starts counting a new run from scratch"""
+        with self._lock:
+            self.started = time()
+            # by kinds, see request_kind
+            self.requests = {}
+            # seconds by phase names
+            self.phases = {}
+            # start times of running phases
+            self._running = {}
+
+    @staticmethod
+    def request_kind(uri: str, method: str) -> str:
+        """Tells the kind of a gdrive request by it's url and http method:
+        list, get, create, update, delete, download, upload, changes, batch
+
+        Args:
+            uri (str): the request url
+            method (str): http method
+
+        Returns:
+            str: the kind
+        """
+        parts = urlsplit(uri)
+        if '/batch/' in parts.path:
+            return 'batch'
+        if '/changes' in parts.path:
+            return 'changes'
+        # media of creates and updates, resumable sessions and their chunks
+        if '/upload/' in parts.path:
+            return 'upload'
+        if 'alt=media' in parts.query:
+            return 'download'
+        if method == 'DELETE':
+            return 'delete'
+        if method == 'POST':
+            return 'create'
+        if method == 'PATCH':
+            return 'update'
+        if parts.path.rstrip('/').endswith('/files'):
+            return 'list'
+        return 'get'
+
+    def _kind(self, kind: str) -> dict:
+        return self.requests.setdefault(kind, {
+            'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'sent': 0, 'received': 0, 'retries': 0,
+            'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+        })
+
+    def record(self, kind: str, seconds: float, sent: int, received: int) -> None:
+        """Counts one made request
+
+        Args:
+            kind (str): see request_kind
+            seconds (float): how long it took
+            sent (int): bytes of the body sent
+            received (int): bytes of the body received
+        """
+        with self._lock:
+            item = self._kind(kind)
+            item['count'] += 1
+            item['seconds'] += seconds
+            item['max_seconds'] = max(item['max_seconds'], seconds)
+            item['sent'] += sent
+            item['received'] += received
+            # the last bucket is for anything longer than the last bound
+            item['histogram'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def retried(self, kind: str, number: int=1) -> None:
+        """counts repeated requests of a kind"""
+        with self._lock:
+            self._kind(kind)['retries'] += number
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def start(self, phase: str) -> None:
+        """starts timing a phase, till stop() is called"""
+        with self._lock:
+            self._running[phase] = perf_counter()
+
+    def stop(self, phase: str) -> None:
+        with self._lock:
+            started = self._running.pop(phase, None)
+            if started is not None:
+                self.add_time(phase, perf_counter() - started)
+
+    @contextmanager
+    def phase(self, phase: str):
+        """times a phase, which is a block of code"""
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop(phase)
+
+    def to_dict(self, title: str) -> dict:
+        with self._lock:
+            return {
+                'run': title,
+                'started': self.started,
+                'seconds': time() - self.started,
+                'phases': dict(self.phases),
+                'latency_buckets': list(LATENCY_BUCKETS),
+                'requests': {kind: dict(item, histogram=list(item['histogram'])) for kind, item in self.requests.items()}
+            }
+
+    def summary(self, title: str) -> str:
+        """Makes a human readable report of the run
+
+        Args:
+            title (str): what was run, like sync or partial update
+
+        Returns:
+            str: several lines of the report
+        """
+        report = self.to_dict(title)
+        lines = [f'{title.capitalize()} took {report["seconds"]:.1f} s' + ''.join(
+            f', {phase} {seconds:.1f} s' for phase, seconds in report['phases'].items()
+        )]
+        total = {'count': 0, 'retries': 0, 'sent': 0, 'received': 0}
+        for kind, item in sorted(report['requests'].items()):
+            for key in total:
+                total[key] += item[key]
+            lines.append(
+                f'  {kind}: {item["count"]} request(s), {item["retries"]} repeated, '
+                f'avg {item["seconds"] / max(1, item["count"]):.2f} s, max {item["max_seconds"]:.2f} s, '
+                f'{item["sent"] / 1024 / 1024:.1f} MB sent, {item["received"] / 1024 / 1024:.1f} MB received'
+            )
+        lines.insert(1, f'(gdrive) {total["count"]} request(s), {total["retries"]} repeated, '
+                        f'{total["sent"] / 1024 / 1024:.1f} MB sent, {total["received"] / 1024 / 1024:.1f} MB received')
+        return '\n'.join(lines)
+
+    def startup(self) -> None:
+        """counts the time since the process started as the phase
+        'startup'. Only the first run of a process gets it"""
+        global STARTED
+        with self._lock:
+            if STARTED is not None:
+                self.phases['startup'] = perf_counter() - STARTED
+                STARTED = None
+
+    def dump(self, metrics_file: str, title: str) -> None:
+        """appends the run to a file of json lines, one line a run"""
+        with open(metrics_file, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(self.to_dict(title)) + '\n')
+
+class TrafficRecorder:
+    """writes every gdrive request and it's response to a gzipped file
+    of json lines, which TrafficReplayer serves later instead of gdrive.
+    Gdrive ids and page tokens are replaced by made up ones, the same
+    real id always gets the same made up one. The access token isn't
+    written, contents of files too, only their length. Names of files
+    are kept, a replayed sync has to find the same local files. Safe
+    to use from several threads, every thread's http object is wrapped
+    by it's own RecordingHttp. The file is open till close()
+    """
+    # json keys, which values are gdrive ids or tokens
+    ID_KEYS = re.compile(r'"(?:id|fileId|driveId|nextPageToken|newStartPageToken|startPageToken)"\s*:\s*"([^"]+)"')
+    PARENTS = re.compile(r'"parents"\s*:\s*\[([^\]]*)\]')
+    # url parameters, which values are gdrive ids or tokens
+    ID_PARAMS = ('pageToken', 'addParents', 'removeParents', 'upload_id', 'fileId')
+    # ids and tokens are looked for among runs of these characters
+    ID_CHARS = re.compile(r'[\w\-~!]+')
+    # response headers needed to replay a response
+    HEADERS = ('content-type', 'content-length', 'content-range', 'range', 'location', 'retry-after')
+    # the format of the file, written to it's first line
+    VERSION = 1
+
+    def __init__(self, record_file: str) -> None:
+        self.record_file = record_file
+        self._lock = RLock()
+        # made up ids by real ones
+        self._ids = {}
+        # real ids with characters outside of ID_CHARS, they are
+        # replaced one by one
+        self._odd_ids = []
+        # a new recording replaces the old one
+        self._file = gzip.open(record_file, 'wt', encoding='utf-8')
+        self._file.write(json.dumps({'version': self.VERSION, 'recorded': time()}) + '\n')
+
+    @staticmethod
+    def target(uri: str) -> str:
+        """the path and the query of an url, decoded, so ids and tokens
+        look the same everywhere"""
+        parts = urlsplit(uri)
+        return unquote_plus(parts.path + (f'?{parts.query}' if parts.query else ''))
+
+    @staticmethod
+    def request_key(body, content_type: str) -> str:
+        """Tells apart requests with the same method and url by their
+        metadata. A batch is told by requests in it
+
+        Args:
+            body (str | bytes | None): the request body
+            content_type (str): the request content type
+
+        Returns:
+            str: request lines and json metadata, empty for the rest
+        """
+        if not body or not any(kind in content_type for kind in ('json', 'multipart')):
+            return ''
+        # media of a multipart upload follows the metadata, it isn't needed
+        if 'multipart/related' in content_type:
+            body = body[:64 * 1024]
+        text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+        if 'json' in content_type:
+            return text
+        if 'multipart/related' in content_type:
+            match = re.search(r'^\{.*\}\r?$', text, re.M)
+            return match.group(0).rstrip('\r') if match else ''
+        items = re.findall(r'^(?:(?:GET|POST|PUT|PATCH|DELETE) \S+|\{.*\})\r?$', text, re.M)
+        return '\n'.join(item.rstrip('\r') if item.startswith('{') else unquote_plus(item.rstrip('\r')) for item in items)
+
+    def _learn_uri(self, uri: str) -> None:
+        """remembers ids and tokens found in an url"""
+        parts = urlsplit(uri)
+        found = [unquote(item) for item in re.findall(r'/files/([^/?]+)', parts.path)]
+        query = parse_qs(parts.query)
+        for name in self.ID_PARAMS:
+            for value in query.get(name, []):
+                found += value.split(',')
+        for value in query.get('q', []):
+            found += re.findall(r"'([^']+)' in parents", value)
+        self._add_ids(found)
+
+    def _learn_text(self, text: str) -> None:
+        """remembers ids and tokens found in json or a batch"""
+        found = self.ID_KEYS.findall(text)
+        for parents in self.PARENTS.findall(text):
+            found += re.findall(r'"([^"]+)"', parents)
+        for uri in re.findall(r'^(?:GET|POST|PUT|PATCH|DELETE) (\S+)', text, re.M):
+            self._learn_uri(uri)
+        self._add_ids(found)
+
+    def _add_ids(self, found: list[str]) -> None:
+        for value in found:
+            if value in self._ids or value in ('root', 'startPageToken'):
+                continue
+            self._ids[value] = f'anon{len(self._ids) + 1:06d}'
+            if not self.ID_CHARS.fullmatch(value):
+                self._odd_ids.append(value)
+
+    def _anonymize(self, text: str) -> str:
+        text = self.ID_CHARS.sub(lambda match: self._ids.get(match.group(0), match.group(0)), text)
+        for value in self._odd_ids:
+            text = text.replace(value, self._ids[value])
+        return text
+
+    def add(self, uri: str, method: str, body, headers: dict|None, response, content: bytes, seconds: float) -> None:
+        """Writes a request and it's response
+
+        Args:
+            uri (str): the request url
+            method (str): http method
+            body (str | bytes | None): the request body
+            headers (dict | None): the request headers
+            response (httplib2.Response): the response headers
+            content (bytes): the response body
+            seconds (float): how long the request took
+        """
+        content_type = {key.lower(): value for key, value in (headers or {}).items()}.get('content-type', '')
+        key = self.request_key(body, content_type)
+        # contents of downloaded files aren't written, errors are
+        media = 'alt=media' in uri and response.status in (200, 206)
+        text = '' if media else (content or b'').decode('utf-8', 'replace')
+        with self._lock:
+            self._learn_uri(uri)
+            self._learn_text(key)
+            self._learn_text(text)
+            if 'location' in response:
+                self._learn_uri(response['location'])
+            record = {
+                'm': method,
+                'u': self._anonymize(self.target(uri)),
+                's': response.status,
+                'h': {name: self._anonymize(response[name]) for name in self.HEADERS if name in response},
+                't': round(seconds, 4)
+            }
+            if key:
+                record['k'] = self._anonymize(key)
+            if media:
+                record['n'] = len(content or b'')
+            else:
+                record['c'] = self._anonymize(text)
+            # a transfer thread may outlive the run
+            if not self._file.closed:
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        """finishes the file, requests made later aren't written"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+class RecordingHttp:
+    """wraps the authorized http object of a service, so every request
+    is written by TrafficRecorder. Anything else is taken from the
+    wrapped object
+    """
+    def __init__(self, http, recorder: TrafficRecorder) -> None:
+        self._http = http
+        self._recorder = recorder
+
+    def __getattr__(self, name: str):
+        return getattr(self._http, name)
+
+    def request(self, uri: str, method: str='GET', body=None, headers=None, *args, **kwargs):
+        started = perf_counter()
+        response, content = self._http.request(uri, method, body, headers, *args, **kwargs)
+        self._recorder.add(uri, method, body, headers, response, content, perf_counter() - started)
+        return response, content
+
+class TrafficReplayer:
+    """serves gdrive requests from a file written by TrafficRecorder,
+    so a recorded sync runs again offline. Takes the place of the
+    authorized http object of every service. A request gets the first
+    not served response, recorded for the same method, url and metadata,
+    or if there is none, for the same method and url. It comes after
+    the time the recorded request took, divided by speed, 0 means at
+    once. Downloaded files are zeros of the recorded length. Safe to use
+    from several threads
+    """
+    def __init__(self, record_file: str, speed: float=1.0) -> None:
+        self.speed = speed
+        self._lock = RLock()
+        # records by method and url and by method, url and request key
+        # in the recorded order. A served record is marked and skipped
+        self._by_url = {}
+        self._by_key = {}
+        with gzip.open(record_file, 'rt', encoding='utf-8') as file:
+            header = json.loads(file.readline() or '{}')
+            if header.get('version') != TrafficRecorder.VERSION:
+                raise ValueError(f'{record_file} is not a gdrive recording or has another version')
+            for line in file:
+                record = json.loads(line)
+                self._by_url.setdefault((record['m'], record['u']), deque()).append(record)
+                self._by_key.setdefault((record['m'], record['u'], record.get('k', '')), deque()).append(record)
+
+    @staticmethod
+    def _first(records: deque|None) -> dict|None:
+        """takes the first not served record"""
+        while records:
+            record = records.popleft()
+            if not record.get('served'):
+                record['served'] = True
+                return record
+        return None
+
+    def request(self, uri: str, method: str='GET', body=None, headers=None, *args, **kwargs):
+        target = TrafficRecorder.target(uri)
+        content_type = {key.lower(): value for key, value in (headers or {}).items()}.get('content-type', '')
+        key = TrafficRecorder.request_key(body, content_type)
+        with self._lock:
+            record = self._first(self._by_key.get((method, target, key))) or self._first(self._by_url.get((method, target)))
+        if record is None:
+            raise LookupError(f'{method} {target} is not in the recording, the replayed sync went another way')
+        if self.speed:
+            sleep(record['t'] / self.speed)
+        content = b'\0' * record['n'] if 'n' in record else record['c'].encode('utf-8')
+        return Response({'status': str(record['s']), **record['h']}), content
+
+class SyncState:
+    """sqlite database, which remembers every file and directory as it
+    was after it's last successful sync: gdrive id, size, mtime and md5.
+    Lets to tell a deletion on one side from a new object on the other,
+    which can't be done by comparing two sides only. One database can
+    serve several synced pairs of directories, they are told apart
+    by the 'root' column. Safe to use from several threads
+    """
+    def __init__(self, db_file: str, local_folder: str, gdrive_folder: str) -> None:
+        """
+        Args:
+            db_file (str): path to the database file. Created if absent
+            local_folder (str): synced local directory
+            gdrive_folder (str): synced gdrive directory path
+        """
+        self.root = f'{path.abspath(local_folder)}|{gdrive_folder}'
+        self._lock = RLock()
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS entries (
+                    root TEXT, rel_path TEXT, is_dir INTEGER, g_id TEXT,
+                    size INTEGER, mtime INTEGER, md5 TEXT, run INTEGER,
+                    PRIMARY KEY (root, rel_path)
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    root TEXT, key TEXT, value TEXT,
+                    PRIMARY KEY (root, key)
+                );
+                CREATE TABLE IF NOT EXISTS plan (
+                    root TEXT, seq INTEGER, op TEXT, done INTEGER, result TEXT,
+                    PRIMARY KEY (root, seq)
+                );
+                CREATE TABLE IF NOT EXISTS hashes (
+                    root TEXT, rel_path TEXT, inode INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT,
+                    PRIMARY KEY (root, rel_path)
+                );
+                CREATE TABLE IF NOT EXISTS transfers (
+                    root TEXT, rel_path TEXT, kind TEXT, g_id TEXT,
+                    size INTEGER, mtime INTEGER, session_uri TEXT, offset INTEGER,
+                    PRIMARY KEY (root, rel_path, kind)
+                );
+                CREATE TABLE IF NOT EXISTS dir_ids (
+                    path TEXT PRIMARY KEY, g_id TEXT
+                );
+            """)
+        # every full sync has a number. Rows, which weren't met by
+        # the last one, describe objects which are gone on both sides
+        self.run = int(self.get_meta('run') or 0)
+
+    def begin_run(self, gdrive_folder_id: str) -> None:
+        """starts a new full sync
+
+        Args:
+            gdrive_folder_id (str): id of the synced gdrive directory.
+                        If it isn't the one remembered, the gdrive directory
+                        was recreated or replaced, and everything known
+                        about it is wrong
+        """
+        with self._lock:
+            if self.get_meta('root_id') not in (None, gdrive_folder_id):
+                logger.info('The gdrive directory was replaced since the last sync, forgetting the sync state')
+                self._db.execute('DELETE FROM entries WHERE root = ?', (self.root,))
+                self._db.execute("DELETE FROM meta WHERE root = ? AND key = 'page_token'", (self.root,))
+            self.set_meta('root_id', gdrive_folder_id)
+            self.run += 1
+            self.set_meta('run', str(self.run))
+
+    def get(self, rel_path: str) -> sqlite3.Row|None:
+        """returns what is known about an object or None"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM entries WHERE root = ? AND rel_path = ?', (self.root, rel_path)
+            ).fetchone()
+
+    def entries(self) -> list[sqlite3.Row]:
+        """returns everything known about the synced directories"""
+        with self._lock:
+            return self._db.execute('SELECT * FROM entries WHERE root = ?', (self.root,)).fetchall()
+
+    def unchanged_file(self, rel_path: str, mtime: int, g_id: str|None=None) -> bool:
+        """True if the file is known and wasn't modified since the last sync.
+        For gdrive files pass g_id, so a new file with the same name
+        isn't taken for the old one
+        """
+        row = self.get(rel_path)
+        return (row is not None and not row['is_dir'] and row['mtime'] == mtime
+                and (g_id is None or row['g_id'] == g_id))
+
+    def known_dir(self, rel_path: str, g_id: str|None=None) -> bool:
+        """True if the directory was synced before"""
+        row = self.get(rel_path)
+        return row is not None and bool(row['is_dir']) and (g_id is None or row['g_id'] == g_id)
+
+    def put(self, rel_path: str, is_dir: bool, g_id: str, mtime: int=0, size: int|None=None, md5: str|None=None) -> None:
+        """remembers a synced object"""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.root, rel_path, int(is_dir), g_id, size, mtime, md5, self.run)
+            )
+
+    def remove(self, rel_path: str) -> None:
+        """forgets an object. For a directory - with all it's contents"""
+        # LIKE would be case insensitive, so compare prefixes as they are
+        prefix = path.join(rel_path, '')
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM entries WHERE root = ? AND (rel_path = ? OR substr(rel_path, 1, ?) = ?)',
+                (self.root, rel_path, len(prefix), prefix)
+            )
+
+    def prune(self) -> None:
+        """forgets objects which weren't met during the current sync,
+        and md5 of local files which aren't synced anymore"""
+        with self._lock:
+            self._db.execute('DELETE FROM entries WHERE root = ? AND run != ?', (self.root, self.run))
+            self._db.execute(
+                'DELETE FROM hashes WHERE root = ? AND rel_path NOT IN (SELECT rel_path FROM entries WHERE root = ?)',
+                (self.root, self.root)
+            )
+
+    def get_hash(self, rel_path: str, file_stat: stat_result) -> str|None:
+        """returns remembered md5 of a local file, if the file wasn't
+        changed since, i.e. has the same inode, size and mtime
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT md5 FROM hashes WHERE root = ? AND rel_path = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                (self.root, rel_path, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+            ).fetchone()
+        return row['md5'] if row else None
+
+    def put_hash(self, rel_path: str, file_stat: stat_result, md5: str) -> None:
+        """remembers md5 of a local file"""
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                (self.root, rel_path, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, md5)
+            )
+
+    def get_transfer(self, rel_path: str, kind: Literal['upload', 'download']) -> sqlite3.Row|None:
+        """returns the journal record of an unfinished transfer or None"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT * FROM transfers WHERE root = ? AND rel_path = ? AND kind = ?', (self.root, rel_path, kind)
+            ).fetchone()
+
+    def put_transfer(
+            self,
+            rel_path: str,
+            kind: Literal['upload', 'download'],
+            g_id: str,
+            size: int|None,
+            mtime: int,
+            session_uri: str|None=None,
+            offset: int=0
+        ) -> None:
+        """journals the progress of a transfer. Committed at once, so
+        it survives even if the process is killed
+
+        Args:
+            rel_path (str): local path of the file
+            kind (Literal['upload', 'download']): the transfer direction
+            g_id (str): gdrive id of the file, or of the parent folder
+                        for an upload of a new file
+            size (int | None): the file size
+            mtime (int): modification time of the transferred version
+            session_uri (str | None, optional): resumable upload session
+            offset (int, optional): bytes transferred so far
+        """
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.root, rel_path, kind, g_id, size, mtime, session_uri, offset)
+            )
+            self._db.commit()
+
+    def drop_transfer(self, rel_path: str, kind: Literal['upload', 'download']) -> None:
+        """forgets a finished or hopeless transfer"""
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM transfers WHERE root = ? AND rel_path = ? AND kind = ?', (self.root, rel_path, kind)
+            )
+
+    def add_plan(self, ops: list[dict], first_seq: int, plan_meta: dict|None=None) -> None:
+        """stores next operations of a sync plan, see GdriveSync._flush_plan.
+        Commits everything, as the plan relies on the state it was made with
+
+        Args:
+            ops (list[dict]): operations, must be json serializable
+            first_seq (int): number of the first one in the plan
+            plan_meta (dict | None, optional): what else is needed to
+                        continue the plan. Given, when the plan is complete.
+                        Till then it isn't continued by the next try
+        """
+        with self._lock:
+            self._db.executemany(
+                'INSERT INTO plan VALUES (?, ?, ?, 0, NULL)',
+                [(self.root, seq, json.dumps(op)) for seq, op in enumerate(ops, first_seq)]
+            )
+            if plan_meta is not None:
+                self.set_meta('plan', json.dumps(plan_meta))
+            self._db.commit()
+
+    def get_plan(self) -> list[tuple[int, dict, bool, str|None]]:
+        """returns operations of the stored plan in their order:
+        (seq, operation, if it's done, it's result)
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM plan WHERE root = ? ORDER BY seq', (self.root,)).fetchall()
+        return [(row['seq'], json.loads(row['op']), bool(row['done']), row['result']) for row in rows]
+
+    def finish_op(self, seq: int, result: str|None=None) -> None:
+        """journals a done operation of the plan at once"""
+        with self._lock:
+            self._db.execute('UPDATE plan SET done = 1, result = ? WHERE root = ? AND seq = ?', (result, self.root, seq))
+            self._db.commit()
+
+    def drop_plan(self) -> None:
+        """forgets the plan, when it's completed or outdated"""
+        with self._lock:
+            self._db.execute('DELETE FROM plan WHERE root = ?', (self.root,))
+            self._db.execute("DELETE FROM meta WHERE root = ? AND key = 'plan'", (self.root,))
+
+    # gdrive paths are the same for all synced pairs, so dir ids aren't
+    # split by roots. A directory and everything inside it make a range
+    # of the primary key: path, then paths from 'path/' to 'path0'
+    @staticmethod
+    def _subtree(gdrive_path: str) -> tuple[str, str, str]:
+        """arguments for 'path = ? OR (path >= ? AND path < ?)'"""
+        return (gdrive_path, gdrive_path + os_sep, gdrive_path + chr(ord(os_sep) + 1))
+
+    def get_dir_ids(self, gdrive_path: str) -> dict[str, str]:
+        """Remembered ids of a gdrive directory, everything inside it
+        and it's parents
+
+        Args:
+            gdrive_path (str): the directory path
+
+        Returns:
+            dict[str, str]: gdrive ids by paths
+        """
+        parents = []
+        parent = path.dirname(gdrive_path)
+        while parent:
+            parents.append(parent)
+            parent = path.dirname(parent)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT path, g_id FROM dir_ids WHERE path = ? OR (path >= ? AND path < ?) '
+                f'OR path IN ({", ".join("?" * len(parents))})',
+                self._subtree(gdrive_path) + tuple(parents)
+            ).fetchall()
+        return {row['path']: row['g_id'] for row in rows}
+
+    def put_dir_ids(self, dir_ids: dict[str, str]) -> None:
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO dir_ids VALUES (?, ?)', dir_ids.items())
+
+    def drop_dir_ids(self, gdrive_path: str) -> None:
+        """forgets a gdrive directory and everything inside it"""
+        with self._lock:
+            self._db.execute('DELETE FROM dir_ids WHERE path = ? OR (path >= ? AND path < ?)', self._subtree(gdrive_path))
+
+    def get_meta(self, key: str) -> str|None:
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE root = ? AND key = ?', (self.root, key)).fetchone()
+        return row['value'] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)', (self.root, key, value))
+
+    def commit(self) -> None:
+        with self._lock:
+            self._db.commit()
+
+class InotifyWatcher:
+    """watches a local directory tree with inotify, linux only. Every
+    directory gets it's own watch, new directories are watched as they
+    appear. Talks to libc via ctypes, so needs no extra modules.
+    read() returns events as tuples:
+    ('created', rel_path, is_dir), ('modified', rel_path),
+    ('deleted', rel_path, is_dir), ('moved', old_path, new_path, is_dir)
+    and ('overflow',) when the kernel dropped some events
+    """
+    # see man inotify
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    # struct inotify_event without the name: wd, mask, cookie, len
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, root: str, ignored) -> None:
+        """
+        Args:
+            root (str): the directory to watch
+            ignored (callable): takes a relative path and is_dir,
+                        True for objects which aren't watched
+        """
+        self.root = root
+        self.ignored = ignored
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify is unavailable')
+        # watched directories by watch descriptors
+        self._paths = {}
+        # moved_from events waiting for their moved_to pair by cookies
+        self._moved_from = {}
+        try:
+            self._add_tree('', [])
+        except OSError:
+            # likely out of watches, fs.inotify.max_user_watches
+            self.close()
+            raise
+
+    def _skip(self, rel_path: str, is_dir: bool) -> bool:
+        """objects, which aren't synced"""
+        return rel_path.endswith(PART_SUFFIX) or self.ignored(rel_path, is_dir)
+
+    def _add_tree(self, rel_dir: str, events: list[tuple]) -> None:
+        """Watches a directory and all directories inside. Everything
+        found inside is reported as created, as it could appear before
+        the watch was added
+
+        Args:
+            rel_dir (str): the directory path relative to the root
+            events (list[tuple]): found objects are added here
+        """
+        dirs_to_watch = [rel_dir]
+        while dirs_to_watch:
+            current = dirs_to_watch.pop()
+            wd = self._libc.inotify_add_watch(self._fd, fsencode(path.join(self.root, current)), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # the directory is already gone, it's deletion comes later
+                if error == errno.ENOENT:
+                    continue
+                raise OSError(error, f'Cant watch {path.join(self.root, current)}')
+            self._paths[wd] = current
+            try:
+                with scandir(path.join(self.root, current)) as entries:
+                    entries = list(entries)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                rel_path = path.join(current, entry.name)
+                is_dir = entry.is_dir()
+                if self._skip(rel_path, is_dir):
+                    continue
+                events.append(('created', rel_path, is_dir))
+                if is_dir:
+                    dirs_to_watch.append(rel_path)
+
+    def _rename_watches(self, old_dir: str, new_dir: str) -> None:
+        """watches of a moved directory stay, only their paths change"""
+        for wd, rel_path in self._paths.items():
+            if rel_path == old_dir or rel_path.startswith(path.join(old_dir, '')):
+                self._paths[wd] = new_dir + rel_path[len(old_dir):]
+
+    def _forget_watches(self, rel_dir: str) -> None:
+        """stops watching a directory, which has left the tree"""
+        for wd, rel_path in list(self._paths.items()):
+            if rel_path == rel_dir or rel_path.startswith(path.join(rel_dir, '')):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._paths[wd]
+
+    def read(self, timeout: float) -> list[tuple]:
+        """Waits for events no longer than timeout seconds
+
+        Args:
+            timeout (float): seconds to wait, 0 to take only
+                        what is already there
+
+        Returns:
+            list[tuple]: events, see the class description
+        """
+        events = []
+        # an object, moved out of the tree, has no moved_to pair.
+        # It's pair is looked for till the end of the next read,
+        # then the object counts deleted
+        waiting = self._moved_from
+        self._moved_from = {}
+        readable, _, _ = select([self._fd], [], [], timeout)
+        data = b''
+        if readable:
+            try:
+                data = os_read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                pass
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append(('overflow',))
+                continue
+            # the watch is removed, the directory is deleted
+            if mask & self.IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            parent = self._paths.get(wd)
+            if parent is None or not name:
+                continue
+            rel_path = path.join(parent, fsdecode(name))
+            is_dir = bool(mask & self.IN_ISDIR)
+            # a move between ignored and watched objects turns
+            # into a creation or a deletion without the pair
+            if self._skip(rel_path, is_dir):
+                continue
+            if mask & self.IN_CREATE:
+                events.append(('created', rel_path, is_dir))
+                if is_dir:
+                    self._add_tree(rel_path, events)
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_ATTRIB):
+                if not is_dir:
+                    events.append(('modified', rel_path))
+            elif mask & self.IN_DELETE:
+                events.append(('deleted', rel_path, is_dir))
+            elif mask & self.IN_MOVED_FROM:
+                self._moved_from[cookie] = (rel_path, is_dir)
+            elif mask & self.IN_MOVED_TO:
+                old = self._moved_from.pop(cookie, None) or waiting.pop(cookie, None)
+                # moved in from outside of the tree
+                if old is None:
+                    events.append(('created', rel_path, is_dir))
+                    if is_dir:
+                        self._add_tree(rel_path, events)
+                else:
+                    events.append(('moved', old[0], rel_path, is_dir))
+                    if is_dir:
+                        self._rename_watches(old[0], rel_path)
+        for old_path, is_dir in waiting.values():
+            events.append(('deleted', old_path, is_dir))
+            if is_dir:
+                self._forget_watches(old_path)
+        return events
+
+    def close(self) -> None:
+        os_close(self._fd)
+
+class PollingWatcher:
+    """watches a local directory tree by comparing it's snapshots,
+    where inotify is unavailable. Gives the same events as
+    InotifyWatcher, a move is found by the inode number
+    """
+    def __init__(self, root: str, ignored, interval: float=WATCH_POLL_INTERVAL) -> None:
+        """
+        Args:
+            root (str): the directory to watch
+            ignored (callable): takes a relative path and is_dir,
+                        True for objects which aren't watched
+            interval (float, optional): seconds between snapshots
+        """
+        self.root = root
+        self.ignored = ignored
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> dict[str, tuple[bool, int, int, int]]:
+        """Takes a snapshot of the tree
+
+        Returns:
+            dict[str, tuple[bool, int, int, int]]: objects by relative
+                        paths: is_dir, inode, size, mtime in ns
+        """
+        snapshot = {}
+        dirs_to_visit = ['']
+        while dirs_to_visit:
+            current = dirs_to_visit.pop()
+            try:
+                with scandir(path.join(self.root, current)) as entries:
+                    for entry in entries:
+                        if entry.is_symlink():
+                            continue
+                        rel_path = path.join(current, entry.name)
+                        is_dir = entry.is_dir()
+                        if rel_path.endswith(PART_SUFFIX) or self.ignored(rel_path, is_dir):
+                            continue
+                        entry_stat = entry.stat()
+                        snapshot[rel_path] = (is_dir, entry_stat.st_ino, entry_stat.st_size, entry_stat.st_mtime_ns)
+                        if is_dir:
+                            dirs_to_visit.append(rel_path)
+            # removed while being scanned
+            except FileNotFoundError:
+                continue
+        return snapshot
+
+    def read(self, timeout: float) -> list[tuple]:
+        """Compares the tree with it's previous snapshot, the tree is
+        scanned not more often than once in self.interval seconds
+
+        Args:
+            timeout (float): seconds to wait, 0 to compare right away
+
+        Returns:
+            list[tuple]: events, see InotifyWatcher
+        """
+        if timeout:
+            sleep(max(timeout, self.interval))
+        old, new = self._snapshot, self._scan()
+        self._snapshot = new
+        events = []
+        gone = {rel_path: item for rel_path, item in old.items() if rel_path not in new}
+        # the same object under a new path is a move
+        gone_by_inode = {(item[0], item[1]): rel_path for rel_path, item in gone.items()}
+        # new paths of moved dirs by their old paths, everything
+        # inside a moved dir is moved together with it
+        moved_dirs = {}
+        # parents go first
+        for rel_path in sorted((p for p in new if p not in old), key=lambda p: p.count(os_sep)):
+            is_dir = new[rel_path][0]
+            old_path = gone_by_inode.pop((is_dir, new[rel_path][1]), None)
+            if old_path is None:
+                events.append(('created', rel_path, is_dir))
+                continue
+            del gone[old_path]
+            if moved_dirs.get(path.dirname(old_path)) != path.dirname(rel_path) or \
+                path.basename(old_path) != path.basename(rel_path):
+                events.append(('moved', old_path, rel_path, is_dir))
+            if is_dir:
+                moved_dirs[old_path] = rel_path
+            elif new[rel_path][2:] != old[old_path][2:]:
+                events.append(('modified', rel_path))
+        # children go first, as inotify gives them
+        for rel_path in sorted(gone, key=lambda p: p.count(os_sep), reverse=True):
+            events.append(('deleted', rel_path, gone[rel_path][0]))
+        for rel_path, item in new.items():
+            if not item[0] and rel_path in old and item != old[rel_path]:
+                events.append(('modified', rel_path))
+        return events
+
+    def close(self) -> None:
+        pass
+
+def make_watcher(root: str, ignored) -> InotifyWatcher|PollingWatcher:
+    """inotify watcher when possible, the polling one otherwise"""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, ignored)
+        except (OSError, AttributeError) as e:
+            logger.warning(f'inotify is unavailable, polling the local folder instead: {e}')
+    return PollingWatcher(root, ignored)
+
+class ActionsCollector:
+    """coalesces watcher events into actions for
+    GdriveSync.sync_partial. Many events of one object end up as one
+    action or as none, like for a file created and deleted before it
+    was synced. An object moved twice is moved once from where it is
+    on gdrive
+    """
+    def __init__(self) -> None:
+        # pending changes by paths: ('created'|'modified'|'deleted', is_dir)
+        self.changes = {}
+        # moved objects by their new paths: (path on gdrive, is_dir)
+        self.moves = {}
+        # something happened which can't be told by actions
+        self.full_sync = False
+        # when the first of the collected events came
+        self.since = None
+
+    def __bool__(self) -> bool:
+        return bool(self.changes or self.moves or self.full_sync)
+
+    def add(self, event: tuple) -> None:
+        """takes an event from a watcher, see InotifyWatcher"""
+        if self.since is None:
+            self.since = time()
+        kind = event[0]
+        if kind == 'created':
+            self._created(*event[1:])
+        elif kind == 'modified':
+            self.changes.setdefault(event[1], ('modified', False))
+        elif kind == 'deleted':
+            self._deleted(*event[1:])
+        elif kind == 'moved':
+            self._moved(*event[1:])
+        else:
+            self.full_sync = True
+
+    def add_actions(self, actions: dict, local_folder: str) -> None:
+        """Takes actions of GdriveSync.sync_partial as if they were
+        watcher events, in the order sync_partial applies them
+
+        Args:
+            actions (dict): actions, see GdriveSync.sync_partial
+            local_folder (str): the synced folder, tells moved dirs
+                        from moved files
+        """
+        is_dir = lambda rel_path: path.isdir(path.join(local_folder, rel_path))
+        for rel_path in actions.get('create_dir', []):
+            self.add(('created', path.normpath(rel_path), True))
+        for rel_path in actions.get('delete_dir', []):
+            self.add(('deleted', path.normpath(rel_path), True))
+        for rel_path in actions.get('delete_file', []):
+            self.add(('deleted', path.normpath(rel_path), False))
+        for old_path, new_path in actions.get('move', {}).items():
+            self.add(('moved', path.normpath(old_path), path.normpath(new_path), is_dir(new_path)))
+        for rel_path in actions.get('create_file', []):
+            self.add(('created', path.normpath(rel_path), False))
+        for rel_path in actions.get('update_file', []):
+            self.add(('modified', path.normpath(rel_path)))
+        # a new name may come with or without the path
+        for old_path, new_name in actions.get('rename', {}).items():
+            new_path = path.join(path.dirname(path.normpath(old_path)), path.basename(new_name))
+            self.add(('moved', path.normpath(old_path), new_path, is_dir(new_path)))
+
+    @staticmethod
+    def _inside(rel_path: str, rel_dir: str) -> bool:
+        return rel_path.startswith(path.join(rel_dir, ''))
+
+    def _created(self, rel_path: str, is_dir: bool) -> None:
+        previous = self.changes.get(rel_path)
+        if previous is None or previous[0] != 'deleted':
+            self.changes[rel_path] = ('created', is_dir)
+        # a file replaced by a new one is just updated
+        elif not is_dir and not previous[1]:
+            self.changes[rel_path] = ('modified', False)
+        # sync_partial creates dirs before deleting, so a replaced
+        # dir would be lost
+        else:
+            self.full_sync = True
+
+    def _deleted(self, rel_path: str, is_dir: bool) -> None:
+        if is_dir:
+            # what happened inside doesn't matter anymore
+            for key in [key for key in self.changes if self._inside(key, rel_path)]:
+                del self.changes[key]
+            # but objects moved inside are still in their old places on gdrive
+            for key in [key for key in self.moves if self._inside(key, rel_path)]:
+                origin, origin_is_dir = self.moves.pop(key)
+                if not self._inside(origin, rel_path):
+                    self.changes[origin] = ('deleted', origin_is_dir)
+        if rel_path in self.moves:
+            origin, _ = self.moves.pop(rel_path)
+            self.changes.pop(rel_path, None)
+            self.changes[origin] = ('deleted', is_dir)
+        # never got to gdrive
+        elif self.changes.get(rel_path, ('',))[0] == 'created':
+            del self.changes[rel_path]
+        else:
+            self.changes[rel_path] = ('deleted', is_dir)
+
+    def _moved(self, old_path: str, new_path: str, is_dir: bool) -> None:
+        previous = self.changes.pop(old_path, None)
+        if is_dir:
+            for pending in (self.changes, self.moves):
+                for key in [key for key in pending if self._inside(key, old_path)]:
+                    pending[new_path + key[len(old_path):]] = pending.pop(key)
+        # not on gdrive yet, so it's just created by the new path.
+        # Editors save files like this, through a temporary file
+        if previous is not None and previous[0] == 'created':
+            self._created(new_path, is_dir)
+            return
+        origin, _ = self.moves.pop(old_path, (old_path, is_dir))
+        # moved back
+        if origin != new_path:
+            self.moves[new_path] = (origin, is_dir)
+        if previous is not None and previous[0] == 'modified':
+            self.changes[new_path] = previous
+
+    def actions(self) -> dict:
+        """Makes actions for GdriveSync.sync_partial
+
+        Returns:
+            dict: actions, see GdriveSync.sync_partial
+        """
+        names = {
+            ('created', True): 'create_dir',
+            ('created', False): 'create_file',
+            ('modified', False): 'update_file',
+            ('deleted', True): 'delete_dir',
+            ('deleted', False): 'delete_file'
+        }
+        actions = {}
+        for rel_path, change in self.changes.items():
+            actions.setdefault(names[change], []).append(rel_path)
+        for new_path, (origin, is_dir) in self.moves.items():
+            # sync_partial renames after creating and updating files,
+            # so a renamed dir with new files inside or a renamed and
+            # changed file have to be moved, moves go first
+            if not is_dir and new_path not in self.changes and path.dirname(new_path) == path.dirname(origin):
+                actions.setdefault('rename', {})[origin] = new_path
+            else:
+                actions.setdefault('move', {})[origin] = new_path
+        return actions
+
 class GdriveSync:
     def __init__(
         self,
@@ -205,7 +1861,20 @@ class GdriveSync:
         gdrive_folder: str='',
         create_folder: bool=False,
         sync_direction: Literal['local_to_gdrive', 'gdrive_to_local', 'mirror', 'ask']='local_to_gdrive',
-        ignored_objects: list[IgnoreThose]|None = None
+        ignored_objects: list[IgnoreThose]|None = None,
+        ignore_patterns: list[str]|None = None,
+        max_transfers: int=1,
+        state_file: str='sync_state.db',
+        delta: bool=False,
+        simple_upload_threshold: int=SIMPLE_UPLOAD_THRESHOLD,
+        chunk_size: int=UPLOAD_CHUNK_SIZE,
+        download_chunk_size: int=DOWNLOAD_CHUNK_SIZE,
+        hash_local: bool=False,
+        max_walkers: int=1,
+        metrics_file: str|None=None,
+        record_file: str|None=None,
+        replay_file: str|None=None,
+        replay_speed: float=1.0
     ) -> None:
         # don't forget to get the actual path from pyinstalled files
         self.client_secrets_file = resource_path(client_secrets_file, True)
@@ -220,61 +1889,176 @@ class GdriveSync:
         # a flag to create a new folder
         self.create_folder = create_folder
         self.creds = None
+        # httplib2 isn't thread safe, so every thread which talks
+        # to gdrive gets it's own service, see the service property
+        self._thread_data = local()
+        # make_creds may be called by several transfer threads at once
+        self._creds_lock = RLock()
+        # grows every time self.creds is replaced by a new object, so
+        # services built with the old one are rebuilt
+        self._creds_generation = 0
         self.service = None
+        # uploads, updates and downloads are put here during syncing
+        self.transfers = TransferPool(max_transfers)
+        # threads listing gdrive folders during a sync, see _stream_gdrive
+        self.max_listers = max_transfers
+        # every thread's requests go through it, see RequestGate. There
+        # is a slot for every transfer, every lister and the main thread,
+        # so long transfers don't hold the listing back
+        self.gate = RequestGate(max_transfers + self.max_listers + 1)
+        # requests and phases of the current run, see _report
+        self.metrics = Metrics()
+        # the metrics of every run are appended there, if set
+        self.metrics_file = metrics_file
+        # gdrive traffic is written there or served from there instead
+        # of gdrive, see TrafficRecorder and TrafficReplayer
+        self.recorder = TrafficRecorder(record_file) if record_file else None
+        self.replayer = TrafficReplayer(replay_file, replay_speed) if replay_file else None
         # prepare for gdrive folder structure
         self.gdrive_struct = []
         # prepare for local structure
         self.local_struct = []
+        # both structures indexed by relative paths
+        self.gdrive_tiers = {}
+        self.local_tiers = {}
         # store stuff to ignore
-        self.ignored_objects = ignored_objects
+        self.ignored_objects = list(ignored_objects or [])
+        # checked for every object while walking both trees
+        self.ignore_matcher = IgnoreMatcher(self.ignored_objects, ignore_patterns or [])
         self.sync_direction = sync_direction
         # when mirror is set, the whole dir should be restored
-        self.restore_dirs = []
+        self.restore_dirs = set()
+        # operations to perform, made by comparing both sides.
+        # See _execute_ops
+        self.plan = []
+        # how many of them are journaled and performed, see _flush_plan
+        self._flushed = 0
+        # ids of gdrive folders, created by the plan, by their references
+        self._refs = {}
+        # what both sides looked like after the last sync
+        self.state = SyncState(resource_path(state_file, True), self.local_folder, self.gdrive_folder)
+        # take only changes since the last sync from gdrive instead of
+        # listing the whole directory
+        self.delta = delta
+        # a changes page token to be saved after a successful sync
+        self.page_token = None
+        # how files are uploaded, see _make_media
+        self.simple_upload_threshold = simple_upload_threshold
+        # gdrive wants chunks to be multiples of 256 KB
+        self.chunk_size = max(1, chunk_size // (256 * 1024)) * 256 * 1024
+        self.download_chunk_size = download_chunk_size
+        # count md5 of all local files, see _hash_local_files
+        self.hash_local = hash_local
+        # how many local directories are read at once
+        self.max_walkers = max_walkers
+        # remembered gdrive dir ids, which weren't checked by
+        # sync_partial yet, see _verify_dirs
+        self._unverified_dirs = set()
+        # when dirs were checked by this process, by their gdrive paths
+        self._verified_dirs = {}
+        # the local folder's watcher in the watch mode, see watch
+        self._watcher = None
+        # local paths and deleted directory trees, changed by syncs
+        # themselves in the watch mode, see _changed_locally
+        self._own_changes = set()
+        self._own_removed_dirs = set()
+
+    @property
+    def service(self):
+        """gdrive service object of the calling thread"""
+        return getattr(self._thread_data, 'service', None)
+
+    @service.setter
+    def service(self, value) -> None:
+        self._thread_data.service = value
+
+    def close(self) -> None:
+        """Ends the run, the traffic recording is finished"""
+        if self.recorder is not None:
+            self.recorder.close()
 
     def make_creds(self) -> None:
         """Takes care of OAuth2 authentification. Checks the token
         existence and it's validity, because the autch token expires
         in one hour. If necessary, user is asked to allow access
-        to his account
+        to his account. Credentials are kept in memory, token.json is
+        read once and written only when the token changes. It's called
+        before every request, so while the token is fresh it returns
+        at once
 
         Raises:
             TransportError: any error, related with networking, signals
             about networking issues.
         """
-        # The file token.json stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if path.exists(self.token_file):
-            self.creds = Credentials.from_authorized_user_file(self.token_file)
-        # If there are no (valid) credentials available, let the user log in.
-        # Hopefully it's a one time action
+        # a replayed run needs no credentials
+        if self.replayer is not None:
+            if self.service is None:
+                self.service = build_from_document(drive_discovery(), http=GatedHttp(self.replayer, self.gate, self.metrics))
+            return
+        if self._creds_fresh() and self._service_actual():
+            return
+        # only one thread at a time may read, refresh or request the token
+        with self._creds_lock:
+            # The file token.json stores the user's access and refresh tokens, and is
+            # created automatically when the authorization flow completes for the first
+            # time.
+            if self.creds is None and path.exists(self.token_file):
+                self.creds = Credentials.from_authorized_user_file(self.token_file)
+            # If there are no (valid) credentials available, let the user log in.
+            # Hopefully it's a one time action. Another thread may have
+            # done it while this one was waiting for the lock
+            if not self._creds_fresh():
+                # refresh in advance, before the token expires. The creds
+                # object stays the same, so services built with it
+                # get the new token too
+                if self.creds and self.creds.refresh_token:
+                    try:
+                        self.creds.refresh(Request(build_http()))
+                    # if any error occured during requesting new access token
+                    # according to docs it will be this type
+                    except TransportError:
+                        raise TransportError
+                else:
+                    # it's needed once in a long while, but takes long to import
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+                    flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_file, self.scopes)
+                    try:
+                        self.creds = flow.run_local_server(port=0, timeout_seconds=60)
+                    # if connection wasn't established, then when timeout is reached, we'll get
+                    # authorization_response = wsgi_app.last_request_uri.replace("http", "https")
+                    # AttributeError: 'NoneType' object has no attribute 'replace'
+                    except AttributeError:
+                        # it's not a mistake. AttributeError doesn't explain what happened
+                        # for a caller, but happens if no network
+                        raise TransportError
+                    self._creds_generation += 1
+                # Save the credentials for the next run
+                with open(self.token_file, 'w') as token:
+                    token.write(self.creds.to_json())
+            # make service
+            if not self._service_actual():
+                # the authorized http object is made like build() makes it
+                # for credentials, but wrapped by the gate
+                http = AuthorizedHttp(self.creds, http=build_http())
+                if self.recorder is not None:
+                    http = RecordingHttp(http, self.recorder)
+                self.service = build_from_document(drive_discovery(), http=GatedHttp(http, self.gate, self.metrics))
+                self._thread_data.creds_generation = self._creds_generation
+
+    def _creds_fresh(self) -> bool:
+        """True if credentials are valid and aren't going to expire soon"""
         if self.creds is None or not self.creds.valid:
-            self.service = None
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                # if any error occured during requesting new access token
-                # according to docs it will be this type
-                except TransportError:
-                    raise TransportError
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_file, self.scopes)
-                try:
-                    self.creds = flow.run_local_server(port=0, timeout_seconds=60)
-                # if connection wasn't established, then when timeout is reached, we'll get
-                # authorization_response = wsgi_app.last_request_uri.replace("http", "https")
-                # AttributeError: 'NoneType' object has no attribute 'replace'
-                except AttributeError:
-                    # it's not a mistake. AttributeError doesn't explain what happened
-                    # for a caller, but happens if no network
-                    raise TransportError
-            # Save the credentials for the next run
-            with open(self.token_file, 'w') as token:
-                token.write(self.creds.to_json())
-        # make service
-        if self.service is None:
-            self.service = build('drive', 'v3', credentials=self.creds)
-    
+            return False
+        # expiry is naive UTC time, or None when unknown
+        if self.creds.expiry is None:
+            return True
+        return self.creds.expiry - datetime.now(UTC).replace(tzinfo=None) > timedelta(seconds=CREDS_REFRESH_MARGIN)
+
+    def _service_actual(self) -> bool:
+        """True if the calling thread has a service built with the current credentials"""
+        return (self.service is not None and
+                getattr(self._thread_data, 'creds_generation', None) == self._creds_generation)
+
     def _get_folder_parent(self, item_id: str) -> str:
         """requests an id if a parent folder to item 'item_id'. Item can
         be either a file or a folder.
@@ -316,224 +2100,355 @@ class GdriveSync:
         Returns:
             tuple: a tuple, consists of two values - boolean, which is set
                         to True if the directory was found on gdrive and
-                        False if created, and str - the directory id
+                        False if created, and str - the directory id.
+                        (False, None) if absent and not created
         """
         # remove innecessary dir separators
         gdrive_path = path.normpath(gdrive_path)
         logger.info(f'Searching{" VAULT" if vault_dir else ""} directory {gdrive_path} on gdrive')
-        self.make_creds() # always check
-        dir_exists = True # init with assumption we'll find the dir
-        # gdrive doesn't support os-like paths, so we have to check
-        # the existence of every item in the path chain
-        folder_chain = gdrive_path.split(os_sep)
-        parent_folder_id = 'root' # search start point
-        # for gdrive_dir_id_cache keys
-        ready_chain = ''
-        while folder_chain:
-            folder_name = folder_chain.pop(0) # get the topmost element
-            ready_chain = path.join(ready_chain, folder_name)
-            # search among saved ids
-            if gdrive_dir_id_cache is not None and ready_chain in gdrive_dir_id_cache:
-                results = gdrive_dir_id_cache[ready_chain]
-            else:
-                # query to request a folder with required name and parent
-                results = self.search_by_name(name=folder_name, parent_folder_id=parent_folder_id, obj_type='folder')
-            # if found, then we can go deeper by the chain
-            if results:
-                # notify if there are more than one dir with teh same name
-                parent_folder_id = results[0]
-                if len(results) > 1:
-                    logger.info(f'(gdrive) !!! warning, found several directories {folder_name} on gdrive')
-                # save if our "cache" is used, no  problem if rewrite
-                if gdrive_dir_id_cache is not None:
-                    gdrive_dir_id_cache[ready_chain] = results
-            # if not found, then create the rest of the absent chain
-            else:
-                dir_exists = False
-                # put back the removed above item, since we didn't find it
-                folder_chain.insert(0, folder_name)
-                # simply create all absent, if dont_create_chain isn't used
-                if not dont_create_chain:
-                    for item in folder_chain:
-                        parent_folder_id = self.create_gdrive_folder(item, parent_folder_id)
-                        if gdrive_dir_id_cache is not None:
-                            ready_chain = path.join(ready_chain, item)
-                            gdrive_dir_id_cache[ready_chain] = parent_folder_id
-                break
-        # log if found. If it was created - another function logs it
-        if dir_exists:
-            logger.info(f'Found{" VAULT" if vault_dir else ""} directory {gdrive_path} on gdrive')
-        return (dir_exists, parent_folder_id)
+        # without a cache from the caller use a throwaway one
+        if gdrive_dir_id_cache is None:
+            gdrive_dir_id_cache = {}
+        created = self._resolve_dirs([gdrive_path], gdrive_dir_id_cache, create=not dont_create_chain)
+        if gdrive_path not in gdrive_dir_id_cache:
+            return (False, None)
+        # if it was created - another function logs it
+        if gdrive_path in created:
+            return (False, gdrive_dir_id_cache[gdrive_path])
+        logger.info(f'Found{" VAULT" if vault_dir else ""} directory {gdrive_path} on gdrive')
+        return (True, gdrive_dir_id_cache[gdrive_path])
+
+    def _resolve_dirs(self, gdrive_paths: list[str], dir_ids: dict[str, str], create: bool=True) -> set[str]:
+        """Finds ids of gdrive directories by their paths. Gdrive doesn't
+        support os-like paths, so every item of every path chain is looked
+        for. Goes level by level, all searches of one level are made in one
+        batch request, creation of absent folders - in another one, since
+        a folder can't be created before it's parent
 
-    def _iterate_gdrive(self, folder_id: str) -> None:
+        Args:
+            gdrive_paths (list[str]): paths to gdrive dirs, like dir/dir/targetdir
+            dir_ids (dict[str, str]): known ids by paths. The side effect
+                        is used, found and created ids are added by it's ref
+            create (bool, optional): create absent dirs. If False, paths
+                        which don't exist don't get to dir_ids
+
+        Returns:
+            set[str]: paths of created dirs
+        """
+        # all path chains split by levels, like {1: {'a'}, 2: {'a/b', 'a/c'}}
+        levels = {}
+        for gdrive_path in gdrive_paths:
+            ready_chain = ''
+            for level, folder_name in enumerate(path.normpath(gdrive_path).split(os_sep)):
+                ready_chain = path.join(ready_chain, folder_name)
+                levels.setdefault(level, set()).add(ready_chain)
+        # ==== innder func ====
+        def parent_id(chain: str) -> str:
+            return dir_ids[path.dirname(chain)] if path.dirname(chain) else 'root'
+        # =====================
+        created = set()
+        for level in sorted(levels):
+            # unknown dirs, which parents are known. If a parent is
+            # unknown now, it doesn't exist and wasn't created
+            unknown = [
+                chain for chain in sorted(levels[level])
+                if chain not in dir_ids and (not path.dirname(chain) or path.dirname(chain) in dir_ids)
+            ]
+            if not unknown:
+                continue
+            found = self.search_by_names([(path.basename(chain), parent_id(chain), 'folder') for chain in unknown])
+            absent = []
+            for chain, results in zip(unknown, found):
+                if results:
+                    # notify if there are more than one dir with the same name
+                    if len(results) > 1:
+                        logger.info(f'(gdrive) !!! warning, found several directories {chain} on gdrive')
+                    dir_ids[chain] = results[0]
+                else:
+                    absent.append(chain)
+            if create and absent:
+                new_ids = self.create_gdrive_folders([(path.basename(chain), parent_id(chain)) for chain in absent])
+                for chain, new_id in zip(absent, new_ids):
+                    dir_ids[chain] = new_id
+                    created.add(chain)
+        return created
+
+    def _iterate_gdrive(
+            self,
+            folder_id: str,
+            parents: str='',
+            listed=None,
+            pool: TransferPool|None=None
+        ) -> None:
         """Takes folder_id as a starting point and gathers the
         gdrive structure to self.gdrive_struct, consisting of
-        OneGDriveTier objects
+        OneGDriveTier objects. Goes level by level, the contents
+        of many folders of one level are requested at once
 
         Args:
             folder_id (str): id of the folder on gdrive to make
                         the structure of
+            parents (str, optional): relative path of the folder, when
+                        only a part of the synced directory is listed
+            listed (Callable, optional): gets every listed chunk of
+                        folders as soon as it's ready, instead of adding
+                        them to self.gdrive_struct. The listing stops,
+                        if it returns False
+            pool (TransferPool | None, optional): threads for the
+                        requests. Defaults to self.transfers
         """
         logger.debug('Start creating gdrive structure')
         self.make_creds() # always check
-        parent_folder_id = folder_id # starting point
-        parent_name = '' # relative root for os-like path
-        dirs_to_visit = [] # nested dirs
-        def one_tier_files() -> None:
-            """Processes one folder, creating the OneGDriveTier object.
-            Doesn't take or return anything because operates with
-            it's parent function variables
-            """
-            for_return = OneGDriveTier(parents=parent_name, gparent=parent_folder_id) # init new
-            # request the information about all contents of the folder
-            current_dir = self.service.files().list(
-                q=f"'{parent_folder_id}' in parents and trashed=false", fields="files(id, name, mimeType, modifiedTime)", pageSize=1000
-            ).execute().get('files', [])
-            for item in current_dir:
-                # if folder, then preserve it's name and id in for result and
-                # add to the list of nested folders - dirs_to_visit
-                # so it's contents can be processed in the future as well
-                if item['mimeType'] == 'application/vnd.google-apps.folder':
-                    for_return.dirs.append((item['name'], item['id']))
-                    dirs_to_visit.append((item['name'], item['id'], parent_name))
-                    continue
-                # if a file, then preserve it's name, id and modification time, converted to timestamp
-                # but cut off numbers after dot via int
-                else:
-                    for_return.files.append((item['name'], item['id'], int(datetime.fromisoformat(item['modifiedTime']).timestamp())))
-            self.gdrive_struct.append(for_return) # add new OneGDriveTier to the result
-        # call for the root dir
-        one_tier_files()
-        # loop over all other dirs with any nesting inside the root dir
-        while dirs_to_visit:
-            dir_name, parent_folder_id, tmp_parent = dirs_to_visit.pop(0)
-            parent_name = path.join(tmp_parent, dir_name)
-            one_tier_files()
+        pool = pool or self.transfers
+        # folders of the current nesting level, their contents are
+        # requested, and their subfolders make the next level
+        level = [OneGDriveTier(parents=parents, gparent=folder_id)]
+        while level:
+            # one request asks for the contents of several folders
+            chunks = [level[i:i + LIST_PARENTS_PER_REQUEST] for i in range(0, len(level), LIST_PARENTS_PER_REQUEST)]
+            parent_ids = [[tier.gparent for tier in chunk] for chunk in chunks]
+            # chunks, which are passed on, are taken as they come, not waiting
+            # for the slowest one. Otherwise keep the order, so of folders with
+            # the same path the same one is always the first
+            if listed is None:
+                contents = enumerate(pool.map(self._list_children, parent_ids))
+            else:
+                contents = pool.map_unordered(self._list_children, parent_ids)
+            next_level = []
+            for number, items in contents:
+                chunk = chunks[number]
+                # items are mixed, so find a tier for each by it's parent id
+                chunk_tiers = {tier.gparent: tier for tier in chunk}
+                for item in items:
+                    for parent in item.get('parents', []):
+                        if parent in chunk_tiers:
+                            for_return = chunk_tiers[parent]
+                            break
+                    else:
+                        continue
+                    is_dir = item['mimeType'] == 'application/vnd.google-apps.folder'
+                    # ignored folders aren't listed at all
+                    if self._ignored(path.join(for_return.parents, item['name']), is_dir):
+                        continue
+                    # if folder, then preserve it's name and id in for result and
+                    # add it to the next level so it's contents can be processed
+                    # in the future as well
+                    if is_dir:
+                        for_return.dirs.append((item['name'], item['id']))
+                        next_level.append(OneGDriveTier(parents=path.join(for_return.parents, item['name']), gparent=item['id']))
+                    # if a file, then preserve it's name, id and modification time, converted to timestamp
+                    # but cut off numbers after dot via int
+                    else:
+                        for_return.files.append((
+                            item['name'],
+                            item['id'],
+                            int(datetime.fromisoformat(item['modifiedTime']).timestamp()),
+                            int(item['size']) if 'size' in item else None,
+                            item.get('md5Checksum')
+                        ))
+                if listed is None:
+                    self.gdrive_struct += chunk # add new OneGDriveTiers to the result
+                elif listed(chunk) is False:
+                    contents.close()
+                    logger.debug('Creating gdrive structure is stopped')
+                    return
+            level = next_level
         logger.debug('Finished creating gdrive structure')
 
-    def _iterate_localdir(self) -> None:
-        """returns OneLocalTier object for each directory in a tree.
-        For files - adds up a file modification type in a tuple
-        (filename, mtime). Stores the gathered results in
-        self.local_struct
+    def _iterate_gdrive_changes(self, page_token: str) -> str|None:
+        """Gathers self.gdrive_struct without listing the whole gdrive
+        directory. Takes the gdrive structure remembered in the sync state
+        and applies to it the changes, made on gdrive since page_token
 
         Args:
-            dir (_type_): an absolute path to a root directory
-                        for which this function returns lists of
-                        contents
+            page_token (str): changes page token, saved by the last sync
+
+        Returns:
+            str|None: a page token to start the next time from, or None
+                        if the changes can't be received, then nothing
+                        is gathered and the whole directory should be listed
+        """
+        logger.debug('Start creating gdrive structure from changes')
+        try:
+            changes, new_page_token = self._list_changes(page_token)
+        except HttpError as e:
+            # the token may be expired or wrong
+            logger.info(f'Changes since the last sync are unavailable, listing the whole directory: {str(e)}')
+            return None
+        # gdrive objects as they were synced last time, by id: name,
+        # parent id, mtime or None for directories, size, md5
+        objects = {}
+        rel_path_ids = {'': self.gdrive_folder_id}
+        rows = sorted(self.state.entries(), key=lambda row: row['rel_path'].count(os_sep))
+        for row in rows:
+            rel_path_ids[row['rel_path']] = row['g_id']
+            parent_id = rel_path_ids.get(path.dirname(row['rel_path']))
+            objects[row['g_id']] = (path.basename(row['rel_path']), parent_id,
+                                    None if row['is_dir'] else row['mtime'], row['size'], row['md5'])
+        known_ids = set(objects)
+        logger.debug(f'{len(changes)} changes on gdrive since the last sync')
+        self._apply_changes(objects, changes)
+        # rebuild tiers going from the synced directory down. Objects which
+        # were moved out of it or lay in deleted folders aren't reached
+        children = {}
+        for g_id, (name, parent_id, mtime, size, md5) in objects.items():
+            children.setdefault(parent_id, []).append((g_id, name, mtime, size, md5))
+        level = [OneGDriveTier(parents='', gparent=self.gdrive_folder_id)]
+        # folders, which came from outside, have unknown contents
+        new_folders = []
+        while level:
+            next_level = []
+            for tier in level:
+                self.gdrive_struct.append(tier)
+                for g_id, name, mtime, size, md5 in children.get(tier.gparent, []):
+                    if self._ignored(path.join(tier.parents, name), mtime is None):
+                        continue
+                    if mtime is not None:
+                        tier.files.append((name, g_id, mtime, size, md5))
+                        continue
+                    tier.dirs.append((name, g_id))
+                    if g_id in known_ids:
+                        next_level.append(OneGDriveTier(parents=path.join(tier.parents, name), gparent=g_id))
+                    else:
+                        new_folders.append((path.join(tier.parents, name), g_id))
+            level = next_level
+        # folders, which are new in the synced directory, are listed
+        # as a whole. They may be just created or moved here
+        for rel_path, g_id in new_folders:
+            self._iterate_gdrive(g_id, rel_path)
+        logger.debug('Finished creating gdrive structure from changes')
+        return new_page_token
+
+    def _list_changes(self, page_token: str) -> tuple[list[dict], str]:
+        """Requests all changes on gdrive since page_token
+
+        Args:
+            page_token (str): a token, saved earlier
+
+        Returns:
+            tuple[list[dict], str]: changes and a token for the next time
+        """
+        self.make_creds() # always check
+        changes = []
+        while True:
+            results = self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=1000,
+                fields='nextPageToken, newStartPageToken, '
+                       'changes(fileId, removed, file(name, mimeType, modifiedTime, size, md5Checksum, parents, trashed))'
+            ).execute()
+            changes += results.get('changes', [])
+            if 'newStartPageToken' in results:
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
+
+    @staticmethod
+    def _apply_changes(objects: dict[str, tuple], changes: list[dict]) -> None:
+        """Applies gdrive changes to known objects
+
+        Args:
+            objects (dict[str, tuple]): objects by their ids: (name,
+                        parent id, mtime, size, md5), mtime is None for directories.
+                        Modified by it's ref
+            changes (list[dict]): changes as they come from changes().list
+        """
+        for change in changes:
+            g_id = change['fileId']
+            file = change.get('file')
+            # deleted, trashed or not available anymore
+            if change.get('removed') or not file or file.get('trashed'):
+                objects.pop(g_id, None)
+                continue
+            # a gdrive item has one parent, if any
+            parent_id = (file.get('parents') or [None])[0]
+            if file['mimeType'] == 'application/vnd.google-apps.folder':
+                mtime = None
+            else:
+                mtime = int(datetime.fromisoformat(file['modifiedTime']).timestamp())
+            objects[g_id] = (file['name'], parent_id, mtime,
+                             int(file['size']) if 'size' in file else None, file.get('md5Checksum'))
+
+    def _get_start_page_token(self) -> str:
+        """Returns a token to request changes made on gdrive after now"""
+        self.make_creds() # always check
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+
+    def _iterate_localdir(self) -> None:
+        """makes OneLocalTier object for each directory in a tree.
+        For files - adds up a file modification type in a tuple
+        (filename, mtime, md5). Stores the gathered results in
+        self.local_struct. Uses scandir, so types and mtimes come
+        with the directory listing, mostly without extra syscalls.
+        Ignored objects are skipped right away, ignored directories
+        aren't walked at all. With self.max_walkers > 1 several
+        directories are read at once, it helps for wide trees
+        on network filesystems
         """
         logger.debug('Creating local structure')
-        dirs_to_visit = [] # dirs to make OneLocalTier for each
         # --------------- innder func ----------------
-        def one_tier_files(parents: str) -> None:
+        def one_tier_files(parents: str) -> OneLocalTier:
             """gets non resursive contents of one directory, stores
-            it into a OneLocalTier object, adds the object to totale result,
-            adds directories to dirs_to_visit if there are any
+            it into a OneLocalTier object
 
             Args:
                 parents (str): relative 'shift' inside the root dir
 
-            Returns: nothing, because modifies variables of parent func
+            Returns:
+                OneLocalTier: the directory contents
             """
             for_return = OneLocalTier(parents=parents)
-            current_dir = path.join(self.local_folder, parents) # get abs path
             # loop over all items in a directory
-            for item in listdir(current_dir):
-                item_full = path.join(current_dir, item) # get abs path of an item
-                # skip links. They are dangerous and not needed on gdrive
-                if path.islink(item_full):
-                    continue
-                # add files as tuples with their modification times with cut off
-                # nimbers after a dot
-                if path.isfile(item_full):
-                    for_return.files.append((item, int(path.getmtime(item_full))))
-                    continue
-                # add dir to the result and to the list of dirs to visit
-                if path.isdir(item_full):
-                    for_return.dirs.append(item)
-                    dirs_to_visit.append((parents, item))
-            self.local_struct.append(for_return)
+            with scandir(path.join(self.local_folder, parents)) as entries:
+                for entry in entries:
+                    # skip links. They are dangerous and not needed on gdrive
+                    if entry.is_symlink():
+                        continue
+                    rel_path = path.join(parents, entry.name)
+                    try:
+                        # add files as tuples with their modification times with cut off
+                        # nimbers after a dot. Skip unfinished downloads
+                        if entry.is_file():
+                            if not entry.name.endswith(PART_SUFFIX) and not self._ignored(rel_path, False):
+                                for_return.files.append((entry.name, int(entry.stat().st_mtime), None))
+                        # add dir to the result, it will be visited later
+                        elif entry.is_dir():
+                            if not self._ignored(rel_path, True):
+                                for_return.dirs.append(entry.name)
+                    # removed while walking
+                    except FileNotFoundError:
+                        continue
+            return for_return
         # ----------- end innder func ----------------
-        # call for the root dir
-        one_tier_files('')
-        # loop over all other dirs with any nesting inside the root dir
-        while dirs_to_visit:
-            one_tier_files(path.join(*dirs_to_visit.pop(0)))
+        if self.max_walkers <= 1:
+            # call for the root dir and loop over all other dirs
+            # with any nesting inside the root dir
+            dirs_to_visit = deque([''])
+            while dirs_to_visit:
+                tier = one_tier_files(dirs_to_visit.popleft())
+                self.local_struct.append(tier)
+                dirs_to_visit.extend(path.join(tier.parents, dir) for dir in tier.dirs)
+        else:
+            # go level by level, all dirs of one level are read at once
+            with ThreadPoolExecutor(self.max_walkers, thread_name_prefix='walk') as pool:
+                level = ['']
+                while level:
+                    tiers = list(pool.map(one_tier_files, level))
+                    self.local_struct += tiers
+                    level = [path.join(tier.parents, dir) for tier in tiers for dir in tier.dirs]
         logger.debug('Created local structure')
 
-    def _exclude_ignored(self) -> None:
-        """takes both structures self.gdrive_struct and
-        self.local_struct and cleans them from objects
-        in self.ignored_objects (list[IgnoreThose]) - folders,
-        files in a folder or single files. It's important to clean
-        both otherwise the objects, presented in one source will be
-        copied to another or, even worse, deleted from the first.
-        """
-        logger.debug('Excluding ignored things')
-        # --------------- innder func ----------------
-        def exclude_one(
-                struct: list[OneGDriveTier]|list[OneLocalTier],
-                item_to_exclude: IgnoreThose
-            ) -> None:
-            """a helper function. Does all the job to exclude stuff
+    def _ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """checks if a local or gdrive object is ignored
 
-            Args:
-                struct (list[OneGDriveTier] | list[OneLocalTier]): a struct
-                item_to_exclude (IgnoreThose): item to exclude
-            """
-            # if we be removing things right in for loor, it probably
-            # can be bad for it. So we store the elements
-            # (rather labels) and remove later. only for a 'folder'
-            items_to_remove = []
-            # check if there are items at all
-            if not struct:
-                return
-            # loop over item in a struct
-            for item in struct:
-                match item_to_exclude.obj_type:
-                    # if we should remove just one file
-                    case 'single_file':
-                        # find the proper item by it's path
-                        if item.parents == item_to_exclude.parents:
-                            # struct.files are tuples, we have to check first elements
-                            for file in item.files:
-                                if item_to_exclude.obj_name == file[0]:
-                                    # remove and return
-                                    item.files.remove(file)
-                                    return
-                    # ignore all files in some folder
-                    case 'all_files':
-                        # find the proper item by it's path
-                        if item.parents == item_to_exclude.parents:
-                            # empty all files
-                            item.files.clear()
-                            break
-                    # ignore a whole folder and it's subfolders with content
-                    case 'folder':
-                        # remove all subfolders
-                        if item_to_exclude.rel_path in item.parents:
-                            items_to_remove.append(item)
-                        # remove the parent folder from some_tier.dirs
-                        if item.tier == item_to_exclude.tier:
-                            for dir in item.dirs:
-                                if type(dir) is tuple:
-                                    if item_to_exclude.obj_name == dir[0]:
-                                        item.dirs.remove(dir)
-                                        break
-                                else:
-                                    if item_to_exclude.obj_name == dir:
-                                        item.dirs.remove(dir)
-                                        break
-            # remove ignored folders from a structure
-            for item in items_to_remove:
-                struct.remove(item)
-        # ----------- end innder func ----------------
-        # go over all ignoring items
-        for item_to_ignore in self.ignored_objects:
-            exclude_one(self.gdrive_struct, item_to_ignore)
-            exclude_one(self.local_struct, item_to_ignore)  
-        # clear self.ignored_objects for usage in 'ask' sync direction
-        self.ignored_objects.clear()
+        Args:
+            rel_path (str): path relative to the syncing folder
+            is_dir (bool): if the object is a directory
+        """
+        started = perf_counter()
+        ignored = self.ignore_matcher.matches(rel_path, is_dir)
+        self.metrics.add_time('ignore filtering', perf_counter() - started)
+        return ignored
 
 # ========== manipulate gdrive ===============
     def create_gdrive_folder(self, folder_name: str, parent_folder_id: str|None=None) -> str:
@@ -546,17 +2461,77 @@ class GdriveSync:
         Returns:
             str: newly created forlder id
         """
-        logger.info(f'[+](gdrive) creating folder {folder_name}')
+        return self.create_gdrive_folders([(folder_name, parent_folder_id)])[0]
+
+    def create_gdrive_folders(self, folders: list[tuple[str, str|None]]) -> list[str]:
+        """creates several folders on gdrive in batch requests. Parents
+        have to exist already, so a folder and it's subfolder can't
+        be created in one call
+
+        Args:
+            folders (list[tuple[str, str|None]]): names and parent
+                        folder ids of folders to create
+
+        Returns:
+            list[str]: newly created forlder ids, in the same order
+        """
+        if not folders:
+            return []
+        logger.info(f'[+](gdrive) creating folder {", ".join(name for name, _ in folders)}')
         self.make_creds() # always check
-        folder_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder' # type folder
-        }
-        if parent_folder_id:
-            # list is required but more than one item is deprecated
-            folder_metadata['parents'] = [parent_folder_id]
-        new_folder = self.service.files().create(body=folder_metadata, fields='id').execute()
-        return new_folder['id']
+        requests = []
+        for folder_name, parent_folder_id in folders:
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': 'application/vnd.google-apps.folder' # type folder
+            }
+            if parent_folder_id:
+                # list is required but more than one item is deprecated
+                folder_metadata['parents'] = [parent_folder_id]
+            requests.append(self.service.files().create(body=folder_metadata, fields='id'))
+        return [new_folder['id'] for new_folder, _ in self._execute_batch(requests)]
+
+    def _list_all(self, query: str, fields: str) -> list[dict]:
+        """Requests all the objects matching a query. Gdrive returns
+        results page by page, so follows nextPageToken until the end
+
+        Args:
+            query (str): a query for files().list
+            fields (str): fields of every found object, like 'id, name'
+
+        Returns:
+            list[dict]: found objects
+        """
+        self.make_creds() # always check
+        found = []
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=query, fields=f'nextPageToken, files({fields})', pageSize=1000, pageToken=page_token
+            ).execute()
+            found += results.get('files', [])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return found
+
+    def _list_children(
+            self,
+            parent_ids: list[str],
+            fields: str='id, name, mimeType, modifiedTime, size, md5Checksum, parents'
+        ) -> list[dict]:
+        """Requests the contents of several folders in one go
+
+        Args:
+            parent_ids (list[str]): ids of folders
+            fields (str, optional): fields of every object, should
+                        include parents to tell the folders apart
+
+        Returns:
+            list[dict]: all objects inside these folders, with their names,
+                        ids, types, modification times, sizes, md5 and parents
+        """
+        parents = ' or '.join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+        return self._list_all(f'({parents}) and trashed=false', fields)
 
     def search_by_name(self,
                        name: str,
@@ -580,8 +2555,39 @@ class GdriveSync:
         """
 
         logger.debug(f'(gdrive) searching id for {name}')
+        for_return = []
+        for item in self._list_all(self._search_query(name, parent_folder_id, obj_type), 'id'):
+            for_return.append(item['id'])
+        return for_return
+
+    def search_by_names(self, searches: list[tuple[str, str|None, Literal['file', 'folder', 'any']]]) -> list[list[str]]:
+        """Does many searches like search_by_name in batch requests
+
+        Args:
+            searches (list[tuple]): tuples of search_by_name arguments:
+                        name, parent_folder_id, obj_type
+
+        Returns:
+            list[list[str]]: lists of IDs of found objects, one for
+                        each search in the same order
+        """
+        if not searches:
+            return []
+        logger.debug(f'(gdrive) searching ids for {", ".join(name for name, _, _ in searches)}')
         self.make_creds() # always check
-        # assembling a query
+        requests = [
+            self.service.files().list(q=self._search_query(*search), fields='files(id)', pageSize=1000)
+            for search in searches
+        ]
+        return [[item['id'] for item in response.get('files', [])] for response, _ in self._execute_batch(requests)]
+
+    @staticmethod
+    def _search_query(
+            name: str,
+            parent_folder_id: str|None=None,
+            obj_type: Literal['file', 'folder', 'any']='file'
+        ) -> str:
+        """assembles a query for search_by_name, see it for arguments"""
         query = ''
         if parent_folder_id is not None:
             query += f"'{parent_folder_id}' in parents and "
@@ -589,14 +2595,66 @@ class GdriveSync:
             query += "mimeType!='application/vnd.google-apps.folder' and "
         elif obj_type == 'folder':
             query += "mimeType='application/vnd.google-apps.folder' and "
+        # quotes and backslashes in the name would break the query
+        name = name.replace('\\', '\\\\').replace("'", "\\'")
         # query += f"name contains '{name}' and trashed=false"
         # looking for the exact name instead of partial
         query += f"name = '{name}' and trashed=false"
-        results = self.service.files().list(q=query, fields='files(id)').execute()
-        for_return = []
-        for item in results['files']:
-            for_return.append(item['id'])
-        return for_return
+        return query
+
+    def _execute_batch(self, requests: list, raise_errors: bool=True) -> list[tuple[dict|None, Exception|None]]:
+        """Executes requests, packing them into as few batch requests
+        as possible. Every request costs a round-trip otherwise
+
+        Args:
+            requests (list): requests, made but not executed
+            raise_errors (bool, optional): raise the first error, if
+                        any request has failed. Otherwise errors are returned
+
+        Returns:
+            list[tuple[dict|None, Exception|None]]: a response and an error
+                        for every request, in the same order
+        """
+        self.make_creds() # always check
+        # a batch of one request is a waste
+        if len(requests) == 1:
+            try:
+                return [(requests[0].execute(), None)]
+            except HttpError as e:
+                if raise_errors:
+                    raise
+                return [(None, e)]
+        results = [(None, None)] * len(requests)
+        def callback(request_id: str, response: dict, exception: HttpError|None) -> None:
+            results[int(request_id)] = (response, exception)
+        # a batch answers 200, even if some requests inside were
+        # throttled, those are repeated here. The whole batch is
+        # repeated by GatedHttp
+        pending = list(range(len(requests)))
+        for attempt in range(RETRY_ATTEMPTS + 1):
+            for start in range(0, len(pending), BATCH_LIMIT):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for number in pending[start:start + BATCH_LIMIT]:
+                    batch.add(requests[number], request_id=str(number))
+                batch.execute()
+            pending = [
+                number for number in pending
+                if isinstance(results[number][1], HttpError) and
+                RequestGate.retryable(results[number][1].resp.status, results[number][1].content,
+                                      requests[number].method != 'POST')
+            ]
+            if not pending or attempt == RETRY_ATTEMPTS:
+                break
+            self.gate.adapt(throttled=True)
+            self.metrics.retried('batch', len(pending))
+            delay = RequestGate.backoff(attempt)
+            logger.info(f'(gdrive) {len(pending)} request(s) of a batch throttled, repeating in {delay:.1f} s')
+            sleep(delay)
+        if raise_errors:
+            for _, exception in results:
+                if exception is not None:
+                    raise exception
+        return results
 
     def delete_file_or_folder(self, file_id: str, file_name: str) -> None:
         """Deletes an object with said id on gdrive
@@ -610,23 +2668,38 @@ class GdriveSync:
             self.service.files().delete(fileId=file_id).execute()
         except HttpError:
             logger.error(f'{file_id} отсутствует')
+        self.state.remove(file_name)
 
     def batch_delete_files(self, files_to_delete: dict[str, str]) -> None:
-        """Deletes all objects in the list in one request
+        """Deletes all objects in the list in one request. Objects
+        which are gone already count deleted
 
         Args:
             files_to_delete (dict): a list of IDs and paths
                         of objects to delete
+
+        Raises:
+            HttpError: the first error of objects, which weren't
+                        deleted. Deleted ones are forgotten anyway
         """
         if not files_to_delete:
             return
         logger.info(f'x(gdrive) batch deleting {", ".join(files_to_delete.values())}')
         self.make_creds()
-        batch = self.service.new_batch_http_request()
-        for g_id in files_to_delete.keys():
-            request = self.service.files().delete(fileId=g_id)
-            batch.add(request)
-        batch.execute()
+        requests = [self.service.files().delete(fileId=g_id) for g_id in files_to_delete.keys()]
+        results = self._execute_batch(requests, raise_errors=False)
+        error = None
+        for (g_id, rel_path), (_, exception) in zip(files_to_delete.items(), results):
+            # a repeated delete of an interrupted plan finds nothing
+            if exception is not None and not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                logger.error(f'{rel_path} ({g_id}) wasnt deleted: {str(exception)}')
+                error = error or exception
+                continue
+            # only what is gone is forgotten. An object left on gdrive
+            # stays known as synced, or the next sync takes it for new
+            self.state.remove(rel_path)
+        if error is not None:
+            raise error
 
     def update_file(self, local_path: str, file_id: str, mtime: int=0) -> None:
         """Updates the existing gdrive file, preserving it's
@@ -640,19 +2713,22 @@ class GdriveSync:
         logger.info(f'(local) -> (gdrive) updating file {path.basename(local_path)}')
         self.make_creds()
         full_path = path.join(self.local_folder, local_path)
-        media = MediaFileUpload(full_path, resumable=True)
+        media = self._make_media(full_path)
         # Get the current modification time of the local file
         if not mtime:
             mtime = int(path.getmtime(full_path))     
         mtime_iso = datetime.fromtimestamp(mtime, UTC).isoformat()   
         # Update the file metadata and media
-        self.service.files().update(
+        request = self.service.files().update(
             fileId=file_id,
             media_body=media,
             body={
                 'modifiedTime': mtime_iso
-            }
-        ).execute()
+            },
+            fields='id, size, md5Checksum'
+        )
+        updated = self._send_media(request, media, local_path, file_id, mtime)
+        self.state.put(local_path, False, file_id, mtime, int(updated.get('size', 0)), updated.get('md5Checksum'))
 
     def rename_file_or_folder(self, file_id: str, new_name: str, local_path: str) -> None:
         """Renames an existing gdrive file or folder
@@ -687,22 +2763,91 @@ class GdriveSync:
         """           
         logger.info(f'<->(gdrive) moving {old_path} to {new_path}')
         self.make_creds()
-        # Retrieve the existing parent folder IDs
-        file = self.service.files().get(
-            fileId=file_id,
-            fields='parents'
-        ).execute()
-        # tbh I didn't see the parents array containing more that one element, ever
-        current_parents = ",".join(file.get('parents'))
-        # Move the file or folder to the new parent folder
-        self.service.files().update(
-            fileId=file_id,
-            addParents=new_parent_id,
-            removeParents=current_parents,
-            fields='id, parents'
-        ).execute()
+        # Retrieve the existing parent folder IDs
+        file = self.service.files().get(
+            fileId=file_id,
+            fields='parents'
+        ).execute()
+        # tbh I didn't see the parents array containing more that one element, ever
+        current_parents = ",".join(file.get('parents'))
+        # Move the file or folder to the new parent folder
+        self.service.files().update(
+            fileId=file_id,
+            addParents=new_parent_id,
+            removeParents=current_parents,
+            fields='id, parents'
+        ).execute()
+
+    def batch_rename(self, renames: list[tuple[str, str, str]]) -> None:
+        """Renames several gdrive files or folders in batch requests
+
+        Args:
+            renames (list[tuple[str, str, str]]): tuples of
+                        rename_file_or_folder arguments: file_id,
+                        new_name, local_path
+        """
+        if not renames:
+            return
+        for _, new_name, local_path in renames:
+            logger.info(f'(gdrive) renaming {local_path} to {new_name}')
+        self.make_creds()
+        self._execute_batch([
+            self.service.files().update(fileId=file_id, body={'name': path.basename(new_name)}, fields='id, name')
+            for file_id, new_name, _ in renames
+        ])
+
+    def batch_move(self, moves: list[tuple[str, str, str, str]]) -> None:
+        """Moves several gdrive files or folders in batch requests
+
+        Args:
+            moves (list[tuple[str, str, str, str]]): tuples of
+                        move_file_or_folder arguments: file_id,
+                        new_parent_id, old_path, new_path
+        """
+        if not moves:
+            return
+        for _, _, old_path, new_path in moves:
+            logger.info(f'<->(gdrive) moving {old_path} to {new_path}')
+        self.make_creds()
+        # existing parents first, they are needed for the update
+        files = self._execute_batch([
+            self.service.files().get(fileId=file_id, fields='parents') for file_id, _, _, _ in moves
+        ])
+        self._execute_batch([
+            self.service.files().update(
+                fileId=file_id,
+                # the object can get a new name on the way
+                body={'name': path.basename(new_path)} if path.basename(new_path) != path.basename(old_path) else {},
+                addParents=new_parent_id,
+                removeParents=",".join(file.get('parents', [])),
+                fields='id, parents'
+            )
+            for (file_id, new_parent_id, old_path, new_path), (file, _) in zip(moves, files)
+        ])
+
+    def batch_set_mtime(self, files: list[tuple[str, int, str]]) -> None:
+        """Sets modification time of several gdrive files in batch
+        requests. The content isn't touched
+
+        Args:
+            files (list[tuple[str, int, str]]): file ids, new
+                        modification times and local paths for logging
+        """
+        if not files:
+            return
+        for _, _, local_path in files:
+            logger.info(f'(gdrive) setting modification time of {local_path}')
+        self.make_creds()
+        self._execute_batch([
+            self.service.files().update(
+                fileId=file_id,
+                body={'modifiedTime': datetime.fromtimestamp(mtime, UTC).isoformat()},
+                fields='id'
+            )
+            for file_id, mtime, _ in files
+        ])
 
-    def upload_file(self, local_path: str, mtime: int=0, parent: str='root') -> None:
+    def upload_file(self, local_path: str, mtime: int=0, parent: str='root') -> str:
         """Uploads a new file to gdrive. If a file with such name
         exists, it will be uploaded as a separate file regardless
 
@@ -711,6 +2856,9 @@ class GdriveSync:
                         syncing folder
             parent (str, optional): folder id on gdrive where
                         the file will be located
+
+        Returns:
+            str: id of the uploaded file
         """
         logger.info(f'(local) -> (gdrive) uploading file {local_path}')
         self.make_creds()
@@ -724,8 +2872,95 @@ class GdriveSync:
             'parents': [parent],
             'modifiedTime': mtime_iso
         }
-        media = MediaFileUpload(full_local_path, resumable=True)
-        self.service.files().create(body=file_metadata, media_body=media).execute()
+        media = self._make_media(full_local_path)
+        request = self.service.files().create(body=file_metadata, media_body=media, fields='id, size, md5Checksum')
+        new_file = self._send_media(request, media, local_path, parent, mtime)
+        self.state.put(local_path, False, new_file['id'], mtime, int(new_file.get('size', 0)), new_file.get('md5Checksum'))
+        return new_file['id']
+
+    def _make_media(self, full_path: str) -> MediaFileUpload:
+        """Prepares a file for uploading. Small files go by one
+        multipart request with the metadata, big ones - by a resumable
+        session, which survives a failed chunk
+
+        Args:
+            full_path (str): absolute path to a local file
+
+        Returns:
+            MediaFileUpload: media_body for create or update
+        """
+        if path.getsize(full_path) <= self.simple_upload_threshold:
+            return MediaFileUpload(full_path, resumable=False)
+        return MediaFileUpload(full_path, chunksize=self.chunk_size, resumable=True)
+
+    def _send_media(self, request, media: MediaFileUpload, local_path: str, g_id: str, mtime: int) -> dict:
+        """Executes an upload request. A resumable upload is sent chunk
+        by chunk and it's session is journaled, so if the upload is
+        interrupted, the next try continues from the last chunk gdrive
+        has received, even after the restart of the script
+
+        Args:
+            request (HttpRequest): files().create or files().update request
+            media (MediaFileUpload): media_body of the request
+            local_path (str): path to the file relative to the
+                        syncing folder
+            g_id (str): id of the updated file or of the parent folder
+                        of a new one. Tells one upload from another
+            mtime (int): local modification time of the file
+
+        Returns:
+            dict: the request response
+        """
+        if not media.resumable():
+            return request.execute()
+        size = media.size()
+        response = None
+        journal = self.state.get_transfer(local_path, 'upload')
+        if journal is not None and (journal['g_id'], journal['size'], journal['mtime']) == (g_id, size, mtime):
+            logger.info(f'(local) -> (gdrive) resuming upload of {local_path}')
+            try:
+                response = self._resume_upload(request, journal['session_uri'], size)
+            except HttpError as e:
+                # the session has expired, a new one is started
+                if e.resp.status not in (404, 410):
+                    raise
+                logger.info(f'(local) -> (gdrive) upload session of {local_path} has expired, starting over')
+        while response is None:
+            status, response = request.next_chunk()
+            if status is not None:
+                self.state.put_transfer(local_path, 'upload', g_id, size, mtime,
+                                        request.resumable_uri, status.resumable_progress)
+                logger.info(f'(local) -> (gdrive) uploading file {local_path} - {int(status.progress() * 100)}%')
+        self.state.drop_transfer(local_path, 'upload')
+        return response
+
+    @staticmethod
+    def _resume_upload(request, session_uri: str, size: int) -> dict|None:
+        """Asks gdrive how much of a file an upload session has got,
+        and sets the request to send the rest by next_chunk
+
+        Args:
+            request (HttpRequest): files().create or files().update request
+            session_uri (str): the journaled upload session
+            size (int): the file size
+
+        Raises:
+            HttpError: 404 or 410 if the session has expired
+
+        Returns:
+            dict | None: the request response, if gdrive has got
+                        the whole file already
+        """
+        response, content = request.http.request(
+            session_uri, 'PUT', headers={'Content-Length': '0', 'Content-Range': f'bytes */{size}'}
+        )
+        if response.status != 308:
+            # the upload is complete, or an error is raised
+            return request.postproc(response, content)
+        request.resumable_uri = response.get('location', session_uri)
+        # no Range means nothing is received yet
+        request.resumable_progress = int(response['range'].split('-')[1]) + 1 if 'range' in response else 0
+        return None
 
     def upload_folder(self, local_path, parent='root') -> None:
         """Uploads a whole dir to gdrive. If a dir with such name
@@ -740,45 +2975,118 @@ class GdriveSync:
         logger.info(f'(local) [->] (grdive) uploading directory {local_path}')
         self.make_creds()
         full_local_path = path.join(self.local_folder, local_path)
-        folder_ids = {full_local_path: self.create_gdrive_folder(path.basename(local_path), parent)}
+        rel_path = path.relpath(full_local_path, self.local_folder)
+        # walk first. All dirs of one level are created at once,
+        # so know them beforehand
+        dirs_by_level = {}
+        files_to_upload = []
         for root, dirs, files in walk(full_local_path):
+            rel_root = path.relpath(root, self.local_folder)
             for directory in dirs:
-                dir_path = path.join(root, directory)
-                parent_path = path.dirname(dir_path)
-                parent_id = folder_ids[parent_path]
-                folder_ids[dir_path] = self.create_gdrive_folder(directory, parent_id)
-            for file in files:
-                file_path = path.join(root, file)
-                parent_id = folder_ids[root]
-                self.upload_file(file_path, parent=parent_id)
-
-    def download_file(self, local_path: str, file_id_to_download: str) -> None:
+                dir_path = path.join(rel_root, directory)
+                dirs_by_level.setdefault(dir_path.count(os_sep), []).append(dir_path)
+            files_to_upload += [path.join(rel_root, file) for file in files if not file.endswith(PART_SUFFIX)]
+        folder_ids = {rel_path: self.create_gdrive_folder(path.basename(rel_path), parent)}
+        for level in sorted(dirs_by_level):
+            dirs = dirs_by_level[level]
+            new_ids = self.create_gdrive_folders([(path.basename(dir), folder_ids[path.dirname(dir)]) for dir in dirs])
+            folder_ids.update(zip(dirs, new_ids))
+        for file_path in files_to_upload:
+            self.upload_file(file_path, parent=folder_ids[path.dirname(file_path)])
+
+    def download_file(
+            self,
+            local_path: str,
+            file_id_to_download: str,
+            file_name: str|None=None,
+            file_mtime: int|None=None,
+            size: int|None=None,
+            md5: str|None=None
+        ) -> None:
         """Downloads a file, which exists on gdrive, but not locally.
-        Takes it's name from gdrive
+        Takes it's name from gdrive. During syncing it's metadata is known
+        from the listing, otherwise it's requested
 
         Args:
             file_id_to_download (str): id of a file on gdrive
             local_path (str): a local path where a file should
                         be located, relative to the syncing dir
+            file_name (str | None, optional): the file name on gdrive
+            file_mtime (int | None, optional): the file modification time
+            size (int | None, optional): the file size
+            md5 (str | None, optional): the file md5Checksum
         """
         self.make_creds()
-        # Request the file metadata: kind - file or dir, id, name, mimeType
-        # we need name here
-        file_metadata = self.service.files().get(fileId=file_id_to_download, fields='modifiedTime,name').execute()
-        file_name = file_metadata['name']
-        file_mtime = datetime.fromisoformat(file_metadata['modifiedTime']).timestamp()
+        if file_name is None or file_mtime is None:
+            # Request the file metadata: kind - file or dir, id, name, mimeType
+            # we need name here
+            file_metadata = self.service.files().get(
+                fileId=file_id_to_download, fields='modifiedTime, name, size, md5Checksum'
+            ).execute()
+            file_name = file_metadata['name']
+            file_mtime = int(datetime.fromisoformat(file_metadata['modifiedTime']).timestamp())
+            size = int(file_metadata['size']) if 'size' in file_metadata else None
+            md5 = file_metadata.get('md5Checksum')
         file_path_local = path.join(self.local_folder, local_path, file_name)
-        # Download the file
+        rel_file_path = path.join(local_path, file_name)
+        # the file is written next to it's place and renamed when complete,
+        # so an interrupted download never looks like a synced file
+        part_path = file_path_local + PART_SUFFIX
+        # continue an interrupted download of the same version of the file
+        offset = 0
+        journal = self.state.get_transfer(rel_file_path, 'download')
+        if (journal is not None and (journal['g_id'], journal['mtime']) == (file_id_to_download, file_mtime)
+                and path.isfile(part_path) and path.getsize(part_path) >= journal['offset']):
+            offset = journal['offset']
+            if size is None:
+                size = journal['size']
+            logger.info(f'(local) <- (gdrive) resuming download of {file_name} from {offset} bytes')
+        # Download the file by chunks, each is asked by a Range header
         request = self.service.files().get_media(fileId=file_id_to_download)
         # save file to sync folder + inner path + file name
-        fh = FileIO(file_path_local, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            logger.info(f"(local) <- (gdrive) downloading file {file_name} - {int(status.progress() * 100)}%")
+        with FileIO(part_path, 'r+b' if offset else 'wb') as fh:
+            # drop whatever was written after the last journaled chunk
+            fh.truncate(offset)
+            fh.seek(offset)
+            # nothing to download - the file is empty, or the
+            # interruption happened after the last chunk
+            done = size is not None and offset >= size
+            while not done:
+                response, content = request.http.request(request.uri, headers=dict(
+                    request.headers, range=f'bytes={offset}-{offset + self.download_chunk_size - 1}'
+                ))
+                # an empty file has no bytes to ask for
+                if response.status == 416:
+                    break
+                if response.status not in (200, 206):
+                    raise HttpError(response, content, uri=request.uri)
+                # 200 is the whole file, the range was ignored
+                if response.status == 200:
+                    fh.seek(0)
+                    fh.truncate()
+                    offset = 0
+                fh.write(content)
+                offset += len(content)
+                if 'content-range' in response:
+                    size = int(response['content-range'].rsplit('/', 1)[1])
+                else:
+                    size = offset
+                done = offset >= size
+                # a file of one chunk is just downloaded again, others
+                # are journaled to continue from the last chunk
+                if not done:
+                    self.state.put_transfer(rel_file_path, 'download', file_id_to_download, size,
+                                            file_mtime, offset=offset)
+                logger.info(f"(local) <- (gdrive) downloading file {file_name} - {int(offset / max(1, size) * 100)}%")
         # set file mtime, otherwise it looks newer than on gdrive
-        utime(file_path_local, (file_mtime, file_mtime))
+        utime(part_path, (file_mtime, file_mtime))
+        replace(part_path, file_path_local)
+        self._changed_locally(rel_file_path)
+        self.state.drop_transfer(rel_file_path, 'download')
+        self.state.put(rel_file_path, False, file_id_to_download, file_mtime, size, md5)
+        # it's the gdrive file, so no need to read it to know md5
+        if md5 is not None:
+            self.state.put_hash(rel_file_path, stat(file_path_local), md5)
 # ======== end manipulate gdrive =============
 
     @staticmethod
@@ -810,6 +3118,208 @@ class GdriveSync:
         # user_input will contain only one of these two values
         return True if user_input == 'c' else False
 
+    @staticmethod
+    def _index_by_name(items: list[tuple]) -> tuple[dict[str, tuple], list[tuple]]:
+        """Indexes gdrive files or dirs of one tier by their names
+
+        Args:
+            items (list[tuple]): tuples, starting with a name
+
+        Returns:
+            tuple[dict[str, tuple], list[tuple]]: items by names and
+                        items with repeating names, which didn't get
+                        to the dict
+        """
+        index = {}
+        repeated = []
+        for item in items:
+            if item[0] in index:
+                repeated.append(item)
+            else:
+                index[item[0]] = item
+        return index, repeated
+
+    @staticmethod
+    def _index_tiers(struct: list[OneGDriveTier]|list[OneLocalTier]) -> dict[str, OneGDriveTier|OneLocalTier]:
+        """Indexes tiers by their relative paths. If gdrive has several
+        folders with the same path, the first one is taken
+
+        Args:
+            struct (list[OneGDriveTier] | list[OneLocalTier]): a structure
+
+        Returns:
+            dict[str, OneGDriveTier|OneLocalTier]: tiers by paths
+        """
+        index = {}
+        for tier in struct:
+            index.setdefault(tier.parents, tier)
+        return index
+
+    def _add_tier(self, tier: OneGDriveTier|OneLocalTier) -> None:
+        """Adds a tier to it's structure and the structure index"""
+        if isinstance(tier, OneGDriveTier):
+            self.gdrive_struct.append(tier)
+            self.gdrive_tiers.setdefault(tier.parents, tier)
+        else:
+            self.local_struct.append(tier)
+            self.local_tiers.setdefault(tier.parents, tier)
+
+    @staticmethod
+    def _is_inside(rel_path: str, dirs: set[str]) -> bool:
+        """Checks if a path is one of dirs or lays inside any of them"""
+        while rel_path:
+            if rel_path in dirs:
+                return True
+            rel_path = path.dirname(rel_path)
+        return False
+
+    def _should_create(
+            self,
+            rel_path: str,
+            absent_locally: bool,
+            file_is_dir: bool=False,
+            unchanged: bool=False
+        ) -> bool:
+        """Decides what to do with an object, which exists only on one
+        side - create it on the other side or remove it
+
+        Args:
+            rel_path (str): the object path
+            absent_locally (bool): where absent
+            file_is_dir (bool, optional): the object is dir. Defaults to False.
+            unchanged (bool, optional): the object was synced before and
+                        wasn't changed since then. It means, that it was
+                        deleted on the other side. Only 'mirror' and 'ask'
+                        care, others have the direction set explicitly
+        Returns:
+            True if the object should be created, False if removed
+        """
+        match self.sync_direction:
+            case 'local_to_gdrive':
+                return not absent_locally
+            case 'gdrive_to_local':
+                return absent_locally
+        if unchanged:
+            logger.info(f'{"Directory" if file_is_dir else "File"} {rel_path} was deleted '
+                        f'{"locally" if absent_locally else "on gdrive"} since the last sync')
+            return False
+        if self.sync_direction == 'ask':
+            return self._ask_user_create(rel_path, absent_locally, file_is_dir)
+        # mirror
+        return True
+
+    def _hash_local_files(self) -> None:
+        """Counts md5 of every file in self.local_struct and adds it to
+        the file tuple. Files, unchanged since the last time, aren't read.
+        Others are read in a thread pool - hashlib and reading release
+        the GIL, so threads load all cores and the disk
+        """
+        logger.debug('Hashing local files')
+        started = time()
+        # files to read: (tier, index in tier.files, path, stat)
+        to_hash = []
+        for tier in self.local_struct:
+            for number, (name, mtime, _) in enumerate(tier.files):
+                rel_path = path.join(tier.parents, name)
+                try:
+                    file_stat = stat(path.join(self.local_folder, rel_path))
+                except OSError:
+                    # removed after the walk, no md5 then
+                    continue
+                md5 = self.state.get_hash(rel_path, file_stat)
+                if md5 is None:
+                    to_hash.append((tier, number, rel_path, file_stat))
+                else:
+                    tier.files[number] = (name, mtime, md5)
+        # ==== innder func ====
+        def hash_one(rel_path: str) -> str|None:
+            try:
+                return file_md5(path.join(self.local_folder, rel_path))
+            except OSError as e:
+                logger.error(f'Cant read {rel_path}: {str(e)}')
+                return None
+        # =====================
+        with ThreadPoolExecutor(thread_name_prefix='hash') as pool:
+            hashes = pool.map(hash_one, [rel_path for _, _, rel_path, _ in to_hash])
+            for (tier, number, rel_path, file_stat), md5 in zip(to_hash, hashes):
+                if md5 is None:
+                    continue
+                self.state.put_hash(rel_path, file_stat, md5)
+                name, mtime, _ = tier.files[number]
+                tier.files[number] = (name, mtime, md5)
+        megabytes = sum(file_stat.st_size for _, _, _, file_stat in to_hash) / 1024 / 1024
+        elapsed = time() - started
+        logger.info(f'Hashed {len(to_hash)} local files, {megabytes:.1f} MB in {elapsed:.1f} s'
+                    + (f', {megabytes / elapsed:.1f} MB/s' if elapsed else ''))
+
+    def _local_md5(self, rel_path: str, file_stat: stat_result|None=None) -> str:
+        """returns md5 of a local file. The file is read only if it was
+        changed since the last time
+
+        Args:
+            rel_path (str): path relative to the syncing folder
+            file_stat (stat_result | None, optional): the file stat,
+                        if it's known already
+        """
+        full_path = path.join(self.local_folder, rel_path)
+        if file_stat is None:
+            file_stat = stat(full_path)
+        md5 = self.state.get_hash(rel_path, file_stat)
+        if md5 is None:
+            md5 = file_md5(full_path)
+            self.state.put_hash(rel_path, file_stat, md5)
+        return md5
+
+    def _same_content(self, rel_path: str, size: int|None, md5: str|None, local_md5: str|None=None) -> bool:
+        """checks if a local file has the same content as a gdrive file.
+        Google docs have no size and md5, so they never match
+
+        Args:
+            rel_path (str): path relative to the syncing folder
+            size (int | None): gdrive file size
+            md5 (str | None): gdrive file md5Checksum
+            local_md5 (str | None, optional): local file md5, if
+                        it's counted already
+        """
+        if md5 is None or size is None:
+            return False
+        if local_md5 is not None:
+            return local_md5 == md5
+        file_stat = stat(path.join(self.local_folder, rel_path))
+        # different sizes - different files, no need to read them
+        return file_stat.st_size == size and self._local_md5(rel_path, file_stat) == md5
+
+    def _subtree_unchanged(self, struct: list[OneGDriveTier]|list[OneLocalTier], rel_dir: str) -> bool:
+        """Checks that every object inside a directory was synced
+        before and wasn't changed since then
+
+        Args:
+            struct (list[OneGDriveTier] | list[OneLocalTier]): the structure
+                        where the directory is
+            rel_dir (str): the directory path
+
+        Returns:
+            bool: True if nothing new is inside
+        """
+        is_gdrive = struct is self.gdrive_struct
+        tiers = self.gdrive_tiers if is_gdrive else self.local_tiers
+        dirs_to_visit = [rel_dir]
+        while dirs_to_visit:
+            tier = tiers.get(dirs_to_visit.pop())
+            if tier is None:
+                continue
+            for file in tier.files:
+                # gdrive files are (name, id, mtime, size, md5), local (name, mtime)
+                g_id, mtime = (file[1], file[2]) if is_gdrive else (None, file[1])
+                if not self.state.unchanged_file(path.join(tier.parents, file[0]), mtime, g_id):
+                    return False
+            for dir in tier.dirs:
+                name, g_id = dir if is_gdrive else (dir, None)
+                if not self.state.known_dir(path.join(tier.parents, name), g_id):
+                    return False
+                dirs_to_visit.append(path.join(tier.parents, name))
+        return True
+
     def _compare_flat(
             self,
             one_local: OneLocalTier,
@@ -823,122 +3333,372 @@ class GdriveSync:
             one_gdrive (OneGDriveTier): gdrive directory
         """
         logger.debug(f'Comparing dir {one_local.parents if one_local.parents else "root"}')
-        files_to_delete = {} # for bacth delete
+        # index gdrive files by names. Gdrive allows several files with
+        # the same name in one folder, only the first one is matched, others
+        # are left as absent locally
+        g_files, g_files_left = self._index_by_name(one_gdrive.files)
         # go over all files in a local dir
-        while one_local.files:
-            local_file, local_mtime = one_local.files.pop()
-            # go over all files in a gdrive dir
-            for item in one_gdrive.files:
-                g_name, g_id, g_mtime = item
-                # if the same file name found
-                if g_name == local_file:
-                    # check if the local file is newer
+        for local_file, local_mtime, local_md5 in one_local.files:
+            item = g_files.pop(local_file, None)
+            # if the same file name found
+            if item is not None:
+                g_name, g_id, g_mtime, g_size, g_md5 = item
+                local_rel_file_path = path.join(one_local.parents, local_file)
+                # same files, just remember them as synced
+                if local_mtime == g_mtime:
+                    self.state.put(local_rel_file_path, False, g_id, g_mtime, g_size, g_md5)
+                # the content is the same, only mtimes differ. Happens after
+                # a touch, a restore from backup or because of a clock skew.
+                # No need to transfer anything, set the newer mtime on the other side
+                elif self._same_content(local_rel_file_path, g_size, g_md5, local_md5):
                     if local_mtime > g_mtime:
-                        # if so - update gdrive file
-                        self.update_file(path.join(one_local.parents, local_file), g_id, local_mtime)
-                    # check if a remote file is newer
-                    elif g_mtime > local_mtime:
-                        # download it to the folder, consisting of a root dir of syncing folder
-                        # and it's relative path inside
-                        self.download_file(one_local.parents, g_id)
-                    # remove the processed file from gdrive list
-                    one_gdrive.files.remove(item)
-                    break
+                        self._plan('touch_gdrive', path=local_rel_file_path, g_id=g_id,
+                                   mtime=local_mtime, size=g_size, md5=g_md5)
+                    else:
+                        self._plan('touch_local', path=local_rel_file_path, g_id=g_id,
+                                   mtime=g_mtime, size=g_size, md5=g_md5)
+                # check if the local file is newer
+                elif local_mtime > g_mtime:
+                    # if so - update gdrive file
+                    self._plan('update', path=local_rel_file_path, g_id=g_id, mtime=local_mtime)
+                # check if a remote file is newer
+                elif g_mtime > local_mtime:
+                    # download it to the folder, consisting of a root dir of syncing folder
+                    # and it's relative path inside
+                    self._plan('download', dir=one_local.parents, g_id=g_id, name=g_name,
+                               mtime=g_mtime, size=g_size, md5=g_md5)
             # if a file not found, means it's absent on gdrive
             # thus it should be uploaded if the sync direction is
             # 'local_to_gdrive' or 'mirror' or user clicked 'c'.
-            # if user cliecked 'r' or direction is 'gdrive_to_local' - 
+            # if user cliecked 'r' or direction is 'gdrive_to_local' -
             # deleted locally
             else:
                 local_rel_file_path = path.join(one_local.parents, local_file)
-                # ask for the user input, if True - create a file
-                if self.sync_direction == 'ask':
-                    user_action = self._ask_user_create(local_rel_file_path, absent_locally=False)
-                if (self.sync_direction in ['local_to_gdrive', 'mirror'] or
-                    (self.sync_direction == 'ask' and user_action)):
-                    logger.info(f'Local file {local_rel_file_path} is absent on gdrive')                    
-                    self.upload_file(path.join(one_local.parents, local_file), local_mtime, one_gdrive.gparent)
+                if self._should_create(local_rel_file_path, absent_locally=False,
+                                       unchanged=self.state.unchanged_file(local_rel_file_path, local_mtime)):
+                    logger.info(f'Local file {local_rel_file_path} is absent on gdrive')
+                    self._plan('upload', path=local_rel_file_path, mtime=local_mtime, parent=one_gdrive.gparent)
                 else:
-                    logger.info(f'x(local) deleting local file {local_rel_file_path}')
-                    remove(path.join(self.local_folder, one_local.parents, local_file))
+                    self._plan('delete_local', path=local_rel_file_path)
         # if anything remins in the list of gdrive files, means these files
         # are absent locally and should be deleted on grdive if sync is
         # 'local_to_gdrive'. If direction is'mirror' or 'gdrive_to_local' or
         # 'ask' with user desire to create files, than download it
-        for item in one_gdrive.files:
-            g_name, g_id, g_mtime = item
+        for item in list(g_files.values()) + g_files_left:
+            g_name, g_id, g_mtime, g_size, g_md5 = item
             gdrive_rel_file_path = path.join(one_gdrive.parents, g_name)
-            # ask for the user input, if True - create a file
-            if self.sync_direction == 'ask':
-                user_action = self._ask_user_create(gdrive_rel_file_path, absent_locally=True)
-            if (self.sync_direction in ['gdrive_to_local', 'mirror'] or
-                (self.sync_direction == 'ask' and user_action)):
+            if self._should_create(gdrive_rel_file_path, absent_locally=True,
+                                   unchanged=self.state.unchanged_file(gdrive_rel_file_path, g_mtime, g_id)):
                 logger.info(f'File {gdrive_rel_file_path} is absent locally')
                 # download newer file
-                self.download_file(one_gdrive.parents, g_id)
+                self._plan('download', dir=one_gdrive.parents, g_id=g_id, name=g_name,
+                           mtime=g_mtime, size=g_size, md5=g_md5)
             # or delete from gdrive
             else:
-                files_to_delete[g_id] = gdrive_rel_file_path
+                self._plan('delete_gdrive', path=gdrive_rel_file_path, g_id=g_id)
+        g_dirs, g_dirs_left = self._index_by_name(one_gdrive.dirs)
+        # local dirs to be created on gdrive
+        dirs_to_create = []
         # loop over local dirs
-        while one_local.dirs:
-            local_dir = one_local.dirs.pop()
-            # loop over gdrive dirs
-            for item in one_gdrive.dirs:
-                g_name, g_id = item
-                # if directory exists on gdrive and locally
-                # that's good, can stop to search and remove dir
-                if g_name == local_dir:
-                    one_gdrive.dirs.remove(item)
-                    break
+        for local_dir in one_local.dirs:
+            item = g_dirs.pop(local_dir, None)
+            # if directory exists on gdrive and locally
+            # that's good, just remember it
+            if item is not None:
+                self.state.put(path.join(one_local.parents, local_dir), True, item[1])
             # dir exists locally, but not on gdrive
             else:
                 local_rel_dir_path = path.join(one_local.parents, local_dir)
-                # ask for the user input, if True - create a file
-                if self.sync_direction == 'ask':
-                    user_action = self._ask_user_create(local_rel_dir_path, absent_locally=False, file_is_dir=True)
                 # in a case 'local_to_gdrive', 'mirror' or 'ask' with user
                 # desire to create the dir we create a folder of current tier
                 # and the rest will be created later diring common sync process
-                if (self.sync_direction in ['local_to_gdrive', 'mirror'] or
-                    (self.sync_direction == 'ask' and user_action)):
+                unchanged = (self.state.known_dir(local_rel_dir_path) and
+                             self._subtree_unchanged(self.local_struct, local_rel_dir_path))
+                if self._should_create(local_rel_dir_path, absent_locally=False, file_is_dir=True, unchanged=unchanged):
                     logger.info(f'Dir {local_rel_dir_path} is absent on gdrive')
-                    new_folder = self.create_gdrive_folder(local_dir, one_gdrive.gparent)
-                    # new gdrive folder which was created in a process of reflecting
-                    # should be added to the gdrive structure; such thing is necessary
-                    # because inner tiers of local structure can require it to exist
-                    self.gdrive_struct.append(OneGDriveTier(parents=local_rel_dir_path, gparent=new_folder))
-                    # if the reason for this dir to be created is mirror or ask,
-                    # it should be restored locally from gdrive
-                    if self.sync_direction != 'local_to_gdrive':
-                        self.restore_dirs.append(local_rel_dir_path)
+                    dirs_to_create.append(local_dir)
                 # if 'gdrive_to_local' or 'ask' with desire to remove - remove it from local
                 else:
-                    logger.info(f'[x](local) deleting local direcotory tree {local_rel_dir_path}')
-                    rmtree(path.join(self.local_folder, local_rel_dir_path))
+                    self._plan('rmtree', path=local_rel_dir_path)
+        for local_dir in dirs_to_create:
+            local_rel_dir_path = path.join(one_local.parents, local_dir)
+            # new gdrive folder which will be created in a process of reflecting
+            # should be added to the gdrive structure; such thing is necessary
+            # because inner tiers of local structure can require it to exist.
+            # It has no id yet, so it's referred by it's path
+            new_folder = self._plan_gdrive_folder(local_rel_dir_path, one_gdrive.gparent)
+            self._add_tier(OneGDriveTier(parents=local_rel_dir_path, gparent=new_folder))
+            # if the reason for this dir to be created is mirror or ask,
+            # it should be restored locally from gdrive
+            if self.sync_direction != 'local_to_gdrive':
+                self.restore_dirs.add(local_rel_dir_path)
         # deal with remaining gdrive dirs
-        while one_gdrive.dirs:
-            g_name, g_id = one_gdrive.dirs.pop()
+        for g_name, g_id in list(g_dirs.values()) + g_dirs_left:
             # if 'local_to_gdrive' or 'ask' with user desire to delete
             # delete those dirs on gdrive
-            gdrive_rel_dir_path = path.join(one_gdrive.parents, g_name)  
-            # ask for the user input, if True - create a file
-            if self.sync_direction == 'ask':
-                user_action = self._ask_user_create(gdrive_rel_dir_path, absent_locally=True, file_is_dir=True) 
-            if (self.sync_direction == 'local_to_gdrive' or
-                (self.sync_direction == 'ask' and not user_action)):
-                files_to_delete[g_id] = gdrive_rel_dir_path
+            gdrive_rel_dir_path = path.join(one_gdrive.parents, g_name)
+            unchanged = (self.state.known_dir(gdrive_rel_dir_path, g_id) and
+                         self._subtree_unchanged(self.gdrive_struct, gdrive_rel_dir_path))
+            if not self._should_create(gdrive_rel_dir_path, absent_locally=True, file_is_dir=True, unchanged=unchanged):
+                self._plan('delete_gdrive', path=gdrive_rel_dir_path, g_id=g_id)
             # dir should be created locally
             else:
-                logger.info(f'[+](local) directory {gdrive_rel_dir_path} is absent locally, creating')
-                mkdir(path.join(self.local_folder, one_gdrive.parents, g_name))
-                self.local_struct.append(OneLocalTier(path.join(one_gdrive.parents, g_name)))
-        # delete all objects marked for this
-        if files_to_delete:
-            self.batch_delete_files(files_to_delete)
+                logger.info(f'[+](local) directory {gdrive_rel_dir_path} is absent locally')
+                self._plan('mkdir_local', path=gdrive_rel_dir_path, g_id=g_id)
+                self._add_tier(OneLocalTier(path.join(one_gdrive.parents, g_name)))
         logger.debug(f'Finished to compare tier {one_local.parents}')
 
     def sync(self) -> None:
-        """Syncs the local and gdrive directory
+        """Syncs the local and gdrive directory. Running transfers
+        are awaited in any case, even if the sync was interrupted
+        by an error
+        """
+        self.metrics.reset()
+        self.metrics.startup()
+        try:
+            try:
+                # an interrupted sync leaves it's plan, the next try
+                # continues it instead of scanning both sides again
+                if self._resume_plan():
+                    self.metrics.start('transfers')
+                    self._execute_plan()
+                # the plan is performed while it's made, see _flush_plan
+                else:
+                    self._sync()
+            except Exception:
+                # let running transfers finish, so no half written files left
+                self.transfers.wait(raise_errors=False)
+                raise
+            self.transfers.wait()
+            self.metrics.stop('transfers')
+            # what wasn't met during the sync doesn't exist on both sides
+            self.state.prune()
+            if self.page_token is not None:
+                self.state.set_meta('page_token', self.page_token)
+            self.state.drop_plan()
+            # the freshest knowledge of gdrive dirs for sync_partial
+            self.state.drop_dir_ids(self.gdrive_folder)
+            dir_ids = {
+                path.normpath(path.join(self.gdrive_folder, row['rel_path'])): row['g_id']
+                for row in self.state.entries() if row['is_dir']
+            }
+            dir_ids[self.gdrive_folder] = self.state.get_meta('root_id')
+            self.state.put_dir_ids(dir_ids)
+        finally:
+            # remember the synced part even if the sync was interrupted
+            self.state.commit()
+            self._report('sync')
+        logger.debug(f'Finish syncing')
+
+    def _report(self, title: str) -> None:
+        """logs the metrics of the run and appends them to the metrics file"""
+        logger.info(self.metrics.summary(title))
+        if self.metrics_file:
+            self.metrics.dump(self.metrics_file, title)
+
+    def _plan(self, op: str, **params) -> None:
+        """adds an operation to self.plan, see _execute_ops"""
+        self.plan.append({'op': op, **params})
+
+    def _plan_gdrive_folder(self, rel_path: str, parent: str) -> str:
+        """plans creation of a gdrive folder. Returns a reference
+        to be used instead of it's id in the plan
+        """
+        self._plan('mkdir_gdrive', path=rel_path, parent=parent)
+        return f'@{rel_path}'
+
+    def _resume_plan(self) -> bool:
+        """Takes the plan of an interrupted sync, if there is one,
+        it's fresh and was made for the same sync direction
+
+        Returns:
+            bool: True if there is a plan to continue
+        """
+        plan_meta = self.state.get_meta('plan')
+        if plan_meta is None:
+            return False
+        plan_meta = json.loads(plan_meta)
+        if plan_meta['sync_direction'] != self.sync_direction or time() - plan_meta['time'] > PLAN_MAX_AGE:
+            logger.info('The plan of an interrupted sync is outdated, starting over')
+            self.state.drop_plan()
+            return False
+        logger.info('Continuing an interrupted sync')
+        self.page_token = plan_meta['page_token']
+        return True
+
+    def _flush_plan(self, complete: bool=False) -> None:
+        """Journals the operations, planned since the last call, and
+        performs them. Transfers are put to self.transfers, not awaited
+
+        Args:
+            complete (bool, optional): nothing more will be planned. Only
+                        a complete plan is continued by the next try, if
+                        this one is interrupted, otherwise it starts over
+        """
+        first = self._flushed
+        ops = self.plan[first:]
+        self._flushed = len(self.plan)
+        self.state.add_plan(ops, first, {
+            'time': time(),
+            'sync_direction': self.sync_direction,
+            'page_token': self.page_token
+        } if complete else None)
+        if not ops:
+            return
+        if not first:
+            # how long the run waits for anything to happen
+            self.metrics.add_time('first change', time() - self.metrics.started)
+            self.metrics.start('transfers')
+        self._execute_ops(list(enumerate(ops, first)), self._refs)
+
+    def _execute_plan(self) -> None:
+        """Performs the stored plan. Operations, done by an interrupted
+        try, are skipped
+        """
+        # ids of created gdrive folders by their references
+        refs = {}
+        todo = []
+        for seq, op, done, result in self.state.get_plan():
+            if not done:
+                todo.append((seq, op))
+            elif op['op'] == 'mkdir_gdrive':
+                refs[f'@{op["path"]}'] = result
+        logger.debug(f'{len(todo)} operations to perform')
+        self._execute_ops(todo, refs)
+
+    def _execute_ops(self, todo: list[tuple[int, dict]], refs: dict[str, str]) -> None:
+        """Performs operations of the plan. Every operation is journaled
+        as soon as it's done, transfers are put to self.transfers.
+        The plan consists of dicts with the operation name in 'op':
+            upload - path, mtime, parent
+            update - path, g_id, mtime
+            download - dir, g_id, name, mtime, size, md5
+            touch_gdrive, touch_local - path, g_id, mtime, size, md5
+            delete_gdrive - path, g_id
+            mkdir_gdrive - path, parent
+            delete_local, rmtree - path
+            mkdir_local - path, g_id
+        Gdrive folders, which don't exist while planning, are referred
+        by '@' and their path instead of id
+
+        Args:
+            todo (list[tuple[int, dict]]): operations with their numbers
+            refs (dict[str, str]): ids of created gdrive folders by
+                        their references, new ones are added
+        """
+        # consecutive operations of one kind are done together
+        # if gdrive allows it
+        for kind, group in groupby(todo, key=lambda item: item[1]['op']):
+            group = list(group)
+            if kind == 'mkdir_gdrive':
+                # a folder can be created only after it's parent,
+                # all folders of one level are created at once
+                by_level = sorted(group, key=lambda item: item[1]['path'].count(os_sep))
+                for _, level in groupby(by_level, key=lambda item: item[1]['path'].count(os_sep)):
+                    level = list(level)
+                    new_folders = self.create_gdrive_folders([
+                        (path.basename(op['path']), refs.get(op['parent'], op['parent'])) for _, op in level
+                    ])
+                    for (seq, op), new_folder in zip(level, new_folders):
+                        refs[f'@{op["path"]}'] = new_folder
+                        self.state.put(op['path'], True, new_folder)
+                        self.state.finish_op(seq, new_folder)
+            elif kind == 'delete_gdrive':
+                self.batch_delete_files({op['g_id']: op['path'] for _, op in group})
+                for seq, _ in group:
+                    self.state.finish_op(seq)
+            elif kind == 'touch_gdrive':
+                self.batch_set_mtime([(op['g_id'], op['mtime'], op['path']) for _, op in group])
+                for seq, op in group:
+                    self.state.put(op['path'], False, op['g_id'], op['mtime'], op['size'], op['md5'])
+                    self.state.finish_op(seq)
+            else:
+                for seq, op in group:
+                    self._execute_op(seq, op, refs)
+
+    def _execute_op(self, seq: int, op: dict, refs: dict[str, str]) -> None:
+        """Performs one operation of the plan, see _execute_ops
+
+        Args:
+            seq (int): number of the operation in the plan
+            op (dict): the operation
+            refs (dict[str, str]): ids of created gdrive folders
+                        by their references
+        """
+        kind = op['op']
+        if kind == 'upload':
+            self.transfers.submit(f'uploading {op["path"]}', self._finish_after, seq, self.upload_file,
+                                  op['path'], op['mtime'], refs.get(op['parent'], op['parent']))
+        elif kind == 'update':
+            self.transfers.submit(f'updating {op["path"]}', self._finish_after, seq, self.update_file,
+                                  op['path'], op['g_id'], op['mtime'])
+        elif kind == 'download':
+            self.transfers.submit(f'downloading {path.join(op["dir"], op["name"])}', self._finish_after, seq,
+                                  self.download_file, op['dir'], op['g_id'], op['name'], op['mtime'],
+                                  op['size'], op['md5'])
+        elif kind == 'delete_local':
+            logger.info(f'x(local) deleting local file {op["path"]}')
+            # it may be gone already, if the operation was interrupted
+            if path.isfile(path.join(self.local_folder, op['path'])):
+                remove(path.join(self.local_folder, op['path']))
+            self._changed_locally(op['path'])
+            self.state.remove(op['path'])
+            self.state.finish_op(seq)
+        elif kind == 'rmtree':
+            logger.info(f'[x](local) deleting local direcotory tree {op["path"]}')
+            if path.isdir(path.join(self.local_folder, op['path'])):
+                rmtree(path.join(self.local_folder, op['path']))
+            self._changed_locally(op['path'], tree=True)
+            self.state.remove(op['path'])
+            self.state.finish_op(seq)
+        elif kind == 'touch_local':
+            logger.info(f'(local) setting modification time of {op["path"]}')
+            utime(path.join(self.local_folder, op['path']), (op['mtime'], op['mtime']))
+            self._changed_locally(op['path'])
+            self.state.put(op['path'], False, op['g_id'], op['mtime'], op['size'], op['md5'])
+            self.state.finish_op(seq)
+        elif kind == 'mkdir_local':
+            logger.info(f'[+](local) creating directory {op["path"]}')
+            if not path.isdir(path.join(self.local_folder, op['path'])):
+                mkdir(path.join(self.local_folder, op['path']))
+            self._changed_locally(op['path'])
+            self.state.put(op['path'], True, op['g_id'])
+            self.state.finish_op(seq)
+        else:
+            raise ValueError(f'Unknown operation {kind}')
+
+    def _changed_locally(self, rel_path: str, tree: bool=False) -> None:
+        """Remembers a local change made by the sync itself, so the
+        watch mode doesn't send it back to gdrive
+
+        Args:
+            rel_path (str): the changed object's relative path
+            tree (bool, optional): the directory tree is deleted
+        """
+        if self._watcher is not None:
+            (self._own_removed_dirs if tree else self._own_changes).add(rel_path)
+
+    def _own_event(self, event: tuple) -> bool:
+        """Checks if a watcher event comes from the sync's own
+        changes, see _changed_locally
+        """
+        if event[0] == 'overflow':
+            return False
+        paths = event[1:3] if event[0] == 'moved' else event[1:2]
+        return all(
+            rel_path in self._own_changes or self._is_inside(rel_path, self._own_removed_dirs)
+            for rel_path in paths
+        )
+
+    def _finish_after(self, seq: int, func, *args) -> None:
+        """calls a transfer function and journals the operation as done"""
+        func(*args)
+        self.state.finish_op(seq)
+
+    def _sync(self) -> None:
+        """Compares the local and gdrive directory and makes a plan
+        to reflect the differences in self.plan. The plan is performed
+        as it's made, see _flush_plan
         """
         # --------------- innder func ----------------
         def tier_maker(
@@ -966,43 +3726,89 @@ class GdriveSync:
             logger.error('A combination of "create folder" and sync "gdrive to local" is not supported! '
                   'It will destroy all data in the local folder')
             raise ValueError('"create folder" with sync "gdrive to local" is not supported!')
+        # the watch mode syncs several times with one object
+        self.gdrive_struct, self.local_struct = [], []
+        self.gdrive_tiers, self.local_tiers = {}, {}
+        self.restore_dirs = set()
+        self.plan = []
+        self._flushed = 0
+        self._refs = {}
+        # what an interrupted try could leave, if it's plan wasn't complete
+        self.state.drop_plan()
+        self.page_token = None
+        # in the watch mode, local changes made till now are seen by
+        # the walk, so their events are dropped
+        if self._watcher is not None:
+            while self._watcher.read(0):
+                pass
         # gen local structure
-        self._iterate_localdir()
+        with self.metrics.phase('local walk'):
+            self._iterate_localdir()
+        self.metrics.start('remote walk')
         exists, self.gdrive_folder_id = self._search_sync_dir(self.gdrive_folder, vault_dir=True)
         # a flag to make a new folder on gdrive instead of
         # searching the existing one to sync with
         if self.create_folder and exists:
             parent_dir = self._get_folder_parent(self.gdrive_folder_id)
-            self.gdrive_folder = f'{path.basename(self.gdrive_folder)}_{str(int(time()))}'
-            self.gdrive_folder_id = self.create_gdrive_folder(self.gdrive_folder, parent_dir)
+            new_folder = f'{path.basename(self.gdrive_folder)}_{str(int(time()))}'
+            self.gdrive_folder = path.join(path.dirname(self.gdrive_folder), new_folder)
+            self.gdrive_folder_id = self.create_gdrive_folder(new_folder, parent_dir)
+        # the sync state makes sense only for the same gdrive directory
+        self.state.begin_run(self.gdrive_folder_id)
         # get the gdrive structure
-        self._iterate_gdrive(self.gdrive_folder_id)
-        # remove ignored files
-        self._exclude_ignored()
-        # depending on the sync direction, we'll be going over
-        # local structure or gdrive structure and match the other
-        if self.sync_direction == 'local_to_gdrive':
-            struct_to_go, struct_to_match = self.local_struct, self.gdrive_struct
+        changes = False
+        if self.delta and self.state.get_meta('page_token'):
+            self.page_token = self._iterate_gdrive_changes(self.state.get_meta('page_token'))
+            changes = self.page_token is not None
+        # changes made from this moment are seen by the next sync
+        if self.delta and not changes:
+            self.page_token = self._get_start_page_token()
+        self.local_tiers = self._index_tiers(self.local_struct)
+        struct_to_match = self.gdrive_struct if self.sync_direction == 'local_to_gdrive' else self.local_struct
+        # the whole listing is a number of round-trips, growing with the
+        # depth of the tree. Instead of waiting for it, folders are compared
+        # as soon as they are listed, and transfers go on while deeper ones
+        # are still being listed. 'ask' lists everything first, so all the
+        # questions come before any change
+        if not changes and self.sync_direction != 'ask':
+            self.metrics.stop('remote walk')
+            matched = self._stream_gdrive(self.gdrive_folder_id)
+            self.metrics.start('comparison')
         else:
-            struct_to_go, struct_to_match = self.gdrive_struct, self.local_struct
-        tiers = tier_maker(struct_to_go)
-        # go from the top (root) tier to the bottom
-        # it will help to cut off unnecessary brancehs
-        for item in sorted(tiers.keys()): # loop over tiers starting on top
-            for elem in tiers[item]: # loop over every dir on this tier
-                for inner_item in struct_to_match: # loop inner folders
-                    # when inner folder will be found (and it will be found
-                    # if no errors happened, because any absent folder will be created
-                    # with the processing of the previous tier)
-                    if elem.parents == inner_item.parents:
-                        # reflect local structure to the grdive structure
-                        if self.sync_direction == 'local_to_gdrive':
-                            self._compare_flat(elem, inner_item)
-                        else:
-                            self._compare_flat(inner_item, elem)
-                        # delete the processed inner element, so less loops in a future
-                        struct_to_match.remove(inner_item)
-                        break
+            if not changes:
+                self._iterate_gdrive(self.gdrive_folder_id)
+            self.metrics.stop('remote walk')
+            if self.hash_local:
+                with self.metrics.phase('hashing'):
+                    self._hash_local_files()
+            self.metrics.start('comparison')
+            # depending on the sync direction, we'll be going over
+            # local structure or gdrive structure and match the other
+            self.gdrive_tiers = self._index_tiers(self.gdrive_struct)
+            if self.sync_direction == 'local_to_gdrive':
+                struct_to_go, tiers_to_match = self.local_struct, self.gdrive_tiers
+            else:
+                struct_to_go, tiers_to_match = self.gdrive_struct, self.local_tiers
+            tiers = tier_maker(struct_to_go)
+            # paths of processed tiers. If gdrive has two folders with the same
+            # path, only the first one is compared
+            matched = set()
+            # go from the top (root) tier to the bottom
+            # it will help to cut off unnecessary brancehs
+            for item in sorted(tiers.keys()): # loop over tiers starting on top
+                for elem in tiers[item]: # loop over every dir on this tier
+                    # the inner folder will be found if no errors happened, because
+                    # any absent folder will be created with the processing of
+                    # the previous tier
+                    inner_item = tiers_to_match.get(elem.parents)
+                    if inner_item is None or elem.parents in matched:
+                        continue
+                    matched.add(elem.parents)
+                    # reflect local structure to the grdive structure
+                    if self.sync_direction == 'local_to_gdrive':
+                        self._compare_flat(elem, inner_item)
+                    else:
+                        self._compare_flat(inner_item, elem)
         # download/upload remaining folders
         # likely there are none, it's rather rare
         # --------------------------------------
@@ -1013,14 +3819,11 @@ class GdriveSync:
         # instead of erasing. Otherwise, we should upload
         # a folder instead of erasing
         if self.restore_dirs:
-            struct_for_restore = []
-            # filter those to restore
-            # deleted objects aren't filtered out from struct_to_match
-            # thus we filter now those which have to be reconstructed
-            for item in struct_to_match:
-                for rel_path in self.restore_dirs:
-                    if rel_path in item.parents:
-                        struct_for_restore.append(item)
+            # filter those to restore among not processed ones
+            struct_for_restore = [
+                item for item in struct_to_match
+                if item.parents not in matched and self._is_inside(item.parents, self.restore_dirs)
+            ]
             # split the new structure to tires
             tiers = tier_maker(struct_for_restore)
             # loop over every tier and every element in it
@@ -1030,10 +3833,8 @@ class GdriveSync:
                     logger.info(f'Restoring dir structure {elem.parents}')
                     # have to find a parent dir first.
                     # if there were no issues before, it has to exist
-                    for dir in self.gdrive_struct:
-                        if dir.parents == elem.parents:
-                            parent_dir_id = dir.gparent
-                            break
+                    if elem.parents in self.gdrive_tiers:
+                        parent_dir_id = self.gdrive_tiers[elem.parents].gparent
                     # unlikely there is no parent dir id, but juste in case this check
                     else:
                         logger.error(f'Parent directory ID is absent for {elem.parents}, this should not happen!')
@@ -1043,14 +3844,135 @@ class GdriveSync:
                         if self.sync_direction == 'ask':
                             if not self._ask_user_create(path.join(elem.parents, file[0]), absent_locally=False, file_is_dir=False):
                                 continue
-                        self.upload_file(path.join(elem.parents, file[0],), file[1], parent_dir_id)
-                    for dir in elem.dirs:                        # ask for the user input, if True - create a file
+                        self._plan('upload', path=path.join(elem.parents, file[0]), mtime=file[1], parent=parent_dir_id)
+                    for dir in elem.dirs:
+                        # ask for the user input, if True - create a file
                         if self.sync_direction == 'ask':
                             if not self._ask_user_create(path.join(elem.parents, dir), absent_locally=False, file_is_dir=True):
                                 continue
-                        new_folder = self.create_gdrive_folder(dir, parent_dir_id)
-                        self.gdrive_struct.append(OneGDriveTier(parents=path.join(elem.parents, dir), gparent=new_folder))
-        logger.debug(f'Finish syncing')
+                        new_folder = self._plan_gdrive_folder(path.join(elem.parents, dir), parent_dir_id)
+                        self._add_tier(OneGDriveTier(parents=path.join(elem.parents, dir), gparent=new_folder))
+        self.metrics.stop('comparison')
+        self._flush_plan(complete=True)
+
+    def _stream_gdrive(self, folder_id: str) -> set[str]:
+        """Lists the gdrive structure in another thread and compares
+        every listed folder with the local one at once, while deeper
+        folders are still being listed. Planned operations are performed
+        right away, see _flush_plan
+
+        Args:
+            folder_id (str): id of the gdrive folder to sync with
+
+        Returns:
+            set[str]: paths of compared folders
+        """
+        # listed chunks of folders, then None or an error of the listing
+        listed = Queue()
+        stop = Event()
+        # the listing has it's own threads, not to wait behind transfers
+        lister = TransferPool(self.max_listers)
+        # --------------- innder func ----------------
+        def pass_on(chunk: list[OneGDriveTier]) -> bool:
+            listed.put(chunk)
+            return not stop.is_set()
+
+        def list_gdrive() -> None:
+            try:
+                with self.metrics.phase('remote walk'):
+                    self._iterate_gdrive(folder_id, listed=pass_on, pool=lister)
+            except Exception as e:
+                listed.put(e)
+            else:
+                listed.put(None)
+            finally:
+                lister.close()
+        # ----------- end innder func ----------------
+        thread = Thread(target=list_gdrive, name='list', daemon=True)
+        thread.start()
+        try:
+            # local files are hashed meanwhile
+            if self.hash_local:
+                with self.metrics.phase('hashing'):
+                    self._hash_local_files()
+            matched = set()
+            # folders to compare, when the whole structure is known
+            postponed = {}
+            while (chunk := listed.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                started = perf_counter()
+                for tier in chunk:
+                    self._add_tier(tier)
+                self._compare_listed(chunk, matched, postponed)
+                self.metrics.add_time('comparison', perf_counter() - started)
+                self._flush_plan()
+            if postponed:
+                logger.debug(f'Comparing {len(postponed)} postponed dirs')
+                started = perf_counter()
+                self._compare_listed(list(postponed.values()), matched)
+                self.metrics.add_time('comparison', perf_counter() - started)
+        finally:
+            # if the comparison failed, the listing isn't needed anymore
+            stop.set()
+            thread.join()
+        return matched
+
+    def _compare_listed(
+            self,
+            listed: list[OneGDriveTier],
+            matched: set[str],
+            postponed: dict[str, OneGDriveTier]|None=None
+        ) -> None:
+        """Compares listed gdrive folders with the local ones, see
+        _stream_gdrive. Their parents have to be listed already
+
+        Args:
+            listed (list[OneGDriveTier]): gdrive folders
+            matched (set[str]): paths of compared folders, new ones are added
+            postponed (dict[str, OneGDriveTier] | None, optional): folders,
+                        which can't be compared till the whole gdrive
+                        structure is known, are added here by their paths.
+                        None, if it's known already
+        """
+        to_compare = deque(listed)
+        while to_compare:
+            one_gdrive = to_compare.popleft()
+            # only the first of gdrive folders with the same path is compared
+            if one_gdrive.parents in matched or (postponed is not None and one_gdrive.parents in postponed):
+                continue
+            one_local = self.local_tiers.get(one_gdrive.parents)
+            if one_local is None:
+                # there is no local folder, unless the parent creates it
+                if postponed is not None and path.dirname(one_gdrive.parents) in postponed:
+                    postponed[one_gdrive.parents] = one_gdrive
+                continue
+            if postponed is not None and self._needs_subtrees(one_local, one_gdrive):
+                postponed[one_gdrive.parents] = one_gdrive
+                continue
+            matched.add(one_gdrive.parents)
+            created = len(self.gdrive_struct)
+            self._compare_flat(one_local, one_gdrive)
+            # local dirs, absent on gdrive, got new gdrive folders. Nothing
+            # is to be listed inside, so they are compared right away
+            if self.sync_direction == 'local_to_gdrive':
+                to_compare.extend(self.gdrive_struct[created:])
+
+    def _needs_subtrees(self, one_local: OneLocalTier, one_gdrive: OneGDriveTier) -> bool:
+        """Tells if comparing two folders needs the whole gdrive structure
+        inside some of their subfolders. It's so for 'mirror' and 'ask',
+        when a subfolder, synced before, exists only on gdrive: it's
+        deleted, if nothing new is inside, see _subtree_unchanged
+        """
+        if self.sync_direction not in ('mirror', 'ask'):
+            return False
+        g_dirs, g_dirs_left = self._index_by_name(one_gdrive.dirs)
+        for local_dir in one_local.dirs:
+            g_dirs.pop(local_dir, None)
+        return any(
+            self.state.known_dir(path.join(one_gdrive.parents, g_name), g_id)
+            for g_name, g_id in list(g_dirs.values()) + g_dirs_left
+        )
 
     def sync_partial(self, actions_json: str) -> None:
         """Applies to gdrive accumulated partial updates.
@@ -1072,15 +3994,26 @@ class GdriveSync:
         """
         # if there will be an error, it will be caught in __main__
         actions = json.loads(actions_json)
+        self.metrics.reset()
+        self.metrics.startup()
         # we won't do any optimisations like for full sync, because
-        # actions is assumed to be relatively small, a few files in average
+        # actions is assumed to be relatively small, a few files in average.
+        # Still, lookups and metadata changes are made in batches, so
+        # every kind of action costs a few requests regardless it's size
 
         # get the existing gdrive directory or create a new one.
         # in theory it makes not much sense, but may be usable
         # for newly created Vault
 
-        # going to also save gdrive found dir ids to prevent unnecessary requests
-        gdrive_dir_id_cache = {}
+        # gdrive dir ids are remembered between runs to prevent unnecessary
+        # requests. A remembered id is checked before it's dir or
+        # anything in it is used, see _verify_dirs
+        gdrive_dir_id_cache = self.state.get_dir_ids(self.gdrive_folder)
+        # a warm process doesn't check the same dirs on every update
+        self._unverified_dirs = {
+            gdrive_path for gdrive_path in gdrive_dir_id_cache
+            if monotonic() - self._verified_dirs.get(gdrive_path, -DIR_VERIFY_INTERVAL) >= DIR_VERIFY_INTERVAL
+        }
         exists, self.gdrive_folder_id = self._search_sync_dir(
             self.gdrive_folder,
             gdrive_dir_id_cache=gdrive_dir_id_cache,
@@ -1088,77 +4021,65 @@ class GdriveSync:
         )
         # first makes sense to create dirs
         if 'create_dir' in actions:
-            for dir in actions['create_dir']:
-                self._search_sync_dir(path.join(self.gdrive_folder, dir), gdrive_dir_id_cache=gdrive_dir_id_cache)
+            dir_paths = [path.normpath(path.join(self.gdrive_folder, dir)) for dir in actions['create_dir']]
+            self._resolve_dirs(dir_paths, gdrive_dir_id_cache)
+            # remembered dirs could be deleted on gdrive, make them again
+            if self._verify_dirs(dir_paths, gdrive_dir_id_cache):
+                self._resolve_dirs(dir_paths, gdrive_dir_id_cache)
         # now - delete dirs
         if 'delete_dir' in actions:
-            for dir in actions['delete_dir']:
-                # search directory on gdrive, don't create if absent
-                exists, dir_id = self._search_sync_dir(
-                    path.join(self.gdrive_folder, dir),
-                    gdrive_dir_id_cache=gdrive_dir_id_cache,
-                    dont_create_chain=True
-                )
-                # if the directory exists at all
-                if exists:
-                    # delete on gdrive
-                    self.delete_file_or_folder(dir_id, dir)
-                    # delete this exact dir from "cache" and all other dirs
-                    # which lay inside the one which will be deleted
-                    gdrive_dir_id_cache = { k: v for k, v in gdrive_dir_id_cache.items() if not dir in k }
+            # search directories on gdrive, don't create if absent
+            dir_paths = {dir: path.normpath(path.join(self.gdrive_folder, dir)) for dir in actions['delete_dir']}
+            self._resolve_dirs(list(dir_paths.values()), gdrive_dir_id_cache, create=False)
+            # a remembered id may belong to a dir, which is moved elsewhere
+            if self._verify_dirs(list(dir_paths.values()), gdrive_dir_id_cache):
+                self._resolve_dirs(list(dir_paths.values()), gdrive_dir_id_cache, create=False)
+            # if the directory exists at all - delete on gdrive
+            dirs_to_del = {
+                gdrive_dir_id_cache[gdrive_path]: dir for dir, gdrive_path in dir_paths.items()
+                if gdrive_path in gdrive_dir_id_cache
+            }
+            self.batch_delete_files(dirs_to_del)
+            for dir in dirs_to_del.values():
+                # forget this exact dir and all dirs inside it
+                self._forget_dirs(dir_paths[dir], gdrive_dir_id_cache)
         # now delete files. Those which remain after the directory deletion
         # we are going to accumulate them to batch delete
         if 'delete_file' in actions:
             files_to_del = {}
-            for file in actions['delete_file']:
-                # search a directory on gdrive, which contains
-                # the file. Don't create the dir if absent
-                exists, dir_id = self._search_sync_dir(
-                    path.join(self.gdrive_folder, path.dirname(file)),
-                    gdrive_dir_id_cache=gdrive_dir_id_cache,
-                    dont_create_chain=True
-                )
-                # if the directory exists, look for a file
-                if exists:
-                    file_id = self.search_by_name(path.basename(file), dir_id, 'file')
-                    # if file exists, add it to the del list
-                    if file_id:
-                        if len(file_id) > 1:
-                            logger.info(f'(gdrive) !!! warning, found several files {file} on gdrive')
-                        files_to_del[file] = file_id[0]
+            # don't create dirs if absent
+            found = self._find_files(actions['delete_file'], 'file', gdrive_dir_id_cache, create_dirs=False)
+            for file, (_, file_ids) in found.items():
+                # if file exists, add it to the del list
+                if file_ids:
+                    files_to_del[file_ids[0]] = file
             # del files
             self.batch_delete_files(files_to_del)
         # move existing files/dirs
         if 'move' in actions:
-            for file in actions['move']:
-                # search a directory on gdrive, which contains
-                # the file. Don't create the dir if absent
-                old_exists, old_dir_id = self._search_sync_dir(
-                    path.join(self.gdrive_folder, path.dirname(file)),
-                    gdrive_dir_id_cache=gdrive_dir_id_cache,
-                    dont_create_chain=True
-                )
-                # init the var
-                file_id = None;
-                # if the directory exists, look for a file/dir
-                if old_exists:
-                    file_id = self.search_by_name(path.basename(file), old_dir_id, 'any')
-                # get new parent id create the dir if absent
-                _, new_dir_id = self._search_sync_dir(
-                    path.join(self.gdrive_folder, path.dirname(actions['move'][file])),
-                    gdrive_dir_id_cache=gdrive_dir_id_cache
-                )    
+            # look for files/dirs where they were. Don't create dirs if absent
+            found = self._find_files(list(actions['move']), 'any', gdrive_dir_id_cache, create_dirs=False)
+            # get new parent ids, create dirs if absent
+            new_parents = [self._gdrive_parent_path(new_path) for new_path in actions['move'].values()]
+            self._resolve_dirs(new_parents, gdrive_dir_id_cache)
+            if self._verify_dirs(new_parents, gdrive_dir_id_cache):
+                self._resolve_dirs(new_parents, gdrive_dir_id_cache)
+            moves = []
+            for file, new_path in actions['move'].items():
+                # dirs inside a moved one are remembered by old paths
+                self._forget_dirs(path.normpath(path.join(self.gdrive_folder, file)), gdrive_dir_id_cache)
+                new_dir_id = gdrive_dir_id_cache[self._gdrive_parent_path(new_path)]
+                _, file_ids = found[file]
                 # if file/dir exists, move it, otherwise upload from the pc
-                if file_id is not None:    
-                    if len(file_id) > 1:
-                        logger.info(f'(gdrive) !!! warning, found several files {file} on gdrive')                
-                    self.move_file_or_folder(file_id[0], new_dir_id, file, actions['move'][file])
+                if file_ids:
+                    moves.append((file_ids[0], new_dir_id, file, new_path))
+                # now upload depending what is it - a dir or a file.
+                # it's already in it's new place locally
+                elif path.isdir(path.join(self.local_folder, new_path)):
+                    self.upload_folder(new_path, new_dir_id)
                 else:
-                    # now upload depending what is it - a dir or a file
-                    if path.isdir(path.join(self.local_folder, file)):
-                        self.upload_folder(file, new_dir_id)
-                    else:
-                        self.upload_file(file, parent=new_dir_id)       
+                    self.upload_file(new_path, parent=new_dir_id)
+            self.batch_move(moves)
         # now create or update files. Gdrive allows to have files
         # with same names in one directory, but pc filesystems usually
         # don't. So we'll be looking even for "create" files and update
@@ -1171,37 +4092,506 @@ class GdriveSync:
         # rename can be applied to both - files and dirs and
         # contains a dict instead of a list where keys - old names
         # and values - new names
-        for_rename = []
+        for_rename = set()
         if 'rename' in actions and isinstance(actions['rename'], dict):
             # save it for easier checks
-            for_rename = list(actions['rename'].keys())
-            create_update_files += for_rename
-        for file in create_update_files:
-            # search a directory on gdrive, which contains
-            # the file. Create the dir if absent, though it
-            # should be already created before
-            exists, dir_id = self._search_sync_dir(
-                path.join(self.gdrive_folder, path.dirname(file)),
-                gdrive_dir_id_cache=gdrive_dir_id_cache
-            )
-            # look for a file
-            file_id = self.search_by_name(path.basename(file), dir_id, 'any')
+            for_rename = set(actions['rename'].keys())
+            create_update_files += list(for_rename)
+        # search directories on gdrive, which contain the files. Create
+        # dirs if absent, though they should be already created before
+        found = self._find_files(create_update_files, 'any', gdrive_dir_id_cache, create_dirs=True)
+        renames = []
+        for file, (dir_id, file_ids) in found.items():
             # if file exists - update or rename it.
             # we take the 0-th item assuming there shouldn't be more with the same name
             # we also don't check if this file isn't newer than the existing one, we got 
             # the request to upload/rename and we do it
-            if file_id:
-                if len(file_id) > 1:
-                    logger.info(f'(gdrive) !!! warning, found several files {file} on gdrive')
+            if file_ids:
                 # check what to do - update or rename
                 if file in for_rename:
-                    self.rename_file_or_folder(file_id[0], actions['rename'][file], file)
+                    renames.append((file_ids[0], actions['rename'][file], file))
+                    self._forget_dirs(path.normpath(path.join(self.gdrive_folder, file)), gdrive_dir_id_cache)
+                else:
+                    self.update_file(file, file_ids[0])
+            # otherwise - upload. A renamed object exists locally by it's new name only
+            elif file in for_rename:
+                new_path = path.join(path.dirname(file), path.basename(actions['rename'][file]))
+                if path.isdir(path.join(self.local_folder, new_path)):
+                    self.upload_folder(new_path, dir_id)
                 else:
-                    self.update_file(file, file_id[0])
-            # otherwise - upload
+                    self.upload_file(new_path, parent=dir_id)
             else:
-                self.upload_file(file, parent=dir_id)        
+                self.upload_file(file, parent=dir_id)
+        self.batch_rename(renames)
+        self.state.put_dir_ids(gdrive_dir_id_cache)
+        self.state.commit()
+        self._report('partial update')
+
+    def _gdrive_parent_path(self, rel_path: str) -> str:
+        """gdrive path of a directory, containing a local object"""
+        return path.normpath(path.join(self.gdrive_folder, path.dirname(rel_path)))
+
+    def _find_files(
+            self,
+            files: list[str],
+            obj_type: Literal['file', 'folder', 'any'],
+            dir_ids: dict[str, str],
+            create_dirs: bool
+        ) -> dict[str, tuple[str|None, list[str]]]:
+        """Searches gdrive objects by their local paths. Directories
+        first, then objects in them, both in batch requests
+
+        Args:
+            files (list[str]): local paths of objects, relative to
+                        the syncing folder
+            obj_type (Literal['file', 'folder', 'any']): to search
+                        only files or folders, or any type
+            dir_ids (dict[str, str]): known gdrive dir ids by paths,
+                        see _resolve_dirs
+            create_dirs (bool): create absent parent dirs
+
+        Returns:
+            dict[str, tuple[str|None, list[str]]]: for every path an id
+                        of the parent dir (None if it doesn't exist) and
+                        ids of found objects
+        """
+        parent_paths = [self._gdrive_parent_path(file) for file in files]
+        self._resolve_dirs(parent_paths, dir_ids, create=create_dirs)
+        # objects are looked for in remembered dirs, which could be
+        # deleted or moved on gdrive. Then objects to delete or move
+        # would be found in a wrong place
+        if self._verify_dirs(parent_paths, dir_ids):
+            self._resolve_dirs(parent_paths, dir_ids, create=create_dirs)
+        found = {file: (None, []) for file in files}
+        # objects can be only in existing dirs, group them by dirs
+        by_parent = {}
+        for file in found:
+            if self._gdrive_parent_path(file) in dir_ids:
+                by_parent.setdefault(dir_ids[self._gdrive_parent_path(file)], []).append(file)
+        # a dir with several wanted objects is listed, several dirs
+        # by one request, and objects are matched by names. A single
+        # object is cheaper to search by it's name, than to list
+        # a big dir, such searches go in a batch
+        listed = [parent_id for parent_id, dir_files in by_parent.items() if len(dir_files) > 1]
+        children = {}
+        for start in range(0, len(listed), LIST_PARENTS_PER_REQUEST):
+            for item in self._list_children(listed[start:start + LIST_PARENTS_PER_REQUEST], 'id, name, mimeType, parents'):
+                for parent_id in item.get('parents', []):
+                    children.setdefault((parent_id, item['name']), []).append(item)
+        for parent_id in listed:
+            for file in by_parent[parent_id]:
+                found[file] = (parent_id, [
+                    item['id'] for item in children.get((parent_id, path.basename(file)), [])
+                    if obj_type == 'any' or
+                    (item['mimeType'] == 'application/vnd.google-apps.folder') == (obj_type == 'folder')
+                ])
+        searchable = [dir_files[0] for dir_files in by_parent.values() if len(dir_files) == 1]
+        results = self.search_by_names([
+            (path.basename(file), dir_ids[self._gdrive_parent_path(file)], obj_type) for file in searchable
+        ])
+        for file, file_ids in zip(searchable, results):
+            found[file] = (dir_ids[self._gdrive_parent_path(file)], file_ids)
+        for file, (_, file_ids) in found.items():
+            if len(file_ids) > 1:
+                logger.info(f'(gdrive) !!! warning, found several files {file} on gdrive')
+        return found
+
+    def _forget_dirs(self, gdrive_path: str, dir_ids: dict[str, str]) -> None:
+        """Forgets a gdrive dir and all dirs inside it, when it's
+        deleted or moved
+
+        Args:
+            gdrive_path (str): the dir path on gdrive
+            dir_ids (dict[str, str]): known gdrive dir ids by paths
+        """
+        for known_path in [
+                known_path for known_path in dir_ids
+                if known_path == gdrive_path or known_path.startswith(path.join(gdrive_path, ''))
+            ]:
+            del dir_ids[known_path]
+            self._verified_dirs.pop(known_path, None)
+        self.state.drop_dir_ids(gdrive_path)
+
+    def _verify_dirs(self, gdrive_paths: list[str], dir_ids: dict[str, str]) -> bool:
+        """Checks, that remembered dirs and their parents still exist
+        on gdrive by the same names in the same parents, by one batch
+        request. Those which don't are forgotten, found and checked ones
+        aren't checked again
+
+        Args:
+            gdrive_paths (list[str]): dir paths on gdrive
+            dir_ids (dict[str, str]): known gdrive dir ids by paths
+
+        Returns:
+            bool: True if any dir was forgotten, then paths have to be
+                        resolved again
+        """
+        to_check = set()
+        for gdrive_path in gdrive_paths:
+            while gdrive_path:
+                if gdrive_path in self._unverified_dirs and gdrive_path in dir_ids:
+                    to_check.add(gdrive_path)
+                gdrive_path = path.dirname(gdrive_path)
+        if not to_check:
+            return False
+        # parents first, so a gone parent takes it's children with it
+        to_check = sorted(to_check)
+        self.make_creds()
+        results = self._execute_batch([
+            self.service.files().get(fileId=dir_ids[gdrive_path], fields='name, parents, trashed')
+            for gdrive_path in to_check
+        ], raise_errors=False)
+        forgotten = False
+        for gdrive_path, (response, exception) in zip(to_check, results):
+            self._unverified_dirs.discard(gdrive_path)
+            self._verified_dirs[gdrive_path] = monotonic()
+            if exception is not None and not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                raise exception
+            # forgotten together with it's parent
+            if gdrive_path not in dir_ids:
+                continue
+            # the parent is known, unless it's the gdrive root
+            parent_path = path.dirname(gdrive_path)
+            if exception is None and not response.get('trashed') and \
+                response.get('name') == path.basename(gdrive_path) and \
+                (parent_path not in dir_ids or dir_ids[parent_path] in response.get('parents', [])):
+                continue
+            logger.info(f'(gdrive) remembered directory {gdrive_path} is gone or moved, looking for it again')
+            self._forget_dirs(gdrive_path, dir_ids)
+            forgotten = True
+        return forgotten
 
+    def watch(self, full_sync_interval: float=WATCH_FULL_SYNC_INTERVAL) -> None:
+        """Keeps the local and gdrive directory in sync until
+        interrupted. Makes a full sync, then watches the local folder
+        and applies it's changes by sync_partial, when there were no
+        new ones for WATCH_DEBOUNCE seconds. Full syncs are repeated
+        every full_sync_interval seconds to bring changes from gdrive
+        and anything the watcher missed. Local changes made before
+        the sync's local walk are left for it, the walk sees them.
+        Those made later are collected, except the sync's own ones
+
+        Args:
+            full_sync_interval (float, optional): seconds between
+                        full syncs
+        """
+        # watched from the start, so nothing made during the first
+        # sync is missed
+        watcher = self._watcher = make_watcher(self.local_folder, self._ignored)
+        collector = ActionsCollector()
+        last_full_sync = None
+        try:
+            while True:
+                try:
+                    if last_full_sync is None or collector.full_sync or time() - last_full_sync >= full_sync_interval:
+                        logger.info('Full sync')
+                        self.sync()
+                        last_full_sync = time()
+                        # a new gdrive folder is made only once
+                        self.create_folder = False
+                        # events before the local walk are dropped by
+                        # _sync, of the rest only the sync's own ones
+                        collector = ActionsCollector()
+                        events = watcher.read(0)
+                        while events:
+                            for event in events:
+                                if not self._own_event(event):
+                                    collector.add(event)
+                            events = watcher.read(0)
+                        self._own_changes.clear()
+                        self._own_removed_dirs.clear()
+                    events = watcher.read(WATCH_DEBOUNCE)
+                    for event in events:
+                        collector.add(event)
+                    # apply when changes calm down, but don't wait forever
+                    if collector and not collector.full_sync and \
+                        (not events or time() - collector.since >= WATCH_MAX_DELAY):
+                        actions = json.dumps(collector.actions())
+                        logger.info(f'Applying local changes {actions}')
+                        self.sync_partial(actions)
+                        collector = ActionsCollector()
+                # collected changes are applied with the next try
+                except NETWORK_ERRORS as e:
+                    logger.error(f'Network error, retrying in {WATCH_RETRY_DELAY} seconds: {e}')
+                    sleep(WATCH_RETRY_DELAY)
+                # the update could be applied partly, a full sync fixes it
+                except Exception as e:
+                    logger.error(f'Unexpected error, a full sync in {WATCH_RETRY_DELAY} seconds: {e}')
+                    collector.full_sync = True
+                    sleep(WATCH_RETRY_DELAY)
+        finally:
+            self._watcher = None
+            watcher.close()
+
+    def serve(self, address: str) -> None:
+        """Keeps running and applies actions sent by clients (see
+        send_actions) by sync_partial, with warm credentials, service
+        and dir ids, so an update costs only the requests it needs.
+        Actions coming within SERVE_DEBOUNCE seconds of each other are
+        coalesced into one update. Every client gets the result of the
+        update it's actions went to
+
+        Args:
+            address (str): a unix socket path or host:port
+        """
+        server = make_socket(address, listen=True)
+        # anyone may connect to a port, so a client has to show a token,
+        # which only the user can read. A unix socket is protected by
+        # it's directory, see private_dir
+        token = None
+        if server.family == socket.AF_INET:
+            token = token_hex(16)
+            with open(token_path(address), 'w', opener=lambda file, flags: os_open(file, flags, 0o600)) as file:
+                file.write(token)
+        # bytes received so far by connections
+        reading = {}
+        # connections waiting for the result of the collected actions
+        waiting = []
+        # raw actions of the collected requests, they are applied one by
+        # one, if the collector can't tell their sum
+        payloads = []
+        collector = ActionsCollector()
+        last_request = 0
+        # after a network error the collected actions wait for the next try
+        retry_at = 0
+        # updates come much later, so the startup is told now
+        self.metrics.startup()
+        logger.info(f'Serving partial updates of {self.local_folder} on {address}, '
+                    f'started in {self.metrics.phases.get("startup", 0):.2f} s')
+        try:
+            while True:
+                timeout = max(SERVE_DEBOUNCE - (monotonic() - last_request), retry_at - monotonic(), 0) if payloads else None
+                ready, _, _ = select([server, *reading], [], [], timeout)
+                for conn in ready:
+                    if conn is server:
+                        client, _ = server.accept()
+                        reading[client] = b''
+                        continue
+                    try:
+                        received = conn.recv(65536)
+                    except OSError:
+                        received = b''
+                    if not received:
+                        del reading[conn]
+                        conn.close()
+                        continue
+                    reading[conn] += received
+                    if not reading[conn].endswith(b'\n'):
+                        continue
+                    message = reading.pop(conn)
+                    try:
+                        request = json.loads(message)
+                        if token is not None and not compare_digest(str(request.get('token', '')), token):
+                            logger.warning('Got a request with a wrong token, ignored')
+                            self._answer([conn], {'ok': False, 'error': 'Wrong token'})
+                            continue
+                        actions = request['actions']
+                        if not isinstance(actions, dict):
+                            raise ValueError('actions have to be a json object')
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        self._answer([conn], {'ok': False, 'error': f'Wrong request: {e}'})
+                        continue
+                    logger.info(f'Got actions {json.dumps(actions)}')
+                    payloads.append(actions)
+                    collector.add_actions(actions, self.local_folder)
+                    waiting.append(conn)
+                    last_request = monotonic()
+                if not payloads or monotonic() - last_request < SERVE_DEBOUNCE or monotonic() < retry_at:
+                    continue
+                try:
+                    # like a directory replaced by another one
+                    if collector.full_sync:
+                        for actions in payloads:
+                            self.sync_partial(json.dumps(actions))
+                    else:
+                        actions = collector.actions()
+                        if len(payloads) > 1:
+                            logger.info(f'Applying {len(payloads)} coalesced requests {json.dumps(actions)}')
+                        self.sync_partial(json.dumps(actions))
+                    result = {'ok': True}
+                # the actions stay and are applied with the next try
+                except NETWORK_ERRORS as e:
+                    logger.error(f'Network error, retrying in {WATCH_RETRY_DELAY} seconds: {e}')
+                    result = {'ok': False, 'queued': True, 'error': f'Network error, the server will retry: {e}'}
+                    retry_at = monotonic() + WATCH_RETRY_DELAY
+                # the update could be applied partly, the client decides
+                except Exception as e:
+                    logger.error(f'Unexpected error, the update is dropped: {e}')
+                    result = {'ok': False, 'error': str(e)}
+                    # remembered dirs could be the reason
+                    self._verified_dirs.clear()
+                if not result.get('queued'):
+                    payloads = []
+                    collector = ActionsCollector()
+                self._answer(waiting, result)
+                waiting = []
+        finally:
+            for conn in [*reading, *waiting]:
+                conn.close()
+            server.close()
+            if server.family != socket.AF_INET:
+                remove(address)
+            elif path.exists(token_path(address)):
+                remove(token_path(address))
+
+    @staticmethod
+    def _answer(connections: list[socket.socket], result: dict) -> None:
+        """sends a result to clients and closes connections"""
+        for conn in connections:
+            try:
+                conn.sendall(json.dumps(result).encode('utf-8') + b'\n')
+            # the client didn't wait
+            except OSError:
+                pass
+            conn.close()
+
+
+def private_dir() -> str:
+    """The directory for sockets and tokens of --mode serve, which only
+    the user can access: in XDG_RUNTIME_DIR or in the temp dir. The
+    temp dir of windows is the user's own already
+
+    Raises:
+        PermissionError: the directory exists, but isn't the user's
+                    own, like made by someone else in the shared temp dir
+
+    Returns:
+        str: the directory path
+    """
+    if os_name != 'posix':
+        dir_path = path.join(gettempdir(), 'gdrive_sync')
+        if not path.isdir(dir_path):
+            mkdir(dir_path)
+        return dir_path
+    # posix only
+    from os import getuid
+    if environ.get('XDG_RUNTIME_DIR') and path.isdir(environ['XDG_RUNTIME_DIR']):
+        dir_path = path.join(environ['XDG_RUNTIME_DIR'], 'gdrive_sync')
+    else:
+        dir_path = path.join(gettempdir(), f'gdrive_sync_{getuid()}')
+    try:
+        mkdir(dir_path, 0o700)
+    except FileExistsError:
+        pass
+    dir_stat = lstat(dir_path)
+    if not S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != getuid() or dir_stat.st_mode & 0o077:
+        raise PermissionError(f'{dir_path} has to be a directory, which only the user can access')
+    return dir_path
+
+def token_path(address: str) -> str:
+    """the file with the token of a host:port server, see serve"""
+    return path.join(private_dir(), f'{hashlib.md5(address.encode("utf-8")).hexdigest()[:16]}.token')
+
+def default_address(local_folder: str) -> str:
+    """The address of the --mode serve process of a local folder:
+    a unix socket in private_dir or a localhost port, both named
+    after the folder
+
+    Args:
+        local_folder (str): the synced folder
+
+    Returns:
+        str: a socket path or host:port
+    """
+    key = hashlib.md5(path.abspath(local_folder).encode('utf-8')).hexdigest()
+    if hasattr(socket, 'AF_UNIX') and os_name == 'posix':
+        return path.join(private_dir(), f'{key[:16]}.sock')
+    return f'127.0.0.1:{SERVE_PORTS[0] + int(key, 16) % (SERVE_PORTS[1] - SERVE_PORTS[0])}'
+
+def make_socket(address: str, listen: bool) -> socket.socket:
+    """Makes a listening socket for --mode serve or connects to it
+
+    Args:
+        address (str): a unix socket path or host:port
+        listen (bool): listen if True, otherwise connect
+
+    Raises:
+        RuntimeError: another server already listens on the socket path
+        FileNotFoundError, ConnectionRefusedError: nobody listens
+
+    Returns:
+        socket.socket: the socket
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target = (host, int(port))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address
+    if not listen:
+        try:
+            sock.connect(target)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    if sock.family != socket.AF_INET and path.exists(address):
+        # a socket left by a killed server is removed, a live one is not
+        try:
+            make_socket(address, listen=False).close()
+        except (FileNotFoundError, ConnectionRefusedError):
+            remove(address)
+        else:
+            sock.close()
+            raise RuntimeError(f'Another server already listens on {address}')
+    # only the user may send actions, the socket file is made
+    # so from the start
+    if sock.family != socket.AF_INET:
+        old_umask = umask(0o177)
+        try:
+            sock.bind(target)
+        finally:
+            umask(old_umask)
+    else:
+        # a restarted server takes it's port at once, though connections
+        # of the previous one are still closing. Windows does the same
+        # by default, but lets other programs take the port too
+        if os_name == 'posix':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif hasattr(socket, 'SO_EXCLUSIVEADDRUSE'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        sock.bind(target)
+    sock.listen()
+    return sock
+
+def send_actions(address: str, actions_json: str) -> dict|None:
+    """Sends actions to a running --mode serve process and waits
+    until they are applied
+
+    Args:
+        address (str): a unix socket path or host:port
+        actions_json (str): actions, see GdriveSync.sync_partial
+
+    Returns:
+        dict|None: the server answer like {'ok': True}, or
+                    {'ok': False, 'error': ...}. None if no server
+                    is running
+    """
+    try:
+        conn = make_socket(address, listen=False)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    with conn:
+        request = {'actions': json.loads(actions_json)}
+        # a port without a token file isn't a server of the user
+        if conn.family == socket.AF_INET:
+            try:
+                with open(token_path(address), encoding='utf-8') as file:
+                    request['token'] = file.read()
+            except FileNotFoundError:
+                return None
+        conn.settimeout(SERVE_CLIENT_TIMEOUT)
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        answer = b''
+        while not answer.endswith(b'\n'):
+            received = conn.recv(65536)
+            if not received:
+                break
+            answer += received
+    if not answer:
+        return {'ok': False, 'error': 'The server closed the connection without an answer'}
+    return json.loads(answer)
 
 def sendmessage(off_messages: bool=False, message: str='', timeout: str='0') -> None:
     """Sends a message to notification daemon in a separate process.
@@ -1317,6 +4707,37 @@ if __name__ == '__main__':
                         ],
                         default='mirror', help='options to use:'
                         'local_to_gdrive, gdrive_to_local, mirror, ask')
+    parser.add_argument('--max-transfers', type=int, default=4,
+                        help='how many files can be uploaded or downloaded at once')
+    parser.add_argument('--delta', action='store_true',
+                        help='take from gdrive only changes since the last sync '
+                        'instead of listing the whole directory')
+    parser.add_argument('--simple-upload-threshold', type=float, default=SIMPLE_UPLOAD_THRESHOLD / 1024 / 1024,
+                        help='files up to this size in MB are uploaded by one request, '
+                        'bigger ones - by a resumable session')
+    parser.add_argument('--chunk-size', type=int, default=UPLOAD_CHUNK_SIZE // 1024 // 1024,
+                        help='chunk size in MB for resumable uploads')
+    parser.add_argument('--download-chunk-size', type=int, default=DOWNLOAD_CHUNK_SIZE // 1024 // 1024,
+                        help='chunk size in MB for downloads')
+    parser.add_argument('--hash-local', action='store_true',
+                        help='count md5 of all local files before comparing')
+    parser.add_argument('--local-walkers', type=int, default=1,
+                        help='how many local directories are read at once, '
+                        'more than one helps on network filesystems')
+    parser.add_argument('--metrics-file', type=str,
+                        help='append requests and timings of every run to this file as json lines')
+    parser.add_argument('--state-file', type=str, default='sync_state.db',
+                        help='where the state of the last sync is kept')
+    parser.add_argument('--record', type=str,
+                        help='write gdrive requests and responses to this file, ids and tokens anonymized')
+    parser.add_argument('--replay', type=str,
+                        help='serve gdrive requests from a file written by --record instead of gdrive')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='replayed requests take the recorded time divided by this, 0 - no waiting')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and upload local changes as they happen')
+    parser.add_argument('--full-sync-interval', type=float, default=WATCH_FULL_SYNC_INTERVAL / 60,
+                        help='minutes between full syncs in the watch mode')
     parser.add_argument('--ignore', type=ignore_directory_parser, action='append',
                     help='ignore directories with the specified path and type.'
                     'Format: --ignore path=<path>,type=<type> '
@@ -1324,10 +4745,18 @@ if __name__ == '__main__':
                     '<type>: single_file, all_files, folder'
                     '<path>: RELATIVE path INSIDE the syncing directory',
                     default=[])
+    parser.add_argument('--ignore-pattern', type=str, action='append', default=[],
+                        help='ignore files and directories matching a glob pattern, like *.tmp '
+                        'or **/.trash/ . A pattern ending with / matches directories only')
     # Alternative mode. Have to use here 'optional' argument, --actions_json
     # though it's required in this mode
     # This mode ignores local_dir, sync_direction, --new, as it makes no sense
-    parser.add_argument('--mode', type=str, choices=['partial_update'], help='Alternative mode, "partial_update"')
+    parser.add_argument('--mode', type=str, choices=['partial_update', 'serve'],
+                        help='Alternative mode, "partial_update" or "serve" - apply partial updates sent by --client')
+    parser.add_argument('--client', action='store_true',
+                        help='send --mode partial_update actions to a running "--mode serve" process')
+    parser.add_argument('--address', type=str,
+                        help='a unix socket path or host:port of "--mode serve"')
     parser.add_argument('--actions_json', type=str, help='Path to JSON file containing parameters (used with --mode partial_update)')
 
     args = parser.parse_args()
@@ -1372,16 +4801,53 @@ if __name__ == '__main__':
         logger.error('No local folder')
         sendmessage(args.off_notifications, f'{args.local_path} doesnt exist locally')
         exit()
+    # a warm server does the work, if it's running
+    if args.mode == 'partial_update' and args.client:
+        address = args.address
+        try:
+            address = address or default_address(args.local_path)
+            answer = send_actions(address, args.actions_json)
+        # the directory of servers isn't the user's own, so no server of
+        # the user can be there, see private_dir
+        except PermissionError as e:
+            logger.warning(f'Cant look for a server: {e}')
+            address = address or 'the default address'
+            answer = None
+        except (OSError, ValueError) as e:
+            answer = {'ok': False, 'error': str(e)}
+        if answer is None:
+            logger.info(f'No server on {address}, applying the actions here')
+        elif answer['ok']:
+            sendmessage(args.off_notifications, 'Partial sync was successfully applied', '10000')
+            logger.info('All done well by the server\n-----------------------')
+            _exit(0)
+        else:
+            logger.error(f'The server failed: {answer["error"]}')
+            sendmessage(args.off_notifications, f'{args.gdrive_dir} wasnt synced: {answer["error"]}')
+            _exit(1)
     while retries:
+        gdrive = None
         try:
             # it's a new mode so look a bit out of design
-            if args.mode == 'partial_update':
+            if args.mode in ('partial_update', 'serve'):
                 gdrive = GdriveSync(
                     **GOOGLE_LOGIN,
                     local_folder=args.local_path,
-                    gdrive_folder=args.gdrive_dir
+                    gdrive_folder=args.gdrive_dir,
+                    simple_upload_threshold=int(args.simple_upload_threshold * 1024 * 1024),
+                    chunk_size=args.chunk_size * 1024 * 1024,
+                    download_chunk_size=args.download_chunk_size * 1024 * 1024,
+                    metrics_file=args.metrics_file,
+                    state_file=args.state_file,
+                    record_file=args.record,
+                    replay_file=args.replay,
+                    replay_speed=args.replay_speed
                 )
-                gdrive.sync_partial(args.actions_json)
+                # runs until interrupted, errors of updates are handled inside
+                if args.mode == 'serve':
+                    gdrive.serve(args.address or default_address(args.local_path))
+                else:
+                    gdrive.sync_partial(args.actions_json)
                 sendmessage(args.off_notifications, 'Partial sync was successfully applied', '10000')
                 logger.info('All done well\n-----------------------')                
                 # the work is done, don't allow retries
@@ -1394,15 +4860,34 @@ if __name__ == '__main__':
                     gdrive_folder=args.gdrive_dir,
                     create_folder=args.new,
                     sync_direction=args.sync_direction,
-                    ignored_objects=args.ignore
+                    ignored_objects=args.ignore,
+                    ignore_patterns=args.ignore_pattern,
+                    max_transfers=args.max_transfers,
+                    delta=args.delta,
+                    simple_upload_threshold=int(args.simple_upload_threshold * 1024 * 1024),
+                    chunk_size=args.chunk_size * 1024 * 1024,
+                    download_chunk_size=args.download_chunk_size * 1024 * 1024,
+                    hash_local=args.hash_local,
+                    max_walkers=args.local_walkers,
+                    metrics_file=args.metrics_file,
+                    state_file=args.state_file,
+                    record_file=args.record,
+                    replay_file=args.replay,
+                    replay_speed=args.replay_speed
                 )
-                gdrive.sync()
+                # runs until interrupted, network errors are handled inside
+                if args.watch:
+                    gdrive.watch(args.full_sync_interval * 60)
+                else:
+                    gdrive.sync()
                 sendmessage(args.off_notifications, f'{args.gdrive_dir} successfully synced', '10000')
                 logger.info('All done well\n-----------------------')
+                # _exit skips the finally below
+                gdrive.close()
                 # the work is done, don't allow retries
                 _exit(0)  # 0 for success, windows requires
         # if issues are related exactly to the network then wait and retry
-        except (TimeoutError, TransportError, ServerNotFoundError, RefreshError):
+        except NETWORK_ERRORS:
             sendmessage(args.off_notifications, f'{args.gdrive_dir} wasnt synced, probably network issues, will retry', '10000')
             logger.error('Network error, retrying')
             sleep(120)
@@ -1412,6 +4897,10 @@ if __name__ == '__main__':
             logger.error(f'Unexpected error, interrupted: {str(e)}')
             sendmessage(args.off_notifications, f'{args.gdrive_dir} wasnt synced, an error occured: {str(e)}')
             break
+        # a retry starts a new recording, an interruption ends it
+        finally:
+            if gdrive is not None:
+                gdrive.close()
     else:
         logger.critical('Network error, out of retries')
         sendmessage(args.off_notifications, f'{args.gdrive_dir} wasnt synced, probably network issues, retries are over')